@@ -0,0 +1,299 @@
+"""Benchmarks for the compression and preview pipeline. Runs headless (offscreen Qt platform).
+
+Usage:
+    python benchmark.py run [--out results.json] [--quick] [--repeat 5]
+    python benchmark.py compare old.json new.json [--threshold 10]
+
+run generates a corpus of synthetic images (ui screenshots, gradients, noise, photo) in a few
+sizes, plus samples/cat2.png, and measures:
+    encode/<encoder>/<image>/q<value>   encode latency per compression value (and output bytes)
+    decode/<encoder>/<image>            first decode of the source
+    open/<image>                        open_image until the compressed preview is painted
+    zoom/<image>/step<n>                repaint of both panes after each zoom in step
+    copy/<image>                        preparing the clipboard/drag data of the compressed image
+    peak_rss/<image>                    peak memory of a process that opened the image
+Every entry has median_ms (or kb for peak_rss) so two result files can be compared.
+"""
+import os
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import argparse
+import json
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageDraw
+
+import encoders
+
+PROGRAM_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_IMAGE = os.path.join(PROGRAM_DIR, "samples", "cat2.png")
+
+SIZES = {"vga": (640, 480), "hd": (1920, 1080), "4k": (3840, 2160)}
+QUICK_SIZES = {"vga": (640, 480), "hd": (1920, 1080)}
+CONTENTS = ("ui", "gradient", "noise", "photo")
+COMPRESSION_VALUES = (1, 2, 4, 7, 12, 20, 31)
+ZOOM_STEPS = 12
+
+
+# -------- corpus ----------------
+def make_image(content, size, seed=0):
+    """synthetic test image. Same content, size and seed always give the same image"""
+    width, height = size
+    rng = random.Random(seed)
+    if content == "ui":
+        # flat areas, sharp edges and text, like a screenshot
+        img = Image.new("RGB", size, (240, 240, 240))
+        draw = ImageDraw.Draw(img)
+        for _ in range(max(4, width*height//40000)):
+            x, y = rng.randrange(width), rng.randrange(height)
+            color = tuple(rng.randrange(256) for _ in range(3))
+            draw.rectangle((x, y, x + rng.randrange(40, 400), y + rng.randrange(20, 200)), fill=color, outline=(0, 0, 0))
+        for y in range(10, height, 18):
+            draw.text((10 + rng.randrange(40), y), "The quick brown fox jumps over the lazy dog "*4, fill=(20, 20, 20))
+        return img
+    if content == "gradient":
+        horizontal = Image.linear_gradient("L").rotate(90).resize(size)
+        vertical = Image.linear_gradient("L").resize(size)
+        return Image.merge("RGB", (horizontal, vertical, Image.radial_gradient("L").resize(size)))
+    if content == "noise":
+        return Image.merge("RGB", [Image.effect_noise(size, 40 + 10*i) for i in range(3)])
+    if content == "photo":
+        with Image.open(SAMPLE_IMAGE) as sample:
+            photo = sample.convert("RGB")
+        # scale to cover the size, then crop the middle
+        scale = max(width/photo.width, height/photo.height)
+        photo = photo.resize((max(width, round(photo.width*scale)), max(height, round(photo.height*scale))), Image.LANCZOS)
+        left, top = (photo.width - width)//2, (photo.height - height)//2
+        return photo.crop((left, top, left + width, top + height))
+    raise ValueError(f"Unknown content {content!r}")
+
+
+def build_corpus(directory, sizes=SIZES, contents=CONTENTS):
+    """writes the synthetic images as png into directory. Returns [(name, path)], samples/cat2.png included"""
+    corpus = []
+    for size_name, size in sizes.items():
+        for content in contents:
+            name = f"{content}-{size_name}"
+            path = os.path.join(directory, name + ".png")
+            make_image(content, size).save(path)
+            corpus.append((name, path))
+    corpus.append(("sample-cat2", SAMPLE_IMAGE))
+    return corpus
+
+
+# -------- measuring ----------------
+def timed(func, repeat):
+    """seconds taken by each of repeat calls of func"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+def summary(name, times, **extra):
+    entry = {
+        "name": name,
+        "median_ms": statistics.median(times)*1000,
+        "min_ms": min(times)*1000,
+        "runs": len(times),
+    }
+    entry.update(extra)
+    return entry
+
+def peak_rss_kb():
+    """peak resident memory of this process in KB, None where resource isn't available"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak//1024 if sys.platform == "darwin" else peak # bytes on macOS, KB on Linux
+
+def available_encoders():
+    names = [encoders.PillowEncoder.name]
+    if shutil.which("ffmpeg"):
+        names.append(encoders.FfmpegEncoder.name)
+    return names
+
+
+def bench_encode(corpus, encoder_names, compression_values, repeat):
+    results = []
+    for image_name, path in corpus:
+        for encoder_name in encoder_names:
+            encoder = encoders.get_encoder(encoder_name, path)
+            if encoder_name == encoders.PillowEncoder.name:
+                results.append(summary(f"decode/{encoder_name}/{image_name}", timed(lambda: encoder.image, 1)))
+            for value in compression_values:
+                data = encoder.encode(value)
+                times = timed(lambda: encoder.encode(value), repeat)
+                results.append(summary(f"encode/{encoder_name}/{image_name}/q{value}", times, bytes=len(data)))
+            print(f"encode {image_name} ({encoder_name}) done", file=sys.stderr)
+    return results
+
+
+def bench_gui(image_name, path, repeat):
+    """open, zoom and copy in the real window. Meant to run in its own process, see run_gui_isolated"""
+    from PySide6.QtWidgets import QApplication
+    app = QApplication.instance() or QApplication([])
+    import main
+
+    # program dir with a config that keeps the caches from hiding the real cost
+    program_dir = tempfile.mkdtemp(prefix="bench-")
+    with open(os.path.join(program_dir, "config.json"), "w") as file:
+        json.dump({"load_folder": program_dir, "cache": {"memory_mb": 0, "preview_mb": 0, "disk_mb": 0}}, file)
+    window = main.Widget(program_dir=program_dir)
+    window.resize(1200, 800)
+    window.show()
+    app.processEvents()
+
+    def paint():
+        for view, area in ((window.real_image_view, window.real_img_scroll_area), (window.cmprsd_image_view, window.cmprsd_img_scroll_area)):
+            view.grab(area.viewport().rect().translated(-view.pos()))
+
+    def wait_for_preview(timeout=120):
+        deadline = time.perf_counter() + timeout
+        while window.encode_worker is not None or window.cmprsd_image is None:
+            if time.perf_counter() > deadline:
+                raise TimeoutError("no compressed preview")
+            app.processEvents()
+            time.sleep(0.001)
+
+    results = []
+    start = time.perf_counter()
+    window.open_image(path)
+    wait_for_preview()
+    paint()
+    results.append(summary(f"open/{image_name}", [time.perf_counter() - start]))
+
+    for step in range(1, ZOOM_STEPS + 1):
+        # every repeat starts from the previous zoom level with empty tile caches
+        times = []
+        for _ in range(repeat):
+            window.zoom_out()
+            paint()
+            window.real_image_view.tiles.clear()
+            window.cmprsd_image_view.tiles.clear()
+            start = time.perf_counter()
+            window.zoom_in()
+            paint()
+            times.append(time.perf_counter() - start)
+        window.zoom_in()
+        results.append(summary(f"zoom/{image_name}/step{step}", times, scale_factor=window.scale_factor))
+
+    results.append(summary(f"copy/{image_name}", timed(window.export_mime_data, repeat)))
+    results.append({"name": f"peak_rss/{image_name}", "kb": peak_rss_kb()})
+    window.close()
+    shutil.rmtree(program_dir, ignore_errors=True)
+    return results
+
+
+def run_gui_isolated(image_name, path, repeat):
+    """bench_gui in a fresh process, so peak memory belongs to this image alone"""
+    command = [sys.executable, os.path.abspath(__file__), "_gui", image_name, path, "--repeat", str(repeat)]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f"gui benchmark failed for {image_name}: {result.stderr.strip()}", file=sys.stderr)
+        return []
+    print(f"gui {image_name} done", file=sys.stderr)
+    return json.loads(result.stdout)
+
+
+def metadata():
+    import PIL, PySide6
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=PROGRAM_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "pillow": PIL.__version__,
+        "pyside6": PySide6.__version__,
+    }
+
+
+# -------- commands ----------------
+def run_main(args):
+    sizes = QUICK_SIZES if args.quick else SIZES
+    corpus_dir = tempfile.mkdtemp(prefix="bench-corpus-")
+    try:
+        corpus = build_corpus(corpus_dir, sizes)
+        results = bench_encode(corpus, available_encoders(), COMPRESSION_VALUES, args.repeat)
+        for image_name, path in corpus:
+            results.extend(run_gui_isolated(image_name, path, args.repeat))
+    finally:
+        shutil.rmtree(corpus_dir, ignore_errors=True)
+
+    with open(args.out, "w") as file:
+        json.dump({"meta": metadata(), "results": results}, file, indent=1)
+    print(f"{len(results)} results written to {args.out}")
+    return 0
+
+
+def gui_main(args):
+    json.dump(bench_gui(args.image_name, args.path, args.repeat), sys.stdout)
+    return 0
+
+
+def compare_main(args):
+    """print the change of every result present in both files, non zero exit if something got slower than threshold %"""
+    with open(args.old) as file: old = {r["name"]: r for r in json.load(file)["results"]}
+    with open(args.new) as file: new = {r["name"]: r for r in json.load(file)["results"]}
+    regressions = 0
+    for name in sorted(old.keys() & new.keys()):
+        metric = "median_ms" if "median_ms" in new[name] else "kb"
+        before, after = old[name].get(metric), new[name].get(metric)
+        if not before or after is None: continue
+        change = (after - before)/before*100
+        flag = ""
+        if change > args.threshold:
+            flag = "  SLOWER" if metric == "median_ms" else "  MORE MEMORY"
+            regressions += 1
+        elif change < -args.threshold:
+            flag = "  faster" if metric == "median_ms" else "  less memory"
+        print(f"{name:50} {before:10.2f} -> {after:10.2f} {metric}  {change:+6.1f}%{flag}")
+    only = sorted(old.keys() ^ new.keys())
+    if only:
+        print(f"{len(only)} results are only in one of the files")
+    print(f"{regressions} regressions over {args.threshold}%")
+    return 1 if regressions else 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmarks for the compression and preview pipeline")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="run the benchmarks and write the results as json")
+    run.add_argument("--out", default="benchmark-results.json", help="results file")
+    run.add_argument("--repeat", type=int, default=5, help="runs per measurement, the median is reported")
+    run.add_argument("--quick", action="store_true", help="skip the 4k images")
+    run.set_defaults(func=run_main)
+
+    compare = commands.add_parser("compare", help="compare two results files")
+    compare.add_argument("old")
+    compare.add_argument("new")
+    compare.add_argument("--threshold", type=float, default=10, help="percent change reported as a regression")
+    compare.set_defaults(func=compare_main)
+
+    gui = commands.add_parser("_gui") # used by run_gui_isolated
+    gui.add_argument("image_name")
+    gui.add_argument("path")
+    gui.add_argument("--repeat", type=int, default=5)
+    gui.set_defaults(func=gui_main)
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    sys.exit(args.func(args))
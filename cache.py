@@ -0,0 +1,243 @@
+"""Cache of encoded images so revisiting a compression value doesn't encode again.
+
+Entries are keyed by (source content hash, source mtime, encode settings...).
+Encoded bytes are kept in memory and optionally on disk, decoded previews in memory only.
+Every level is bounded in bytes and evicts the least recently used entries first.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+class LRUCache:
+    """In-memory LRU cache bounded by the total size of its values. sizeof(value) gives a value's size in bytes"""
+    def __init__(self, max_bytes, sizeof=len):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.entries = OrderedDict() # key -> (value, size)
+        self.bytes = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None: return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self.lock:
+            # the old value goes either way, a value too big to keep mustn't leave the old one behind
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+            if size > self.max_bytes: return
+            self.entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, old_size) = self.entries.popitem(last=False)
+                self.bytes -= old_size
+                self.evictions += 1
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+
+class DiskCache:
+    """Encoded bytes stored as files in a directory, bounded by total size, oldest used files are removed first"""
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.files = OrderedDict() # file name -> size, least recently used first
+        self.bytes = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # pick up files from earlier runs, ordered by last use
+        existing = sorted(os.scandir(directory), key=lambda entry: entry.stat().st_mtime)
+        for entry in existing:
+            if entry.is_file():
+                self.files[entry.name] = entry.stat().st_size
+                self.bytes += entry.stat().st_size
+        self._evict()
+
+    @staticmethod
+    def file_name(key):
+        return hashlib.sha1(repr(key).encode()).hexdigest()
+
+    def get(self, key):
+        name = self.file_name(key)
+        with self.lock:
+            if name not in self.files: return None
+            self.files.move_to_end(name)
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+            os.utime(path) # mtime is the last use time, see __init__
+        except OSError:
+            with self.lock:
+                self.bytes -= self.files.pop(name, 0)
+            return None
+        return data
+
+    def put(self, key, data):
+        name = self.file_name(key)
+        path = os.path.join(self.directory, name)
+        if len(data) > self.max_bytes:
+            # too big to keep, but the older data stored for key is stale now
+            with self.lock:
+                if name not in self.files: return
+                self.bytes -= self.files.pop(name)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return
+        # write to a temporary file first so a half written file is never read
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.bytes -= self.files.pop(name, 0)
+            self.files[name] = len(data)
+            self.bytes += len(data)
+            self._evict()
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self.files:
+            name, size = self.files.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+
+class EncodeCache:
+    """Encoded bytes (memory + optional disk), decoded previews and quality metrics (memory) for (source, settings) keys"""
+    def __init__(self, memory_bytes, preview_bytes, disk_bytes=0, disk_dir=None, preview_sizeof=len):
+        self.memory = LRUCache(memory_bytes)
+        self.previews = LRUCache(preview_bytes, sizeof=preview_sizeof)
+        # metrics.Metrics of an encode against its source, small so the limit is a count
+        self.metrics = LRUCache(4096, sizeof=lambda metrics: 1)
+        self.disk = DiskCache(disk_dir, disk_bytes) if disk_bytes > 0 and disk_dir else None
+        self.source_keys = {} # (path, size, mtime_ns) -> source key, so a file is hashed only once
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, configuration, program_dir, preview_sizeof=len):
+        """build the cache from the "cache" section of config.json"""
+        cache_config = configuration["cache"]
+        disk_dir = cache_config["dir"]
+        if not os.path.isabs(disk_dir):
+            disk_dir = os.path.join(program_dir, disk_dir)
+        return cls(
+            memory_bytes=int(cache_config["memory_mb"]*1048576),
+            preview_bytes=int(cache_config["preview_mb"]*1048576),
+            disk_bytes=int(cache_config["disk_mb"]*1048576),
+            disk_dir=disk_dir,
+            preview_sizeof=preview_sizeof,
+        )
+
+    @staticmethod
+    def _stat_key(path):
+        stat = os.stat(path)
+        return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+    def source_key(self, path):
+        """(content hash, mtime) of a source file. Hashes the file the first time it's seen"""
+        stat_key = self._stat_key(path)
+        with self.lock:
+            if stat_key in self.source_keys:
+                return self.source_keys[stat_key]
+        digest = hashlib.sha1()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1048576), b""):
+                digest.update(chunk)
+        key = (digest.hexdigest(), stat_key[2])
+        with self.lock:
+            self.source_keys[stat_key] = key
+        return key
+
+    def known_source_key(self, path):
+        """source key if the file was hashed already, else None. Never reads the file"""
+        try:
+            stat_key = self._stat_key(path)
+        except OSError:
+            return None
+        with self.lock:
+            return self.source_keys.get(stat_key)
+
+    def get(self, key):
+        """encoded bytes for key or None"""
+        data = self.memory.get(key)
+        if data is None and self.disk is not None:
+            data = self.disk.get(key)
+            if data is not None:
+                self.memory.put(key, data)
+                with self.lock: self.disk_hits += 1
+        with self.lock:
+            if data is None: self.misses += 1
+            else: self.hits += 1
+        return data
+
+    def put(self, key, data, preview=None):
+        self.memory.put(key, data)
+        if self.disk is not None:
+            self.disk.put(key, data)
+        if preview is not None:
+            self.previews.put(key, preview)
+
+    def get_in_memory(self, key):
+        """(bytes, preview) if both are in memory, else None. Cheap enough for the UI thread"""
+        data = self.memory.get(key)
+        preview = self.previews.get(key)
+        if data is None or preview is None: return None
+        with self.lock: self.hits += 1
+        return data, preview
+
+    def get_preview(self, key):
+        """decoded preview for key or None. Doesn't count towards hits/misses"""
+        return self.previews.get(key)
+
+    def stats(self):
+        """hit/miss counts and memory use as a dict"""
+        stats = {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "entries": len(self.memory),
+            "memory_bytes": self.memory.bytes,
+            "preview_bytes": self.previews.bytes,
+            "evictions": self.memory.evictions + self.previews.evictions,
+        }
+        if self.disk is not None:
+            stats["disk_bytes"] = self.disk.bytes
+            stats["evictions"] += self.disk.evictions
+        return stats
+
+    def stats_str(self):
+        stats = self.stats()
+        total = stats["hits"] + stats["misses"]
+        hit_rate = stats["hits"]/total*100 if total else 0
+        text = (f"Cache: {stats['hits']} hits ({stats['disk_hits']} from disk), {stats['misses']} misses ({hit_rate:.0f}%), "
+                f"{stats['entries']} entries, {stats['memory_bytes']/1048576:.1f}MB encoded + {stats['preview_bytes']/1048576:.1f}MB previews")
+        if "disk_bytes" in stats:
+            text += f", {stats['disk_bytes']/1048576:.1f}MB on disk"
+        return text
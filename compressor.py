@@ -0,0 +1,613 @@
+"""Headless image compression.
+
+Usage:
+    python -m compressor batch <dir|glob> [--q 7 | --min-ssim 0.98 | --min-psnr 40] [--workers N] [--out DIR]
+    python -m compressor target <image> --max-size 200KB [--allow-scaling] [--out DIR]
+    python -m compressor watch [dir] [--q 7] [--workers N] [--queue 16] [--poll SECONDS]
+    python -m compressor compare <image> [--formats jpeg,webp,avif,png] [--value webp=30] [--metrics]
+    python -m compressor serve [--port 8765 | --socket PATH] [--workers N] [--queue 32]
+    python -m compressor dedup stats|gc [--older-than DAYS] [--max-mb MB]
+
+batch, target and watch take --format and --preset (fast, balanced, small), the compression value range depends on the format.
+batch and watch take --dedup to reuse earlier outputs of identical sources, see dedup.py, and --lossless-jpeg
+to only optimize JPEG sources written as JPEG instead of re-encoding them.
+All commands take --max-width, --max-height, --scale PERCENT, --megapixels and --filter to downscale before encoding,
+and --exif keep|strip and --icc keep|strip for the source's metadata.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import core
+import dedup
+import encoders
+import imagestore
+import metadata
+import metrics
+import perf
+import resizing
+import search
+import utils
+import watcher
+
+PROGRAM_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# values used when config.json is missing or doesn't have a key
+DEFAULT_CONFIG = {
+    # compression value for "format", the other formats start at their own default
+    "default_compression_value": 7,
+    "load_folder": "..",
+    "out_img_name_pat": "*",
+    "encoder": "pillow",
+    # output format (jpeg, webp, avif, png, jxl if a plugin is installed) and effort preset (fast, balanced, small)
+    "format": "jpeg",
+    "preset": "balanced",
+    # downscale before encoding, see resizing.py. null limits are off, the strictest limit wins, images are never enlarged
+    "resize": {"max_width": None, "max_height": None, "percent": None, "megapixels": None, "filter": "lanczos"},
+    # what outputs keep of the source's metadata, see metadata.py: exif (EXIF, XMP, IPTC, comments) and icc (color profile),
+    # each keep or strip. lossless_jpeg rewrites JPEG sources written as JPEG without re-encoding them (batch, watch, service)
+    "metadata": {"exif": "strip", "icc": "keep", "lossless_jpeg": False},
+    # encoded image cache used by the GUI, sizes in MB. disk_mb 0 disables the disk cache
+    "cache": {"memory_mb": 128, "preview_mb": 256, "disk_mb": 0, "dir": "cache"},
+    # background pre-encoding of neighbouring compression values in the GUI.
+    # radius is how far from the current value to go (null for the whole ladder), threads is the cpu budget
+    "prefetch": {"enabled": False, "radius": 4, "threads": 1},
+    # memory limit for the zoom-out levels (mipmaps) of each image pane in the GUI
+    "pyramid_mb": 256,
+    # images bigger than mmap_threshold_mb once decoded are kept in a memory-mapped file in dir (null for the temp dir)
+    "decode": {"mmap_threshold_mb": 256, "dir": None},
+    # timing of the hot paths, see perf.py. trace_file gets one json line per timed span (null for none),
+    # overlay shows the latest timings in the GUI status bar
+    "perf": {"enabled": False, "trace_file": None, "overlay": False},
+    # local compression service (python -m compressor serve), see service.py. socket is a Unix socket path used instead of host/port
+    "service": {"host": "127.0.0.1", "port": 8765, "socket": None, "workers": 2, "queue": 32, "max_upload_mb": 100},
+    # content-addressed store of outputs (see dedup.py), dir is relative to the program folder.
+    # link is how outputs are made from it: auto (reflink, else hardlink, else copy), reflink, hardlink or copy
+    "dedup": {"enabled": False, "dir": "dedup_store", "link": "auto"},
+    # images open at once in the GUI: threads for Export All and the thumbnails (null for one less than the cpu count),
+    # thumbnail_size in pixels
+    "session": {"workers": None, "thumbnail_size": 96},
+}
+
+IMAGE_EXTS = (".png", ".jpg", ".jpeg")
+
+
+def load_config(program_dir=PROGRAM_DIR):
+    """read config.json from program_dir, missing keys are filled from DEFAULT_CONFIG"""
+    configuration = {key: dict(value) if isinstance(value, dict) else value for key, value in DEFAULT_CONFIG.items()}
+    config_file_path = os.path.join(program_dir, "config.json")
+    if os.path.exists(config_file_path):
+        with open(config_file_path, "r") as file:
+            for key, value in json.load(file).items():
+                # sections like "cache" only override the keys they have
+                if isinstance(value, dict) and isinstance(configuration.get(key), dict):
+                    configuration[key].update(value)
+                else:
+                    configuration[key] = value
+    return configuration
+
+
+def get_output_path(input_file, output_dir, out_img_name_pat, extension=".jpg"):
+    """output image path for input_file, "*" in out_img_name_pat is replaced with input image name"""
+    input_file_name_wo_ext = utils.get_base_name_wo_ext(input_file)
+    output_file_name = out_img_name_pat.replace("*", input_file_name_wo_ext) + extension
+    return os.path.join(output_dir, output_file_name)
+
+
+def get_output_paths(inputs, output_dir, out_img_name_pat, extension=".jpg"):
+    """output paths for all inputs, like get_output_path, but inputs that would get the same output
+    (a.png and a.jpg) are told apart with a number: a.webp, a-2.webp. None of them is another input's output"""
+    paths = [get_output_path(input_file, output_dir, out_img_name_pat, extension) for input_file in inputs]
+    taken = set(paths)
+    seen = set()
+    for i, path in enumerate(paths):
+        if path in seen:
+            stem = path[:len(path) - len(extension)]
+            number = 2
+            while f"{stem}-{number}{extension}" in taken: number += 1
+            path = paths[i] = f"{stem}-{number}{extension}"
+            taken.add(path)
+        seen.add(path)
+    return paths
+
+
+def output_settings(args, configuration):
+    """(format name, preset, compression value) from the command line, falling back to config.json.
+    Raises ValueError if the value is outside the format's range"""
+    settings = core.Settings.from_config(configuration, args.format, args.preset, args.q)
+    return settings.format.name, settings.preset, settings.compression_value
+
+
+def resize_settings(args, configuration):
+    """resizing.Resize from the command line, limits not given there come from config.json.
+    Raises ValueError for an unknown filter or a limit that isn't above 0"""
+    return core.resize_from_config(configuration, max_width=args.max_width, max_height=args.max_height,
+                                   percent=args.percent, megapixels=args.megapixels, filter=args.filter)
+
+
+def metadata_settings(args, configuration):
+    """metadata.MetadataPolicy from the command line, falling back to config.json"""
+    return metadata.MetadataPolicy.from_config(configuration, args.exif, args.icc)
+
+
+def lossless_jpeg_setting(args, configuration):
+    return args.lossless_jpeg if args.lossless_jpeg is not None else configuration["metadata"]["lossless_jpeg"]
+
+
+def dedup_settings(args, configuration):
+    """(store directory, link mode) if the dedup store is on (--dedup, or enabled in config.json), else (None, link mode)"""
+    dedup_config = configuration["dedup"]
+    enabled = args.dedup if args.dedup is not None else dedup_config["enabled"]
+    if dedup_config["link"] not in dedup.LINK_MODES:
+        raise ValueError(f"Unknown dedup link mode {dedup_config['link']!r}, choose from: {', '.join(dedup.LINK_MODES)}")
+    directory = dedup_config["dir"]
+    if not os.path.isabs(directory):
+        directory = os.path.join(PROGRAM_DIR, directory)
+    return (directory if enabled else None), dedup_config["link"]
+
+
+def compress_file(input_image, output_image, compression_value, encoder=DEFAULT_CONFIG["encoder"], with_metrics=False,
+                  format=DEFAULT_CONFIG["format"], preset=DEFAULT_CONFIG["preset"], resize=None, dedup_dir=None, link_mode="auto",
+                  metadata_policy=None, lossless_jpeg=False):
+    """compress one image with the named encoder, resized first if resize (a resizing.Resize) is given.
+    metadata_policy (a metadata.MetadataPolicy) decides what the output keeps of the source's EXIF and ICC profile.
+    With lossless_jpeg, a JPEG source written as JPEG without resizing is only optimized, "lossless" in the result.
+    With dedup_dir, an output stored there earlier for the same source content and settings is linked
+    to output_image instead (see dedup.py), and new outputs are added to the store.
+    Returns a dict with sizes and time taken, "deduped" is True if the output was reused.
+    with_metrics adds "metrics", a metrics.Metrics of the output against the input (not timed)"""
+    start = time.perf_counter()
+    error = ""
+    out_bytes = 0
+    data = None
+    deduped = False
+    lossless = False
+    try:
+        # the encoder decodes on the first encode, so a reused output costs the hash and the link only
+        image_encoder = core.make_encoder(encoder, input_image, format=format, preset=preset, resize=resize,
+                                          metadata_policy=metadata_policy, lossless_jpeg=lossless_jpeg)
+        lossless = image_encoder.lossless
+        if dedup_dir is None:
+            data = image_encoder.encode(compression_value)
+            utils.write_file(output_image, data)
+        else:
+            store = dedup.open_store(dedup_dir, link_mode)
+            source, settings = store.source_hash(input_image), repr(image_encoder.settings_key(compression_value))
+            blob = store.lookup(source, settings)
+            deduped = blob is not None
+            if not deduped:
+                data = image_encoder.encode(compression_value)
+                blob = store.add(source, settings, data)
+            store.link(blob, output_image)
+        out_bytes = os.path.getsize(output_image)
+    except Exception as e:
+        error = str(e) or type(e).__name__
+    elapsed = time.perf_counter() - start
+
+    result = {
+        "input": input_image,
+        "output": output_image,
+        "ok": not error,
+        "error": error,
+        "in_bytes": os.path.getsize(input_image),
+        "out_bytes": out_bytes,
+        "seconds": elapsed,
+        "deduped": deduped,
+        "lossless": lossless,
+    }
+    if with_metrics and not error:
+        if data is None:
+            with open(output_image, "rb") as file:
+                data = file.read()
+        result["metrics"] = metrics.compare(metrics.load(input_image), metrics.decode(data), resize_filter=resize.filter if resize else "lanczos")
+    return result
+
+
+def compress_file_for_quality(input_image, output_image, metric, threshold, encoder=DEFAULT_CONFIG["encoder"],
+                              format=DEFAULT_CONFIG["format"], preset=DEFAULT_CONFIG["preset"], resize=None, metadata_policy=None):
+    """compress one image with the highest compression value that keeps metric ("ssim" or "psnr") at or above threshold.
+    Returns the same dict as compress_file, plus "compression_value", "metrics" and "fits" """
+    start = time.perf_counter()
+    error = ""
+    out_bytes = 0
+    result = None
+    try:
+        result = search.find_value_for_quality(core.make_encoder(encoder, input_image, format=format, preset=preset, resize=resize,
+                                                                 metadata_policy=metadata_policy), metric, threshold)
+        utils.write_file(output_image, result.data)
+        out_bytes = result.size
+    except Exception as e:
+        error = str(e) or type(e).__name__
+    elapsed = time.perf_counter() - start
+
+    return {
+        "input": input_image,
+        "output": output_image,
+        "ok": not error,
+        "error": error,
+        "in_bytes": os.path.getsize(input_image),
+        "out_bytes": out_bytes,
+        "seconds": elapsed,
+        "compression_value": result.compression_value if result else None,
+        "metrics": result.metrics if result else None,
+        "fits": result.fits if result else False,
+    }
+
+
+def collect_inputs(target):
+    """list of images from a directory or a glob pattern"""
+    if os.path.isdir(target):
+        files = [os.path.join(target, name) for name in os.listdir(target)]
+    else:
+        files = glob.glob(target)
+    return sorted(f for f in files if os.path.isfile(f) and f.lower().endswith(IMAGE_EXTS))
+
+
+def batch_compress(inputs, output_dir, out_img_name_pat, compression_value, workers=None, on_result=None, encoder=DEFAULT_CONFIG["encoder"],
+                   with_metrics=False, quality=None, format=DEFAULT_CONFIG["format"], preset=DEFAULT_CONFIG["preset"], resize=None,
+                   dedup_dir=None, link_mode="auto", metadata_policy=None, lossless_jpeg=False):
+    """compress all inputs across a process pool. on_result is called with each file's result as it finishes.
+    resize is an optional resizing.Resize applied to every image before it's encoded, metadata_policy and
+    lossless_jpeg are as for compress_file.
+    dedup_dir is an optional dedup store, outputs are reused from it for fixed compression values (not with quality).
+    quality is an optional (metric, threshold), then each image gets its own compression value, see compress_file_for_quality.
+    Returns the list of results"""
+    os.makedirs(output_dir, exist_ok=True)
+    results = []
+    output_images = get_output_paths(inputs, output_dir, out_img_name_pat, encoders.get_format(format).extension)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {} # future -> (input, output)
+        for input_image, output_image in zip(inputs, output_images):
+            if quality is not None:
+                future = executor.submit(compress_file_for_quality, input_image, output_image, *quality, encoder, format, preset, resize,
+                                         metadata_policy)
+            else:
+                future = executor.submit(compress_file, input_image, output_image, compression_value, encoder, with_metrics, format, preset, resize,
+                                         dedup_dir, link_mode, metadata_policy, lossless_jpeg)
+            futures[future] = (input_image, output_image)
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e: # e.g. a source deleted meanwhile or a worker process that died, the others go on
+                input_image, output_image = futures[future]
+                result = {"input": input_image, "output": output_image, "ok": False, "error": str(e) or type(e).__name__,
+                          "in_bytes": 0, "out_bytes": 0, "seconds": 0.0}
+            results.append(result)
+            if on_result: on_result(result)
+    return results
+
+
+def format_throughput(count, in_bytes, out_bytes, seconds):
+    """images/s and MB/s in and out"""
+    seconds = max(seconds, 1e-9)
+    return (f"{count/seconds:.2f} images/s, "
+            f"{in_bytes/1048576/seconds:.2f} MB/s in, "
+            f"{out_bytes/1048576/seconds:.2f} MB/s out")
+
+
+def print_result(result):
+    if not result["ok"]:
+        print(f"FAILED {result['input']}: {result['error']}")
+        return
+    percent = result["out_bytes"]/result["in_bytes"]*100 if result["in_bytes"] else 0
+    if "compression_value" in result:
+        print(f"q {result['compression_value']}{'' if result['fits'] else ' (below the quality target)'}  ", end="")
+    print(f"{result['input']} -> {result['output']}  "
+          f"{utils.format_bytes(result['in_bytes'])} -> {utils.format_bytes(result['out_bytes'])} ({percent:.1f}%)  "
+          f"{result['seconds']*1000:.0f}ms  "
+          f"{format_throughput(1, result['in_bytes'], result['out_bytes'], result['seconds'])}"
+          + (f"  {result['metrics']}" if "metrics" in result else "")
+          + ("  (lossless)" if result.get("lossless") else "")
+          + ("  (reused)" if result.get("deduped") else ""))
+
+
+def batch_main(args, configuration):
+    inputs = collect_inputs(args.target)
+    if not inputs:
+        print("No images found for", args.target)
+        return 1
+    try:
+        format_name, preset, compression_value = output_settings(args, configuration)
+        resize = resize_settings(args, configuration)
+        dedup_dir, link_mode = dedup_settings(args, configuration)
+        metadata_policy = metadata_settings(args, configuration)
+    except ValueError as e:
+        print(e)
+        return 2
+    out_img_name_pat = args.pattern if args.pattern is not None else configuration["out_img_name_pat"]
+
+    quality = None
+    if args.min_ssim is not None: quality = ("ssim", args.min_ssim)
+    elif args.min_psnr is not None: quality = ("psnr", args.min_psnr)
+
+    start = time.perf_counter()
+    encoder = args.encoder or configuration["encoder"]
+    results = batch_compress(inputs, args.out, out_img_name_pat, compression_value, args.workers, print_result, encoder, args.metrics, quality,
+                             format_name, preset, resize, dedup_dir, link_mode, metadata_policy, lossless_jpeg_setting(args, configuration))
+    wall = time.perf_counter() - start
+
+    done = [r for r in results if r["ok"]]
+    in_bytes = sum(r["in_bytes"] for r in done)
+    out_bytes = sum(r["out_bytes"] for r in done)
+    print(f"\n{len(done)}/{len(results)} images in {wall:.2f}s: {format_throughput(len(done), in_bytes, out_bytes, wall)}")
+    if in_bytes:
+        print(f"{utils.format_bytes(in_bytes)} -> {utils.format_bytes(out_bytes)} ({out_bytes/in_bytes*100:.1f}%)")
+    # how much each path saved, the lossless path only when some images took it
+    lossless = [r for r in done if r.get("lossless")]
+    if lossless:
+        for name, path_results in (("lossless", lossless), ("lossy", [r for r in done if not r.get("lossless")])):
+            path_in = sum(r["in_bytes"] for r in path_results)
+            path_out = sum(r["out_bytes"] for r in path_results)
+            if path_in:
+                print(f"{name}: {len(path_results)} images, saved {utils.format_bytes(path_in - path_out)} ({(path_in - path_out)/path_in*100:.1f}%)")
+    reused = sum(1 for r in done if r.get("deduped"))
+    if reused:
+        print(f"{reused} outputs reused from the dedup store")
+    return 0 if len(done) == len(results) else 1
+
+
+def target_main(args, configuration):
+    try:
+        format_name, preset, scale_value = output_settings(args, configuration)
+        resize = resize_settings(args, configuration)
+        metadata_policy = metadata_settings(args, configuration)
+    except ValueError as e:
+        print(e)
+        return 2
+    out_img_name_pat = args.pattern if args.pattern is not None else configuration["out_img_name_pat"]
+    try:
+        encoder = core.make_encoder(args.encoder or configuration["encoder"], args.image, format=format_name, preset=preset, resize=resize,
+                                    metadata_policy=metadata_policy)
+        result = search.find_value_for_size(encoder, args.max_size, allow_scaling=args.allow_scaling, scale_value=scale_value)
+        output_image = get_output_path(args.image, args.out, out_img_name_pat, encoder.format.extension)
+        os.makedirs(args.out, exist_ok=True)
+        utils.write_file(output_image, result.data)
+    except (encoders.EncodeError, OSError) as e: # missing or unreadable input, ffmpeg failing, output not writable
+        print(f"FAILED {args.image}: {str(e) or type(e).__name__}")
+        return 2
+
+    print(f"{'fits' if result.fits else 'DOES NOT FIT'}: compression value {result.compression_value}"
+          + (f" at scale {result.scale:.3f}" if result.scale != 1.0 else "")
+          + f", {utils.format_bytes(result.size)} (budget {utils.format_bytes(args.max_size)})")
+    print(f"{result.encodes} encodes in {result.seconds:.2f}s -> {output_image}")
+    if args.metrics:
+        print(metrics.compare(metrics.load(args.image), metrics.decode(result.data), resize_filter=resize.filter))
+    return 0 if result.fits else 1
+
+
+def watch_main(args, configuration):
+    directory = args.directory or configuration["load_folder"]
+    try:
+        format_name, preset, compression_value = output_settings(args, configuration)
+        resize = resize_settings(args, configuration)
+        dedup_dir, link_mode = dedup_settings(args, configuration)
+        metadata_policy = metadata_settings(args, configuration)
+    except ValueError as e:
+        print(e)
+        return 2
+    if not os.path.isdir(directory):
+        print(f"{directory} is not a folder")
+        return 2
+    if os.path.realpath(args.out) == os.path.realpath(directory):
+        # every output would be a new file in the watched folder and get compressed again
+        print(f"--out can't be the watched folder {directory}, choose another output folder")
+        return 2
+    lossless_jpeg = lossless_jpeg_setting(args, configuration)
+    out_img_name_pat = args.pattern if args.pattern is not None else configuration["out_img_name_pat"]
+    encoder = args.encoder or configuration["encoder"]
+    extension = encoders.get_format(format_name).extension
+    os.makedirs(args.out, exist_ok=True)
+
+    compress = lambda path: compress_file(path, get_output_path(path, args.out, out_img_name_pat, extension), compression_value, encoder,
+                                          format=format_name, preset=preset, resize=resize, dedup_dir=dedup_dir, link_mode=link_mode,
+                                          metadata_policy=metadata_policy, lossless_jpeg=lossless_jpeg)
+    work_queue = watcher.CompressQueue(compress, workers=args.workers, max_queued=args.queue, on_result=print_result)
+    index = watcher.FolderIndex(directory, IMAGE_EXTS)
+    folder_watcher = watcher.FolderWatcher(index, work_queue.put, poll_interval=args.poll or 1.0, use_inotify=args.poll is None)
+    if args.existing:
+        for path in sorted(os.path.join(directory, name) for name in os.listdir(directory) if index.matches(name)):
+            work_queue.put(path)
+    folder_watcher.start()
+    print(f"Watching {directory} ({folder_watcher.mode}), Ctrl+C to stop")
+    try:
+        while folder_watcher.is_alive():
+            folder_watcher.join(0.5)
+    except KeyboardInterrupt:
+        pass
+    folder_watcher.stop()
+    work_queue.close()
+    return 0
+
+
+def compare_formats(input_image, output_dir, values, preset=DEFAULT_CONFIG["preset"], with_metrics=False, workers=None, resize=None,
+                    metadata_policy=None):
+    """encode input_image into every format in values ({format name: compression value}) in parallel.
+    The image is decoded once and shared by the encode threads. Returns one dict per format, in the order of values"""
+    store = imagestore.ImageStore()
+    reference = metrics.Reference(store.get(input_image), resize_filter=resize.filter if resize else "lanczos") if with_metrics else None
+    in_bytes = os.path.getsize(input_image)
+
+    def encode(format_name):
+        encoder = encoders.get_encoder(encoders.PillowEncoder.name, input_image, store, format_name, preset, resize, metadata_policy)
+        encoder.image # decode (or take the shared pixels) and resize before timing
+        start = time.perf_counter()
+        data = encoder.encode(values[format_name])
+        elapsed = time.perf_counter() - start
+        output_image = get_output_path(input_image, output_dir, "*", encoder.format.extension)
+        utils.write_file(output_image, data)
+        result = {"format": format_name, "value": values[format_name], "output": output_image,
+                  "in_bytes": in_bytes, "out_bytes": len(data), "seconds": elapsed}
+        if reference is not None:
+            result["metrics"] = reference.compare(metrics.decode(data))
+        return result
+
+    os.makedirs(output_dir, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=workers or len(values)) as executor:
+        return list(executor.map(encode, values))
+
+
+def compare_main(args, configuration):
+    try:
+        values = {name: core.default_value(configuration, name) for name in (args.formats or list(encoders.FORMATS))}
+        for item in args.value or []:
+            name, _, value = item.partition("=")
+            values[name] = int(value)
+        for name, value in values.items():
+            encoders.get_format(name).check_value(value)
+        resize = resize_settings(args, configuration)
+        metadata_policy = metadata_settings(args, configuration)
+    except ValueError as e:
+        print(e)
+        return 2
+
+    results = compare_formats(args.image, args.out, values, args.preset or configuration["preset"], args.metrics, args.workers, resize,
+                              metadata_policy)
+    for result in sorted(results, key=lambda result: result["out_bytes"]):
+        percent = result["out_bytes"]/result["in_bytes"]*100
+        print(f"{result['format']:5} {result['value']:4}  {utils.format_bytes(result['out_bytes']):>10} ({percent:5.1f}%)  "
+              f"{result['seconds']*1000:7.0f}ms  {result['output']}" + (f"  {result['metrics']}" if "metrics" in result else ""))
+    return 0
+
+
+def dedup_main(args, configuration):
+    args.dedup = True
+    directory, link_mode = dedup_settings(args, configuration)
+    if not os.path.isdir(directory):
+        print("No dedup store at", directory)
+        return 1
+    store = dedup.open_store(directory, link_mode)
+    if args.action == "gc":
+        older_than = args.older_than*86400 if args.older_than is not None else None
+        max_bytes = int(args.max_mb*1048576) if args.max_mb is not None else None
+        removed = store.gc(older_than, max_bytes)
+        print(f"Removed {removed['entries']} entries, {removed['blobs']} blobs ({utils.format_bytes(removed['blob_bytes'])}), "
+              f"{removed['sources']} hashes of deleted sources")
+    stats = store.stats()
+    print(f"{directory}: {stats['entries']} entries, {stats['blobs']} blobs ({utils.format_bytes(stats['blob_bytes'])}), "
+          f"{stats['hits']} reuses, {stats['sources']} source hashes")
+    return 0
+
+
+def serve_main(args, configuration):
+    import service # only the serve command needs the http modules
+    service_config = configuration["service"]
+    option = lambda name: getattr(args, name) if getattr(args, name) is not None else service_config[name]
+    perf.configure_from_config(configuration)
+    service.serve(configuration, option("host"), option("port"), option("socket"), option("workers"), option("queue"),
+                  service_config["max_upload_mb"], args.verbose)
+    return 0
+
+
+def add_resize_arguments(parser):
+    parser.add_argument("--max-width", type=int, default=None, help="downscale to at most this many pixels wide (default: resize from config.json)")
+    parser.add_argument("--max-height", type=int, default=None, help="downscale to at most this many pixels high")
+    parser.add_argument("--scale", type=float, default=None, dest="percent", metavar="PERCENT", help="downscale to this percent of the size, e.g. 50")
+    parser.add_argument("--megapixels", type=float, default=None, help="downscale to at most this many million pixels")
+    parser.add_argument("--filter", choices=resizing.FILTERS, default=None, help="resampling filter for the downscale")
+
+
+def add_metadata_arguments(parser):
+    parser.add_argument("--exif", choices=metadata.POLICIES, default=None, help="keep or strip EXIF, XMP, IPTC and comments (default: metadata.exif from config.json)")
+    parser.add_argument("--icc", choices=metadata.POLICIES, default=None, help="keep or strip the ICC color profile (default: metadata.icc from config.json)")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m compressor", description="Headless image compression")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    batch = commands.add_parser("batch", help="compress every image in a directory or glob")
+    batch.add_argument("target", help="directory or glob pattern of images")
+    batch.add_argument("--q", type=int, metavar="VALUE", help="compression value, 1-31 (ffmpeg -q:v) for jpeg (default: default_compression_value from config.json)")
+    batch.add_argument("--workers", type=int, default=None, help="number of worker processes (default: cpu count)")
+    batch.add_argument("--out", default=os.path.join(PROGRAM_DIR, "output"), help="output directory")
+    batch.add_argument("--pattern", default=None, help="output image name pattern (default: out_img_name_pat from config.json)")
+    batch.add_argument("--encoder", choices=encoders.ENCODERS, default=None, help="encoder backend (default: encoder from config.json)")
+    batch.add_argument("--format", choices=encoders.FORMATS, default=None, help="output format (default: format from config.json)")
+    batch.add_argument("--preset", choices=encoders.PRESETS, default=None, help="encoder effort (default: preset from config.json)")
+    batch.add_argument("--metrics", action="store_true", help="also print PSNR, SSIM and worst area score of each output")
+    quality = batch.add_mutually_exclusive_group()
+    quality.add_argument("--min-ssim", type=float, default=None, help="per image, the smallest output with at least this SSIM (e.g. 0.98) instead of --q")
+    quality.add_argument("--min-psnr", type=float, default=None, help="per image, the smallest output with at least this PSNR in dB (e.g. 40) instead of --q")
+    add_resize_arguments(batch)
+    add_metadata_arguments(batch)
+    batch.add_argument("--lossless-jpeg", action=argparse.BooleanOptionalAction, default=None,
+                        help="rewrite JPEG sources written as JPEG without decoding them, --q doesn't apply to them (default: metadata.lossless_jpeg from config.json)")
+    batch.add_argument("--dedup", action=argparse.BooleanOptionalAction, default=None,
+                        help="reuse earlier outputs of identical sources from the dedup store (default: dedup.enabled from config.json)")
+    batch.set_defaults(func=batch_main)
+
+    target = commands.add_parser("target", help="find the best compression value that fits a size budget")
+    target.add_argument("image", help="image to compress")
+    target.add_argument("--max-size", required=True, type=search.parse_size, help="size budget, e.g. 200KB, 1.5MB or bytes")
+    target.add_argument("--allow-scaling", action="store_true", help="downscale the image if even the highest compression value is too big")
+    target.add_argument("--q", type=int, metavar="VALUE", help="compression value used when downscaling (default: default_compression_value from config.json)")
+    target.add_argument("--out", default=os.path.join(PROGRAM_DIR, "output"), help="output directory")
+    target.add_argument("--pattern", default=None, help="output image name pattern (default: out_img_name_pat from config.json)")
+    target.add_argument("--encoder", choices=encoders.ENCODERS, default=None, help="encoder backend (default: encoder from config.json)")
+    target.add_argument("--format", choices=encoders.FORMATS, default=None, help="output format (default: format from config.json)")
+    target.add_argument("--preset", choices=encoders.PRESETS, default=None, help="encoder effort (default: preset from config.json)")
+    target.add_argument("--metrics", action="store_true", help="also print PSNR, SSIM and worst area score of the output")
+    add_resize_arguments(target)
+    add_metadata_arguments(target)
+    target.set_defaults(func=target_main)
+
+    watch = commands.add_parser("watch", help="compress new images as they appear in a folder")
+    watch.add_argument("directory", nargs="?", default=None, help="folder to watch (default: load_folder from config.json)")
+    watch.add_argument("--q", type=int, metavar="VALUE", help="compression value, 1-31 (ffmpeg -q:v) for jpeg (default: default_compression_value from config.json)")
+    watch.add_argument("--workers", type=int, default=2, help="number of encode threads")
+    watch.add_argument("--queue", type=int, default=16, help="max images waiting to be compressed, the watcher waits when it's full")
+    watch.add_argument("--poll", type=float, default=None, help="poll every POLL seconds instead of using inotify")
+    watch.add_argument("--existing", action="store_true", help="also compress the images already in the folder")
+    watch.add_argument("--out", default=os.path.join(PROGRAM_DIR, "output"), help="output directory")
+    watch.add_argument("--pattern", default=None, help="output image name pattern (default: out_img_name_pat from config.json)")
+    watch.add_argument("--encoder", choices=encoders.ENCODERS, default=None, help="encoder backend (default: encoder from config.json)")
+    watch.add_argument("--format", choices=encoders.FORMATS, default=None, help="output format (default: format from config.json)")
+    watch.add_argument("--preset", choices=encoders.PRESETS, default=None, help="encoder effort (default: preset from config.json)")
+    add_resize_arguments(watch)
+    add_metadata_arguments(watch)
+    watch.add_argument("--lossless-jpeg", action=argparse.BooleanOptionalAction, default=None,
+                        help="rewrite JPEG sources written as JPEG without decoding them, --q doesn't apply to them (default: metadata.lossless_jpeg from config.json)")
+    watch.add_argument("--dedup", action=argparse.BooleanOptionalAction, default=None,
+                        help="reuse earlier outputs of identical sources from the dedup store (default: dedup.enabled from config.json)")
+    watch.set_defaults(func=watch_main)
+
+    compare = commands.add_parser("compare", help="encode one image into several formats in parallel and compare size and time")
+    compare.add_argument("image", help="image to compress")
+    compare.add_argument("--formats", type=lambda text: text.split(","), default=None, help="comma separated formats (default: all available)")
+    compare.add_argument("--value", action="append", metavar="FORMAT=VALUE", help="compression value for a format, e.g. webp=30 (default: each format's default)")
+    compare.add_argument("--preset", choices=encoders.PRESETS, default=None, help="encoder effort (default: preset from config.json)")
+    compare.add_argument("--metrics", action="store_true", help="also print PSNR, SSIM and worst area score of each output")
+    compare.add_argument("--workers", type=int, default=None, help="encode threads (default: one per format)")
+    compare.add_argument("--out", default=os.path.join(PROGRAM_DIR, "output"), help="output directory")
+    add_resize_arguments(compare)
+    add_metadata_arguments(compare)
+    compare.set_defaults(func=compare_main)
+
+    dedup_parser = commands.add_parser("dedup", help="show or compact the dedup store")
+    dedup_parser.add_argument("action", choices=("stats", "gc"), help="stats, or gc to remove old entries and unused outputs")
+    dedup_parser.add_argument("--older-than", type=float, default=None, metavar="DAYS", help="gc: remove entries not reused for DAYS days")
+    dedup_parser.add_argument("--max-mb", type=float, default=None, help="gc: remove the least recently used entries until the outputs fit in MAX_MB")
+    dedup_parser.set_defaults(func=dedup_main)
+
+    serve = commands.add_parser("serve", help="run the local compression service (HTTP or Unix socket)")
+    serve.add_argument("--host", default=None, help="address to listen on (default: service.host from config.json, 127.0.0.1)")
+    serve.add_argument("--port", type=int, default=None, help="port to listen on, 0 for any free port (default: service.port, 8765)")
+    serve.add_argument("--socket", default=None, help="listen on this Unix socket instead of host and port")
+    serve.add_argument("--workers", type=int, default=None, help="encode threads (default: service.workers)")
+    serve.add_argument("--queue", type=int, default=None, help="max images waiting for a worker, more get 429 (default: service.queue)")
+    serve.add_argument("--verbose", action="store_true", help="log every request")
+    serve.set_defaults(func=serve_main)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args, load_config())
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+"""Compression without Qt, shared by the window (main.py), the command line (compressor.py) and the service (service.py).
+
+    settings = core.Settings.from_config(configuration, format="webp", max_width=1920)
+    result = core.compress_bytes(data, settings)  # in memory, no files
+
+Settings are everything that decides the output besides the source: encoder, format, effort preset,
+compression value, the resize stage and the metadata policy. Sources are file paths or, for compress_bytes, encoded bytes.
+With lossless_jpeg, JPEG sources that are written as JPEG without resizing only get their metadata stripped and
+their Huffman tables optimized (encoders.LosslessJpegEncoder), the compression value doesn't apply to them.
+"""
+import time
+from io import BytesIO
+
+import encoders
+import metadata
+import perf
+import resizing
+
+
+def default_value(configuration, format_name):
+    """starting compression value for format_name: default_compression_value for the configured format, else the format's default"""
+    if format_name == configuration["format"]:
+        return configuration["default_compression_value"]
+    return encoders.get_format(format_name).default_value
+
+
+def resize_from_config(configuration, **limits):
+    """resizing.Resize from the "resize" section of config.json, with the limits (max_width, max_height, percent,
+    megapixels, filter) that aren't None replacing it. Raises ValueError for an unknown filter or a limit that isn't above 0"""
+    resize_config = dict(configuration["resize"])
+    resize_config.update((key, value) for key, value in limits.items() if value is not None)
+    return resizing.Resize.from_config({"resize": resize_config})
+
+
+class Settings:
+    """Validated output settings. Raises ValueError for unknown names or a value outside the format's range"""
+    def __init__(self, format="jpeg", preset="balanced", compression_value=None, resize=None, encoder="pillow",
+                 metadata_policy=None, lossless_jpeg=False):
+        if encoder not in encoders.ENCODERS:
+            raise ValueError(f"Unknown encoder {encoder!r}, choose from: {', '.join(encoders.ENCODERS)}")
+        if preset not in encoders.PRESETS:
+            raise ValueError(f"Unknown preset {preset!r}, choose from: {', '.join(encoders.PRESETS)}")
+        self.format = encoders.get_format(format)
+        self.preset = preset
+        self.compression_value = self.format.default_value if compression_value is None else int(compression_value)
+        self.format.check_value(self.compression_value)
+        self.resize = resize if resize is not None else resizing.Resize()
+        self.encoder = encoder
+        self.metadata_policy = metadata_policy if metadata_policy is not None else metadata.MetadataPolicy()
+        self.lossless_jpeg = lossless_jpeg
+
+    @classmethod
+    def from_config(cls, configuration, format=None, preset=None, compression_value=None, encoder=None,
+                    exif=None, icc=None, lossless_jpeg=None, **limits):
+        """settings from config.json, with the arguments that aren't None replacing it. limits are the resize limits"""
+        format = format or configuration["format"]
+        if compression_value is None:
+            compression_value = default_value(configuration, format)
+        if lossless_jpeg is None:
+            lossless_jpeg = configuration["metadata"]["lossless_jpeg"]
+        return cls(format, preset or configuration["preset"], compression_value, resize_from_config(configuration, **limits),
+                   encoder or configuration["encoder"], metadata.MetadataPolicy.from_config(configuration, exif, icc), lossless_jpeg)
+
+    def __repr__(self):
+        return (f"Settings(format={self.format.name!r}, preset={self.preset!r}, compression_value={self.compression_value}, "
+                f"resize={self.resize!r}, encoder={self.encoder!r}, metadata_policy={self.metadata_policy!r}, "
+                f"lossless_jpeg={self.lossless_jpeg})")
+
+
+def make_encoder(encoder_name, source, store=None, format="jpeg", preset="balanced", resize=None, metadata_policy=None,
+                 lossless_jpeg=False):
+    """encoder for source. The named encoder if it can write format and read source, else pillow
+    (ffmpeg only writes jpeg and only reads files). With lossless_jpeg, a JPEG source written as JPEG
+    without resizing gets the lossless path instead"""
+    if lossless_jpeg and format == "jpeg" and not resize and metadata.detect_format(source) == "jpeg":
+        return encoders.LosslessJpegEncoder(source, store, format, preset, resize, metadata_policy)
+    if format not in encoders.ENCODERS[encoder_name].formats or not isinstance(source, str):
+        encoder_name = encoders.PillowEncoder.name
+    return encoders.get_encoder(encoder_name, source, store, format, preset, resize, metadata_policy)
+
+
+def cache_key(cache, encoder, compression_value, scale=1.0):
+    return cache.source_key(encoder.input_image) + encoder.settings_key(compression_value, scale)
+
+
+def encode(encoder, compression_value, cache=None, cancelled=None, scale=1.0):
+    """encoded bytes, taken from cache (a cache.EncodeCache) if they're in it and put there if not.
+    Returns (data, cached)"""
+    data = None
+    if cache is not None:
+        key = cache_key(cache, encoder, compression_value, scale)
+        data = cache.get(key)
+        perf.count("cache.miss" if data is None else "cache.hit")
+    if data is not None:
+        return data, True
+    with perf.span("encode", encoder=encoder.name, value=compression_value):
+        data = encoder.encode(compression_value, cancelled, scale=scale)
+    if cache is not None:
+        cache.put(key, data)
+    return data, False
+
+
+def compress_bytes(data, settings, cancelled=None):
+    """compress an encoded image (bytes) in memory with settings. Returns a dict with the output and its timings"""
+    start = time.perf_counter()
+    encoder = make_encoder(settings.encoder, BytesIO(data), format=settings.format.name, preset=settings.preset, resize=settings.resize,
+                           metadata_policy=settings.metadata_policy, lossless_jpeg=settings.lossless_jpeg)
+    output, _ = encode(encoder, settings.compression_value, cancelled=cancelled)
+    return {
+        "data": output,
+        "mime_type": encoder.mime_type,
+        "extension": encoder.format.extension,
+        "compression_value": settings.compression_value,
+        "lossless": encoder.lossless,
+        "in_bytes": len(data),
+        "out_bytes": len(output),
+        "seconds": time.perf_counter() - start,
+    }
@@ -0,0 +1,194 @@
+"""Content-addressed store of compressed outputs, so identical sources aren't compressed again, across runs.
+
+    store = dedup.open_store(directory)
+    source = store.source_hash(path)                  # sha256 of the file, remembered per (path, size, mtime)
+    blob = store.lookup(source, settings)            # path of the earlier output, or None
+    blob = store.add(source, settings, data)         # store a new output
+    store.link(blob, output_path)                    # reflink, hardlink or copy it to output_path
+
+Outputs (blobs) are files named by the sha256 of their content in objects/, so two sources that compress to
+the same bytes share one blob. index.sqlite maps (source sha256, settings) to the blob and keeps the source
+hashes, it survives restarts. Blobs are read-only: a hardlinked output is the same file as its blob, so it
+is replaced (rename) rather than edited in place, the writers all go through utils.write_file which does that.
+gc() drops old entries and blobs nothing points to.
+"""
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+LINK_MODES = ("auto", "reflink", "hardlink", "copy")
+FICLONE = 0x40049409 # Linux ioctl that makes dst share src's blocks (btrfs, xfs)
+TMP_GRACE = 3600 # seconds gc leaves a temporary file alone, it may still be written by another process
+
+
+def reflink(source, destination):
+    import fcntl # Linux/macOS only, and only needed here
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+def copy(source, destination):
+    shutil.copyfile(source, destination)
+
+LINKERS = {"reflink": reflink, "hardlink": os.link, "copy": copy}
+# auto tries the cheapest safe way first: a reflink is copy on write, a hardlink shares the file
+LINK_ORDER = {"auto": ("reflink", "hardlink", "copy"), "reflink": ("reflink", "copy"), "hardlink": ("hardlink", "copy"), "copy": ("copy",)}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    source TEXT NOT NULL, settings TEXT NOT NULL, blob TEXT NOT NULL, size INTEGER NOT NULL,
+    created REAL NOT NULL, last_used REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (source, settings));
+CREATE INDEX IF NOT EXISTS entries_blob ON entries (blob);
+CREATE TABLE IF NOT EXISTS sources (
+    path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, sha256 TEXT NOT NULL);
+"""
+
+
+class DedupStore:
+    """The blobs and the index in directory. Safe to share between threads, and between processes through sqlite"""
+    def __init__(self, directory, link_mode="auto"):
+        if link_mode not in LINK_MODES:
+            raise ValueError(f"Unknown link mode {link_mode!r}, choose from: {', '.join(LINK_MODES)}")
+        self.directory = directory
+        self.link_mode = link_mode
+        self.objects_dir = os.path.join(directory, "objects")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        # batch workers in other processes write to the same index, wait for their writes instead of failing
+        self.db = sqlite3.connect(os.path.join(directory, "index.sqlite"), timeout=30, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def blob_path(self, name):
+        return os.path.join(self.objects_dir, name[:2], name)
+
+    def source_hash(self, path):
+        """sha256 of the file at path. Unchanged files (same size and mtime) aren't read again"""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime_ns, sha256 FROM sources WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[:2] == (stat.st_size, stat.st_mtime_ns):
+            return row[2]
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1048576), b""):
+                digest.update(chunk)
+        sha256 = digest.hexdigest()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)", (path, stat.st_size, stat.st_mtime_ns, sha256))
+        return sha256
+
+    def lookup(self, source, settings):
+        """path of the blob stored for (source hash, settings), None if there is none or it was deleted"""
+        with self.lock:
+            row = self.db.execute("SELECT blob FROM entries WHERE source = ? AND settings = ?", (source, settings)).fetchone()
+            if row is None: return None
+            path = self.blob_path(row[0])
+            if not os.path.exists(path):
+                self.db.execute("DELETE FROM entries WHERE source = ? AND settings = ?", (source, settings))
+                return None
+            self.db.execute("UPDATE entries SET last_used = ?, hits = hits + 1 WHERE source = ? AND settings = ?",
+                            (time.time(), source, settings))
+        return path
+
+    def add(self, source, settings, data):
+        """store data as the output for (source hash, settings). Returns the blob's path"""
+        name = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(name)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write to a temporary file first so a half written blob is never linked
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as file:
+                file.write(data)
+            os.chmod(tmp_path, 0o444)
+        else:
+            tmp_path = None
+        now = time.time()
+        # the blob shows up together with its entry, so gc never finds it unreferenced
+        with self.lock:
+            if tmp_path is not None: os.replace(tmp_path, path)
+            self.db.execute("INSERT OR REPLACE INTO entries (source, settings, blob, size, created, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                            (source, settings, name, len(data), now, now))
+        return path
+
+    def link(self, blob, output_path):
+        """put the blob at output_path, replacing what's there. Returns how: "reflink", "hardlink", "copy" or
+        "linked" if output_path already is the blob"""
+        if os.path.exists(output_path) and os.path.samefile(blob, output_path):
+            return "linked"
+        tmp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        for method in LINK_ORDER[self.link_mode]:
+            try:
+                LINKERS[method](blob, tmp_path)
+                break
+            except (OSError, ImportError) as e: # not supported by this filesystem or platform
+                error = e
+                if os.path.exists(tmp_path): os.remove(tmp_path)
+        else:
+            raise error # even the copy failed, that error says why
+        os.replace(tmp_path, output_path)
+        return method
+
+    def stats(self):
+        with self.lock:
+            entries, hits = self.db.execute("SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM entries").fetchone()
+            blobs, size = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM (SELECT blob, MAX(size) AS size FROM entries GROUP BY blob)").fetchone()
+            sources = self.db.execute("SELECT COUNT(*) FROM sources").fetchone()[0]
+        return {"entries": entries, "blobs": blobs, "blob_bytes": size, "hits": hits, "sources": sources}
+
+    def gc(self, older_than=None, max_bytes=None):
+        """compact the store: drop entries not used for older_than seconds, then the least recently used ones
+        until the blobs fit in max_bytes, then blobs no entry points to and source hashes of deleted files.
+        Outputs linked from removed blobs stay valid. Returns counts of what was removed"""
+        removed = {"entries": 0, "blobs": 0, "blob_bytes": 0, "sources": 0}
+        with self.lock:
+            if older_than is not None:
+                removed["entries"] += self.db.execute("DELETE FROM entries WHERE last_used < ?", (time.time() - older_than,)).rowcount
+            if max_bytes is not None:
+                total, kept = 0, set()
+                for source, settings, blob, size in self.db.execute(
+                        "SELECT source, settings, blob, size FROM entries ORDER BY last_used DESC").fetchall():
+                    if blob in kept: continue # shares a blob that stays anyway, costs nothing more
+                    total += size
+                    if total > max_bytes:
+                        removed["entries"] += self.db.execute("DELETE FROM entries WHERE source = ? AND settings = ?", (source, settings)).rowcount
+                    else:
+                        kept.add(blob)
+            used = {row[0] for row in self.db.execute("SELECT DISTINCT blob FROM entries")}
+            for path, in self.db.execute("SELECT path FROM sources").fetchall():
+                if not os.path.exists(path):
+                    removed["sources"] += self.db.execute("DELETE FROM sources WHERE path = ?", (path,)).rowcount
+        # blobs on disk that no entry points to, including leftovers of interrupted writes
+        for prefix in os.scandir(self.objects_dir):
+            if not prefix.is_dir(): continue
+            for entry in os.scandir(prefix.path):
+                if entry.name in used: continue
+                stat = entry.stat()
+                if entry.name.endswith(".tmp") and stat.st_mtime > time.time() - TMP_GRACE: continue # may still be written
+                with self.lock:
+                    # an add since the entries were read above may have pointed to it again
+                    if self.db.execute("SELECT 1 FROM entries WHERE blob = ? LIMIT 1", (entry.name,)).fetchone(): continue
+                    os.remove(entry.path)
+                removed["blobs"] += 1
+                removed["blob_bytes"] += stat.st_size
+        with self.lock:
+            self.db.execute("VACUUM")
+        return removed
+
+    def close(self):
+        self.db.close()
+
+
+_stores = {} # (directory, link mode) -> DedupStore, per process
+
+def open_store(directory, link_mode="auto"):
+    """the store for directory, opened once per process (batch workers each open their own)"""
+    key = (os.path.abspath(directory), link_mode)
+    if key not in _stores:
+        _stores[key] = DedupStore(directory, link_mode)
+    return _stores[key]
@@ -0,0 +1,326 @@
+"""Encoders turn a source image into compressed image bytes.
+
+Every output format (FORMATS) has its own compression value range, always from the best quality
+(min_value) to the smallest file (max_value), and effort presets that trade encode time for size.
+JPEG uses ffmpeg's -q:v scale, 1-31, so results stay comparable between the pillow and ffmpeg encoders.
+JPEG sources written as JPEG without resizing can skip the decode and encode entirely, see LosslessJpegEncoder.
+"""
+import shutil
+import subprocess
+import threading
+from io import BytesIO
+
+from PIL import Image, features
+
+import metadata
+import perf
+import resizing
+
+class EncodeError(Exception):
+    pass
+
+class EncodeCancelled(EncodeError):
+    """raised when the cancelled event is set while encoding"""
+    pass
+
+
+def qscale_to_quality(compression_value):
+    """map ffmpeg -q:v (1-31) to a libjpeg quality (1-100)
+
+    ffmpeg's mjpeg encoder scales the standard quantisation tables by about q/8,
+    libjpeg scales them by (200 - 2*quality)% above quality 50 and 5000/quality% below it.
+    Solving for the same scaling gives the mapping below (q=8 -> 50, q=31 -> 13).
+    """
+    q = min(max(int(compression_value), 1), 31)
+    if q <= 8:
+        return round(100 - 6.25*q)
+    return round(400/q)
+
+
+PRESETS = ("fast", "balanced", "small")
+
+class Format:
+    """An output format. save_options(value, preset) gives the Pillow save arguments for a compression value"""
+    def __init__(self, name, extension, mime_type, pil_format, min_value, max_value, default_value, alpha, options, presets):
+        self.name = name
+        self.extension = extension
+        self.mime_type = mime_type
+        self.pil_format = pil_format
+        self.min_value = min_value
+        self.max_value = max_value
+        self.default_value = default_value
+        self.alpha = alpha # keeps transparency
+        self.options = options # compression value -> dict of save arguments
+        self.presets = presets # preset name -> dict of save arguments
+
+    def save_options(self, compression_value, preset="balanced"):
+        value = min(max(int(compression_value), self.min_value), self.max_value)
+        return {**self.options(value), **self.presets[preset]}
+
+    def check_value(self, compression_value):
+        if not self.min_value <= compression_value <= self.max_value:
+            raise ValueError(f"Compression value for {self.name} must be {self.min_value}-{self.max_value}, not {compression_value}")
+
+
+def png_quantize(image, compression_value):
+    """PNG compression value 0 is lossless, 1-8 reduce the image to a palette of 256 down to 2 colors"""
+    if compression_value == 0: return image
+    # fast octree is the built in method that also handles alpha
+    method = Image.Quantize.LIBIMAGEQUANT if features.check_feature("libimagequant") else Image.Quantize.FASTOCTREE
+    return image.quantize(colors=256 >> (compression_value - 1), method=method)
+
+FORMATS = {
+    "jpeg": Format("jpeg", ".jpg", "image/jpeg", "JPEG", 1, 31, 7, False,
+                   # 4:2:0, same as ffmpeg's mjpeg default
+                   lambda value: {"quality": qscale_to_quality(value), "subsampling": "4:2:0"},
+                   {"fast": {"optimize": False}, "balanced": {"optimize": True}, "small": {"optimize": True, "progressive": True}}),
+    "webp": Format("webp", ".webp", "image/webp", "WEBP", 0, 100, 25, True,
+                   lambda value: {"quality": 100 - value},
+                   {"fast": {"method": 2}, "balanced": {"method": 4}, "small": {"method": 6}}),
+    "avif": Format("avif", ".avif", "image/avif", "AVIF", 0, 100, 40, True,
+                   lambda value: {"quality": 100 - value},
+                   {"fast": {"speed": 10}, "balanced": {"speed": 8}, "small": {"speed": 6}}),
+    "png": Format("png", ".png", "image/png", "PNG", 0, 8, 0, True,
+                  lambda value: {}, # see png_quantize
+                  {"fast": {"compress_level": 1}, "balanced": {"compress_level": 6}, "small": {"compress_level": 9, "optimize": True}}),
+}
+# Image.SAVE has the savers once the plugins are loaded, also those of plugins like pillow-avif-plugin.
+# features.check("avif") warns on Pillows that don't know the feature
+Image.init()
+if "AVIF" not in Image.SAVE:
+    del FORMATS["avif"]
+if "JXL" in Image.SAVE: # with a JPEG XL plugin such as pillow-jxl-plugin
+    FORMATS["jxl"] = Format("jxl", ".jxl", "image/jxl", "JXL", 0, 100, 25, True,
+                            lambda value: {"quality": 100 - value},
+                            {"fast": {"effort": 3}, "balanced": {"effort": 7}, "small": {"effort": 9}})
+
+def get_format(name):
+    if name not in FORMATS:
+        raise ValueError(f"Unknown format {name!r}, choose from: {', '.join(FORMATS)}")
+    return FORMATS[name]
+
+
+class Encoder:
+    """Base encoder. Subclasses implement encode()"""
+    name = ""
+    formats = () # names of the formats it can write
+    lossless = False # True if the output has exactly the source's pixels whatever the compression value
+
+    def __init__(self, input_image, store=None, format="jpeg", preset="balanced", resize=None, metadata_policy=None):
+        if format not in self.formats:
+            raise ValueError(f"The {self.name} encoder can't write {format}, only {', '.join(self.formats)}")
+        if preset not in PRESETS:
+            raise ValueError(f"Unknown preset {preset!r}, choose from: {', '.join(PRESETS)}")
+        self.input_image = input_image
+        self.store = store # shared imagestore.ImageStore, encoders that decode in process take the pixels from it
+        self.format = get_format(format)
+        self.preset = preset
+        self.resize = resize if resize is not None else resizing.Resize() # applied to the source before encoding
+        # what the output keeps of the source's EXIF and ICC profile
+        self.metadata_policy = metadata_policy if metadata_policy is not None else metadata.MetadataPolicy()
+
+    @property
+    def mime_type(self):
+        return self.format.mime_type
+
+    def encode(self, compression_value, cancelled=None, scale=1.0):
+        """returns the compressed image as bytes, after the resize stage and then downscaled by scale if it's below 1.
+        cancelled is an optional threading.Event, encoding stops with EncodeCancelled once it is set"""
+        raise NotImplementedError
+
+    def settings_key(self, compression_value, scale=1.0):
+        """everything besides the source that changes the output, used in cache keys"""
+        key = (self.name, self.format.name, self.preset, int(compression_value)) + self.resize.key() + self.metadata_policy.key()
+        if scale == 1.0:
+            return key
+        return key + (round(scale, 4),)
+
+    @staticmethod
+    def check_cancelled(cancelled):
+        if cancelled is not None and cancelled.is_set():
+            raise EncodeCancelled("encode cancelled")
+
+
+class FfmpegEncoder(Encoder):
+    """Spawns ffmpeg for every encode, output is piped back instead of written to disk. JPEG only, presets are ignored.
+    The source is turned upright by its EXIF orientation like with pillow, but ffmpeg writes no metadata,
+    the metadata policy is ignored"""
+    name = "ffmpeg"
+    formats = ("jpeg",)
+
+    def __init__(self, input_image, store=None, format="jpeg", preset="balanced", resize=None, metadata_policy=None):
+        super().__init__(input_image, store, format, preset, resize, metadata_policy)
+        # orientation and size are in the file header, read once here, nothing is decoded
+        try:
+            with Image.open(self.input_image) as img:
+                self.orientation = metadata.read(img)["orientation"]
+                self.size = metadata.oriented_size(img.size, self.orientation) # upright
+        except OSError: # not an image Pillow reads, ffmpeg may still read it or reports the error on encode
+            self.orientation = 1
+            self.size = None
+
+    def scale_filter(self, scale=1.0):
+        if self.resize:
+            if self.size is None:
+                raise EncodeError(f"Can't read the size of {self.input_image} to resize it")
+            width, height = self.resize.target_size(self.size)
+            size = f"{max(1, round(width*scale))}:{max(1, round(height*scale))}"
+            return [f'scale={size}:flags={resizing.FFMPEG_FLAGS[self.resize.filter]}']
+        return [f'scale=iw*{scale}:-2'] if scale != 1.0 else []
+
+    def video_filter(self, scale=1.0):
+        """-vf arguments that turn the source upright, then resize it"""
+        filters = ([metadata.FFMPEG_TRANSPOSES[self.orientation]] if self.orientation in metadata.FFMPEG_TRANSPOSES else []) + self.scale_filter(scale)
+        return ['-vf', ",".join(filters)] if filters else []
+
+    def command(self, compression_value, scale=1.0):
+        return [
+            'ffmpeg',
+            '-noautorotate', # the orientation is applied by video_filter, newer ffmpegs would turn it a second time
+            '-i', self.input_image,
+            *self.video_filter(scale),
+            '-q:v', str(compression_value),
+            '-f', 'image2pipe', '-c:v', 'mjpeg',
+            '-loglevel', 'quiet', # to disable the output
+            '-' # write to stdout
+        ]
+
+    def encode(self, compression_value, cancelled=None, scale=1.0):
+        self.check_cancelled(cancelled)
+        try:
+            with perf.span("ffmpeg.spawn"):
+                process = subprocess.Popen(self.command(compression_value, scale), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e: # ffmpeg not installed
+            raise EncodeError(str(e))
+        # wait in small steps so a cancelled encode kills ffmpeg right away
+        while True:
+            try:
+                stdout, stderr = process.communicate(timeout=0.05)
+                break
+            except subprocess.TimeoutExpired:
+                if cancelled is not None and cancelled.is_set():
+                    process.kill()
+                    process.communicate()
+                    raise EncodeCancelled("encode cancelled")
+        if process.returncode != 0 or not stdout:
+            raise EncodeError(stderr.decode(errors="replace").strip() or f"ffmpeg exited with code {process.returncode}")
+        return stdout
+
+
+class PillowEncoder(Encoder):
+    """Decodes the source once and keeps it in memory, every encode goes straight to a bytes buffer"""
+    name = "pillow"
+    formats = tuple(FORMATS)
+
+    def __init__(self, input_image, store=None, format="jpeg", preset="balanced", resize=None, metadata_policy=None):
+        super().__init__(input_image, store, format, preset, resize, metadata_policy)
+        self._image = None
+        self._metadata = None # metadata.read() of the source
+        self._lock = threading.Lock()
+
+    @property
+    def image(self):
+        """decoded, upright and resized source, RGB or RGBA if it has transparency and the format keeps it.
+        Decoded on first use so it can happen on a worker thread"""
+        with self._lock:
+            if self._image is None:
+                with perf.span("decode", encoder=self.name):
+                    if self.store is not None:
+                        # the store already turned the pixels upright, only the header is read for the metadata
+                        with Image.open(self.input_image) as img:
+                            self._metadata = metadata.read(img)
+                        # a view of the shared decoded pixels, only copied if it's resized or alpha has to be dropped
+                        image = self.resize.apply(self.store.get(self.input_image).pil_image())
+                        self._image = image if image.mode == "RGB" or self.format.alpha else image.convert("RGB")
+                    else:
+                        with Image.open(self.input_image) as img:
+                            self._metadata = metadata.read(img)
+                            orientation = self._metadata["orientation"]
+                            has_alpha = img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+                            target_size = self.resize.target_size(metadata.oriented_size(img.size, orientation))
+                            # jpeg sources are decoded at 1/2, 1/4 or 1/8 size right away, as long as that stays
+                            # REDUCING_GAP times above the target (like Image.thumbnail does)
+                            if target_size != metadata.oriented_size(img.size, orientation):
+                                draft_size = metadata.oriented_size(target_size, orientation)
+                                img.draft("RGB", tuple(round(side*resizing.REDUCING_GAP) for side in draft_size))
+                            # ffmpeg drops alpha for jpeg too
+                            image = img.convert("RGBA" if has_alpha and self.format.alpha else "RGB")
+                            self._image = self.resize.apply(metadata.apply_orientation(image, orientation), target_size)
+                            # only the metadata policy decides what's written, the JPEG and PNG savers would
+                            # otherwise carry the source's comment and ICC profile over from info
+                            self._image.info = {}
+            return self._image
+
+    def encode(self, compression_value, cancelled=None, scale=1.0):
+        self.check_cancelled(cancelled)
+        source = image = self.image
+        if scale != 1.0:
+            size = (max(1, round(image.width*scale)), max(1, round(image.height*scale)))
+            image = image.resize(size, Image.LANCZOS, reducing_gap=2.0)
+        if self.format.name == "png":
+            image = png_quantize(image, compression_value)
+        if image is source:
+            # Image.save keeps its options on the Image object, so encodes running on other
+            # threads need their own Image. A copy is cheap next to the encode itself
+            image = image.copy()
+        self.check_cancelled(cancelled)
+        output = BytesIO()
+        image.save(output, self.format.pil_format, **self.format.save_options(compression_value, self.preset),
+                   **self.metadata_policy.save_options(self._metadata))
+        return output.getvalue()
+
+
+JPEGTRAN = shutil.which("jpegtran")
+
+class LosslessJpegEncoder(Encoder):
+    """Rewrites a JPEG source without decoding it: the compressed image data stays exactly as it is and
+    only the metadata the policy strips is dropped. With jpegtran installed the Huffman tables are optimized
+    too, and the "small" preset makes it progressive. The compression value is ignored.
+    Only for JPEG sources written as JPEG without resizing, see core.make_encoder"""
+    name = "lossless"
+    formats = ("jpeg",)
+    lossless = True
+
+    def settings_key(self, compression_value, scale=1.0):
+        # the compression value changes nothing, one entry for all of them
+        return (self.name, self.format.name, self.preset, bool(JPEGTRAN)) + self.metadata_policy.key()
+
+    def command(self):
+        # keep all metadata here, the policy is applied afterwards so it works the same without jpegtran
+        return [JPEGTRAN, "-copy", "all", "-optimize", *(["-progressive"] if self.preset == "small" else [])]
+
+    def encode(self, compression_value, cancelled=None, scale=1.0):
+        self.check_cancelled(cancelled)
+        if scale != 1.0:
+            raise EncodeError("The lossless JPEG path can't downscale")
+        if isinstance(self.input_image, str):
+            with open(self.input_image, "rb") as file:
+                data = file.read()
+        else:
+            data = self.input_image.read()
+            self.input_image.seek(0)
+        if JPEGTRAN:
+            with perf.span("jpegtran"):
+                process = subprocess.run(self.command(), input=data, capture_output=True)
+            if process.returncode != 0 or not process.stdout:
+                raise EncodeError(process.stderr.decode(errors="replace").strip() or f"jpegtran exited with code {process.returncode}")
+            data = process.stdout
+        self.check_cancelled(cancelled)
+        try:
+            return metadata.filter_jpeg(data, self.metadata_policy)
+        except ValueError as e: # corrupt file
+            raise EncodeError(str(e))
+
+
+ENCODERS = {
+    PillowEncoder.name: PillowEncoder,
+    FfmpegEncoder.name: FfmpegEncoder,
+}
+
+def get_encoder(name, input_image, store=None, format="jpeg", preset="balanced", resize=None, metadata_policy=None):
+    """create the encoder called name for input_image, writing format with the effort preset.
+    store is an optional imagestore.ImageStore to decode through, resize an optional resizing.Resize,
+    metadata_policy an optional metadata.MetadataPolicy"""
+    if name not in ENCODERS:
+        raise ValueError(f"Unknown encoder {name!r}, choose from: {', '.join(ENCODERS)}")
+    return ENCODERS[name](input_image, store, format, preset, resize, metadata_policy)
@@ -0,0 +1,122 @@
+"""Decode each source image once and share the pixels.
+
+The preview, the encoders and the clipboard all get views of the same decoded buffer
+instead of decoding the file again. Images whose raw size is above mmap_threshold are
+decoded into a memory-mapped temporary file, so the OS can page them out instead of
+them counting fully against RSS.
+"""
+import mmap
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+import metadata
+
+class DecodedImage:
+    """Raw decoded pixels (mode "RGB" or "RGBA", rows top to bottom, no padding, turned upright by the EXIF
+    orientation) in memory or in an mmap"""
+    def __init__(self, path, mode, size, buffer, mapped_file=None):
+        self.path = path
+        self.mode = mode
+        self.size = size # (width, height)
+        self.buffer = buffer # bytearray or mmap
+        self.mapped_file = mapped_file # keeps the mmap's backing file open
+
+    @property
+    def bytes_per_line(self):
+        return self.size[0]*len(self.mode)
+
+    @property
+    def nbytes(self):
+        return self.bytes_per_line*self.size[1]
+
+    @property
+    def is_mapped(self):
+        return self.mapped_file is not None
+
+    def pil_image(self):
+        """PIL Image over the shared buffer, nothing is copied"""
+        return Image.frombuffer(self.mode, self.size, self.buffer, "raw", self.mode, 0, 1)
+
+
+class ImageStore:
+    """Decoded images by path, the max_images most recently used are kept"""
+    def __init__(self, mmap_threshold=256*1048576, directory=None, max_images=2):
+        self.mmap_threshold = mmap_threshold
+        self.directory = directory # for the mmap files, None for the system temp dir
+        self.max_images = max_images
+        self.images = OrderedDict() # (path, size, mtime_ns) -> DecodedImage
+        self.lock = threading.Lock()
+        self.decode_locks = {} # one decode at a time per file
+
+    @classmethod
+    def from_config(cls, configuration):
+        decode_config = configuration["decode"]
+        return cls(mmap_threshold=int(decode_config["mmap_threshold_mb"]*1048576), directory=decode_config["dir"])
+
+    @staticmethod
+    def _key(path):
+        stat = os.stat(path)
+        return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+    def get(self, path):
+        """DecodedImage for path, decoded on the first call"""
+        key = self._key(path)
+        with self.lock:
+            decode_lock = self.decode_locks.setdefault(key, threading.Lock())
+        with decode_lock:
+            with self.lock:
+                if key in self.images:
+                    self.images.move_to_end(key)
+                    return self.images[key]
+            decoded = self.decode(path)
+            with self.lock:
+                self.images[key] = decoded
+                self.decode_locks.pop(key, None)
+                while len(self.images) > self.max_images:
+                    # the buffer is freed (or unmapped) once no view uses it anymore
+                    self.images.popitem(last=False)
+            return decoded
+
+    def decode(self, path):
+        with Image.open(path) as img:
+            has_alpha = img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+            mode = "RGBA" if has_alpha else "RGB"
+            orientation = metadata.read(img)["orientation"]
+            width, height = metadata.oriented_size(img.size, orientation)
+            nbytes = width*height*len(mode)
+            mapped_file = None
+            if nbytes <= self.mmap_threshold:
+                buffer = bytearray(nbytes)
+            else:
+                mapped_file = tempfile.TemporaryFile(dir=self.directory)
+                mapped_file.truncate(nbytes)
+                buffer = mmap.mmap(mapped_file.fileno(), nbytes)
+
+            # Pillow decodes the whole file at once, so the decoded image and the buffer are both in memory
+            # until the copy is done. It is copied (and turned upright) in bands of rows, so convert(),
+            # transpose() and tobytes() only ever make copies of one band, not of the whole image
+            img.load()
+            row_bytes = width*len(mode)
+            band_rows = max(1, (16*1048576)//row_bytes)
+            for top in range(0, height, band_rows):
+                bottom = min(height, top + band_rows)
+                band = img.crop(source_box(img.size, orientation, top, bottom))
+                band = metadata.apply_orientation(band, orientation)
+                buffer[top*row_bytes:bottom*row_bytes] = band.convert(mode).tobytes()
+            return DecodedImage(path, mode, (width, height), buffer, mapped_file)
+
+
+def source_box(size, orientation, top, bottom):
+    """box of an image of size that becomes the rows top..bottom once apply_orientation turned it upright"""
+    width, height = size
+    if orientation in (3, 4): # upside down, rows come from the other end
+        return (0, height - bottom, width, height - top)
+    if orientation in (5, 6): # sideways, rows come from columns
+        return (top, 0, bottom, height)
+    if orientation in (7, 8):
+        return (width - bottom, 0, width - top, height)
+    return (0, top, width, bottom)
@@ -2,41 +2,90 @@ from PySide6.QtWidgets import (
     QApplication, QMainWindow, QWidget,
     QHBoxLayout, QVBoxLayout,
     QPushButton, QLabel, QSlider, QSpinBox, QScrollArea,
-    QStatusBar,
+    QStatusBar, QProgressBar,
     QSpacerItem, QSizePolicy,
     QFileDialog,
     QStyle
 )
-from PySide6.QtGui import QPixmap, QFont, QPalette, QDrag, QIcon
-from PySide6.QtCore import Qt, QMimeData, QPoint, QUrl
+from PySide6.QtGui import QPixmap, QImage, QFont, QPalette, QDrag, QIcon
+from PySide6.QtCore import Qt, QByteArray, QMimeData, QPoint, QUrl, QThread, QThreadPool, QTimer
 
-import subprocess, os, sys, shutil, json
+import subprocess, os, sys, shutil, json, time
 import glob
 
-import utils, widgets
-
-app = QApplication(sys.argv)
+import utils, widgets, compressor, core, encoders, workers, cache, search, tiles, imagestore, watcher, perf, metrics, resizing, metadata, session
 
 class Widget(QMainWindow):
-    def __init__(self):
+    def __init__(self, program_dir=None):
         super().__init__()
-        self.program_dir = os.path.dirname(sys.argv[0])
+        # config.json, output/ and icons/ are looked up here
+        self.program_dir = program_dir if program_dir is not None else os.path.dirname(sys.argv[0])
 
-        config_file_path = os.path.join(self.program_dir, "config.json")
-        with open(config_file_path, "r") as file:
-            configuration = json.load(file)
+        configuration = compressor.load_config(self.program_dir)
 
         self.default_cmprs_val = configuration["default_compression_value"]
         self.out_img_name_pat = configuration["out_img_name_pat"] # output image name pattern
         load_folder = configuration["load_folder"]
+        self.encoder_name = configuration["encoder"]
+        self.format_name = configuration["format"]
+        self.preset = configuration["preset"]
+        self.output_resize = resizing.Resize.from_config(configuration) # applied to the source before encoding
+        self.metadata_policy = metadata.MetadataPolicy.from_config(configuration) # what outputs keep of EXIF and ICC
+        self.configuration = configuration
+        self.pyramid_mb = configuration["pyramid_mb"]
+        # every image is decoded once here and shared by the preview and the encoder
+        self.image_store = imagestore.ImageStore.from_config(configuration)
+        self.cache = cache.EncodeCache.from_config(configuration, self.program_dir, preview_sizeof=lambda image: image.sizeInBytes())
+        perf.configure_from_config(configuration)
+        self.perf_overlay = False
+        self.perf_enabled = configuration["perf"]["enabled"] # timings on without the overlay
         
         self.scale_factor = 1.0
         self.scale_factor_min = 0.05
         self.scale_factor_max = 20
         
         self.input_img_path = ""
-        self.real_pixmap = None
-        self.cmprsd_pixmap = None  # compressed image pix map
+        self.input_img_size = 0
+        self.encoder = None # keeps the decoded source image, see encoders.py
+        self.real_decoded = None # imagestore.DecodedImage, real_image is a view of it
+        self.real_image = None # QImage
+        self.cmprsd_image = None  # compressed image, QImage
+        self.cmprsd_bytes = b""  # compressed image bytes
+        self.cmprsd_mime_type = "" # of cmprsd_bytes, the format can change before the next encode is shown
+        
+        # encoding runs on its own pool, one encode at a time. Only the latest job's result is shown
+        self.encode_pool = QThreadPool()
+        self.encode_pool.setMaxThreadCount(1)
+        self.encode_job_id = 0
+        self.encode_worker = None
+        self.encode_started = 0.0 # perf_counter() when the latest encode was asked for
+        self.encode_value = None # compression value of the latest encode
+        self.metrics_worker = None
+        # coalesce fast slider moves into one encode
+        self.encode_timer = QTimer()
+        self.encode_timer.setSingleShot(True)
+        self.encode_timer.setInterval(40)
+        self.encode_timer.timeout.connect(self.start_encode)
+        
+        # speculative encoding of neighbouring values, low priority and limited to prefetch threads
+        self.prefetch_enabled = configuration["prefetch"]["enabled"]
+        self.prefetch_radius = configuration["prefetch"]["radius"]
+        self.prefetch_pool = QThreadPool()
+        self.prefetch_pool.setMaxThreadCount(max(1, configuration["prefetch"]["threads"]))
+        self.prefetch_workers = []
+        self.search_worker = None
+        
+        # the images open at once, see session.py. Export All and the thumbnails share one bounded pool,
+        # thumbnails are queued first so the strip fills in while an export runs
+        self.session = session.Session()
+        self.session_pool = QThreadPool()
+        self.session_pool.setMaxThreadCount(configuration["session"]["workers"] or max(1, (os.cpu_count() or 2) - 1))
+        self.thumbnail_size = configuration["session"]["thumbnail_size"]
+        self.export_job_id = 0
+        self.export_workers = [] # of the running Export All, empty when none runs
+        self.export_done_count = 0 # exports of the running Export All that finished or failed
+        self.thumbnail_workers = {} # path -> Worker making its thumbnail
+        self.diff_tile_workers = {} # tile key -> Worker computing the difference heatmap tile
         
         # output images names and paths 
         self.output_img_dir = os.path.join(self.program_dir, "output")
@@ -45,6 +94,12 @@ class Widget(QMainWindow):
             os.makedirs(self.output_img_dir)
         
         self.load_folder = load_folder
+        # index of the load_folder pngs, kept up to date in the background so Load doesn't rescan the folder
+        self.load_folder_index = watcher.FolderIndex(self.load_folder, (".png",))
+        self.load_folder_watcher = None
+        if os.path.isdir(self.load_folder):
+            self.load_folder_watcher = watcher.FolderWatcher(self.load_folder_index)
+            self.load_folder_watcher.start()
         
         self.setWindowTitle("Image Compressor")
         self.setWindowIcon(QIcon(os.path.join(self.program_dir, "icons/minimize.png")))
@@ -53,6 +108,21 @@ class Widget(QMainWindow):
         self.init_menubar()
         
         self.setStatusBar(QStatusBar())
+        # memory used by the zoom levels of both images
+        self.pyramid_status_label = QLabel()
+        self.statusBar().addPermanentWidget(self.pyramid_status_label)
+        # latest timings of the hot paths, refreshed while the overlay is on
+        self.perf_label = QLabel()
+        self.statusBar().addPermanentWidget(self.perf_label)
+        self.perf_timer = QTimer()
+        self.perf_timer.setInterval(500)
+        self.perf_timer.timeout.connect(self.update_perf_overlay)
+        self.set_perf_overlay(configuration["perf"]["overlay"])
+        # progress of Export All
+        self.export_progress = QProgressBar()
+        self.export_progress.setMaximumWidth(200)
+        self.export_progress.hide()
+        self.statusBar().addPermanentWidget(self.export_progress)
         
         self.init_central_widget()
     
@@ -66,6 +136,10 @@ class Widget(QMainWindow):
         save_action = self.file_menu.addAction("Save")
         save_action.setShortcut("Ctrl+S")
         save_action.triggered.connect(self.save_file_with_file_dialog)
+        export_all_action = self.file_menu.addAction("Export All")
+        export_all_action.setShortcut("Ctrl+E")
+        export_all_action.setStatusTip("Compress every open image with its own compression value into the output folder")
+        export_all_action.triggered.connect(self.export_all)
         
         self.view_menu = self.menu_bar.addMenu("View")
         zoom_in_action = self.view_menu.addAction("Zoom In")
@@ -74,21 +148,59 @@ class Widget(QMainWindow):
         zoom_out_action = self.view_menu.addAction("Zoom Out")
         zoom_out_action.setShortcut("Ctrl+-")
         zoom_out_action.triggered.connect(self.zoom_out)
+        prefetch_action = self.view_menu.addAction("Pre-encode Nearby Values")
+        prefetch_action.setCheckable(True)
+        prefetch_action.setChecked(self.prefetch_enabled)
+        prefetch_action.setStatusTip("Encode neighbouring compression values in the background")
+        prefetch_action.toggled.connect(self.set_prefetch_enabled)
+        cache_stats_action = self.view_menu.addAction("Cache Stats")
+        cache_stats_action.triggered.connect(lambda: self.statusBar().showMessage(self.cache.stats_str()))
+        diff_action = self.view_menu.addAction("Show Differences")
+        diff_action.setShortcut("Ctrl+D")
+        diff_action.setCheckable(True)
+        diff_action.setStatusTip("Show a heatmap of the compression error instead of the compressed image")
+        diff_action.toggled.connect(self.set_diff_mode)
+        perf_action = self.view_menu.addAction("Performance Overlay")
+        perf_action.setCheckable(True)
+        perf_action.setChecked(self.perf_overlay)
+        perf_action.setStatusTip("Show encode, decode and paint timings in the status bar")
+        perf_action.toggled.connect(self.set_perf_overlay)
     
     def init_central_widget(self):
         self.central_widget = QWidget()
         
         # Compression layout - the top layout - has input fields for compression
-        self.cmprs_panel = widgets.CompressionPanel(default_cmprs_val=self.default_cmprs_val)
-        self.cmprs_panel.set_on_value_change(self.compress_image)
+        output_format = encoders.get_format(self.format_name)
+        self.cmprs_panel = widgets.CompressionPanel(
+            self.default_cmprs_val, output_format.min_value, output_format.max_value,
+            tuple(encoders.FORMATS), encoders.PRESETS, self.format_name, self.preset)
+        self.cmprs_panel.set_on_value_change(self.encode_timer.start)
+        self.cmprs_panel.set_on_format_change(self.set_format)
+        # resize panel - downscales the source before encoding
+        self.resize_panel = widgets.ResizePanel(self.output_resize)
+        self.resize_panel.set_on_change(self.set_resize)
+        # target size panel - finds the compression value for a size budget
+        self.target_panel = widgets.TargetSizePanel()
+        self.target_panel.set_on_fit(self.fit_target_size)
+        # quality target panel - finds the compression value for a quality threshold
+        self.quality_panel = widgets.QualityTargetPanel()
+        self.quality_panel.set_on_fit(self.fit_target_quality)
+        # thumbnails of the open images, shown once there is more than one
+        self.session_model = widgets.SessionModel(self.session)
+        self.session_model.set_on_thumbnail_needed(self.make_thumbnail)
+        self.thumbnail_strip = widgets.ThumbnailStrip(self.session_model, self.thumbnail_size)
+        self.thumbnail_strip.set_on_select(self.open_image)
+        self.thumbnail_strip.hide()
         
         # Actual image - this layout has the real image and it's size
         real_image_layout = QVBoxLayout()
-        self.real_image_label = QLabel()
-        self.real_image_label.setBackgroundRole(QPalette.Base)
+        # both image views draw through the same tile grid, so tiles line up between them
+        self.tile_grid = tiles.TileGrid()
+        self.real_image_view = widgets.ImageView(self.tile_grid, pyramid_mb=self.pyramid_mb)
+        self.real_image_view.setBackgroundRole(QPalette.Base)
         # real image scroll area
         self.real_img_scroll_area = widgets.customScrollArea()
-        self.real_img_scroll_area.setWidget(self.real_image_label)
+        self.real_img_scroll_area.setWidget(self.real_image_view)
         self.real_img_scroll_area.setWidgetResizable(True)
         real_image_layout.addWidget(self.real_img_scroll_area)
         # real image size label
@@ -98,17 +210,24 @@ class Widget(QMainWindow):
         
         # Compressed image - this layout has the compressed image and it's size
         cmprsd_image_layout = QVBoxLayout()
-        self.cmprsd_image_label = QLabel()
-        self.cmprsd_image_label.setBackgroundRole(QPalette.Base)
+        self.cmprsd_image_view = widgets.ImageView(self.tile_grid, pyramid_mb=self.pyramid_mb)
+        self.cmprsd_image_view.set_on_diff_tile_needed(self.make_diff_tile)
+        self.cmprsd_image_view.setBackgroundRole(QPalette.Base)
         # compressed image scroll area
         self.cmprsd_img_scroll_area = widgets.customScrollArea()
-        self.cmprsd_img_scroll_area.setWidget(self.cmprsd_image_label)
+        self.cmprsd_img_scroll_area.setWidget(self.cmprsd_image_view)
         self.cmprsd_img_scroll_area.setWidgetResizable(True)
         cmprsd_image_layout.addWidget(self.cmprsd_img_scroll_area)
         # compressed image size label
         self.cmprsd_img_size_label = QLabel("Size: ")
         self.cmprsd_img_size_label.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Fixed)
-        cmprsd_image_layout.addWidget(self.cmprsd_img_size_label)
+        # PSNR/SSIM of the compressed image, computed in the background after each encode
+        self.metrics_label = QLabel()
+        self.metrics_label.setAlignment(Qt.AlignRight | Qt.AlignVCenter)
+        cmprsd_label_layout = QHBoxLayout()
+        cmprsd_label_layout.addWidget(self.cmprsd_img_size_label)
+        cmprsd_label_layout.addWidget(self.metrics_label)
+        cmprsd_image_layout.addLayout(cmprsd_label_layout)
         
         # Setting zoom functions for scroll Areas
         self.real_img_scroll_area.set_zoom_funcs(self.zoom_in, self.zoom_out)
@@ -128,12 +247,6 @@ class Widget(QMainWindow):
         images_layout.addLayout(cmprsd_image_layout)
         images_layout.setSpacing(20)
         
-        # Set styles and alignments for both (real and comp) images
-        # self.real_image_label.setStyleSheet("QLabel {background-color: grey; border-radius: 0px}")
-        self.real_image_label.setAlignment(Qt.AlignCenter)
-        # self.cmprsd_image_label.setStyleSheet("QLabel {background-color: grey; border-radius: 0px}")
-        self.cmprsd_image_label.setAlignment(Qt.AlignCenter)
-        
         # set fonts sizes for size labes
         font16 = QFont()
         font16.setPointSize(16)
@@ -145,7 +258,11 @@ class Widget(QMainWindow):
 
         main_layout = QVBoxLayout()
         main_layout.addWidget(self.cmprs_panel)
+        main_layout.addWidget(self.resize_panel)
+        main_layout.addWidget(self.target_panel)
+        main_layout.addWidget(self.quality_panel)
         main_layout.addLayout(images_layout)
+        main_layout.addWidget(self.thumbnail_strip)
         main_layout.addLayout(down_sub_layout)
         
         self.central_widget.setLayout(main_layout)
@@ -161,7 +278,7 @@ class Widget(QMainWindow):
         load_button.clicked.connect(self.load_btn_clicked)
         layout.addWidget(load_button)
         copy_btn = QPushButton("Copy")
-        copy_btn.clicked.connect(lambda: utils.copy_image_to_clipboard(self.output_img_path))
+        copy_btn.clicked.connect(self.copy_btn_clicked)
         copy_btn.setStatusTip("Copy image to clipboard")
         layout.addWidget(copy_btn)
         # temp_btn = QPushButton("Temp")
@@ -175,50 +292,145 @@ class Widget(QMainWindow):
         drag_btn.mousePressEvent = self.drag_btn_clicked
         layout.addWidget(drag_btn)
         drag_btn.setStyleSheet("""QPushButton { background-color: green;}""")
+        apply_all_btn = QPushButton("Apply to All")
+        apply_all_btn.setStatusTip("Use the current compression value for every open image")
+        apply_all_btn.clicked.connect(self.apply_to_all)
+        layout.addWidget(apply_all_btn)
+        self.export_all_btn = QPushButton("Export All")
+        self.export_all_btn.setStatusTip("Compress every open image with its own compression value into the output folder")
+        self.export_all_btn.clicked.connect(self.export_all)
+        layout.addWidget(self.export_all_btn)
 
         return layout
 
     def load_btn_clicked(self):
         """opens latest image from load_folder"""
-        latest_image = utils.get_latest_image_from_dir(self.load_folder)
+        latest_image = self.load_folder_index.latest()
+        if latest_image is None: # index not ready yet
+            latest_image = utils.get_latest_image_from_dir(self.load_folder)
+        if latest_image is None: return
         self.open_image(latest_image)
     
     def open_image_with_file_dialog(self):
         file_dialog = QFileDialog()
         
-        # Open the file dialog and get the selected file path
-        file_path, _ = file_dialog.getOpenFileName(
+        # Open the file dialog and get the selected file paths, several files are opened together as a session
+        file_paths, _ = file_dialog.getOpenFileNames(
             None,            # Parent widget (None means no parent)
-            "Open File",     # Dialog title
+            "Open Files",    # Dialog title
             "",              # Default directory (empty means current directory)
             "Image Files (*.png *.jpg *.jpeg)"  # File filter
         )
         
-        if file_path: 
-            self.open_image(input_file=file_path)
+        if file_paths: 
+            self.add_images(file_paths)
+            self.open_image(input_file=file_paths[0])
         else: print("Open operation cancelled.")    
     
+    def add_images(self, paths):
+        """add paths to the session, their thumbnails are made once they're scrolled into view"""
+        added = self.session.add(paths)
+        if added:
+            self.session_model.images_added(len(added))
+        self.thumbnail_strip.setVisible(len(self.session) > 1)
+    
+    def make_thumbnail(self, path):
+        worker = workers.Worker(0, workers.thumbnail_job(path, self.thumbnail_size), thread_priority=QThread.LowPriority)
+        worker.signals.finished.connect(lambda job_id, image: self.thumbnail_finished(path, image))
+        worker.signals.failed.connect(lambda job_id, error: self.thumbnail_finished(path, None, error))
+        # kept until it's done, the signals go away with the worker
+        self.thumbnail_workers[path] = worker
+        # ahead of queued exports
+        self.session_pool.start(worker, 1)
+    
+    def thumbnail_finished(self, path, image, error=""):
+        self.thumbnail_workers.pop(path, None)
+        if image is not None: self.session_model.set_thumbnail(path, image)
+        else: print("Thumbnail failed: ", path, error)
+    
     def open_image(self, input_file):
+        with perf.span("open", path=input_file):
+            self._open_image(input_file)
+    
+    def _open_image(self, input_file):
+        # decode first, a file that can't be opened leaves the current image (and the session) as they are
+        try:
+            with perf.span("open.decode"):
+                decoded = self.image_store.get(input_file)
+            if not decoded.size[0] or not decoded.size[1]:
+                raise ValueError("the image is empty")
+        except Exception as e:
+            print("Error occured while opening: ", input_file, e)
+            self.statusBar().showMessage(f"Can't open {os.path.basename(input_file)}: {str(e) or type(e).__name__}")
+            self.thumbnail_strip.remove(input_file, self.input_img_path)
+            self.thumbnail_strip.setVisible(len(self.session) > 1)
+            return
+        self.add_images([input_file])
+        self.thumbnail_strip.set_current(input_file)
+        # each image keeps its own compression value, one without starts at the current value
+        self.cmprs_panel.cmprs_spinbox.setValue(self.session.value_for(input_file, self.cmprs_panel.value()))
         self.input_img_path = input_file
-        input_file_name_wo_ext = utils.get_base_name_wo_ext(self.input_img_path) # input image file name wihtout extensions
-        output_file_name = self.out_img_name_pat.replace("*", input_file_name_wo_ext) + ".jpg"
-        # print("output file name:", output_file_name)
-        self.output_img_path = self.program_dir+"/output/"+output_file_name
-        
-        # set pixmap to the label
-        self.real_pixmap = QPixmap(self.input_img_path)
+        self.output_img_path = compressor.get_output_path(self.input_img_path, self.output_img_dir, self.out_img_name_pat,
+                                                          encoders.get_format(self.format_name).extension)
+        
+        # set image to the view, fitted to the scroll area. The QImage shares the decoded pixels
+        self.real_decoded = decoded
+        image_format = QImage.Format_RGBA8888 if self.real_decoded.mode == "RGBA" else QImage.Format_RGB888
+        width, height = self.real_decoded.size
+        self.real_image = QImage(self.real_decoded.buffer, width, height, self.real_decoded.bytes_per_line, image_format)
         self.scale_factor = 1.0
-        scaled_pixmap = self.real_pixmap.scaled(self.real_img_scroll_area.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation)
-        self.real_image_label.setPixmap(scaled_pixmap)
+        self.cmprsd_image = None
+        self.cmprsd_image_view.clear()
+        self.metrics_label.setText("")
+        self.update_images()
+        # build the source's zoom levels in the background
+        source_pyramid = self.real_image_view.pyramid
+        pyramid_worker = workers.Worker(0, lambda cancelled: source_pyramid.build_all(), thread_priority=QThread.LowPriority)
+        pyramid_worker.signals.finished.connect(lambda job_id, result: self.update_pyramid_status())
+        QThreadPool.globalInstance().start(pyramid_worker)
         
         # update the size label
-        file_size = os.path.getsize(input_file)
-        file_size_str = utils.format_file_size(file_size)
+        self.input_img_size = os.path.getsize(input_file)
+        file_size_str = utils.format_file_size(self.input_img_size)
         self.real_img_size_label.setText(file_size_str)
         
+        # decode the source once, every compression value change reuses it
+        self.cancel_prefetch()
+        self.encoder = self.make_encoder()
+        
         # call compress image function also to update the compressed image
         self.compress_image()
     
+    def make_encoder(self):
+        """encoder for the open image. The configured encoder if it can write the format, else pillow"""
+        return core.make_encoder(self.encoder_name, self.input_img_path, self.image_store, self.format_name, self.preset, self.output_resize,
+                                 self.metadata_policy)
+    
+    def set_format(self, format_name, preset):
+        """switch the output format or effort preset. The panel's range follows the format"""
+        if format_name != self.format_name:
+            output_format = encoders.get_format(format_name)
+            self.cmprs_panel.set_range(output_format.min_value, output_format.max_value, core.default_value(self.configuration, format_name))
+            # the images' values were on the old format's scale
+            self.session.reset_values()
+            self.session_model.refresh()
+        self.format_name, self.preset = format_name, preset
+        if self.real_image is None: return
+        self.output_img_path = compressor.get_output_path(self.input_img_path, self.output_img_dir, self.out_img_name_pat,
+                                                          encoders.get_format(format_name).extension)
+        self.cancel_prefetch()
+        self.encoder = self.make_encoder()
+        self.compress_image()
+    
+    def set_resize(self, resize):
+        """downscale the source with resize (a resizing.Resize) before encoding"""
+        self.output_resize = resize
+        if self.real_image is None: return
+        self.cancel_prefetch()
+        # the encoder keeps the resized source, a new one resizes again on its first encode
+        self.encoder = self.make_encoder()
+        self.encode_timer.start()
+    
     def save_file_with_file_dialog(self):
         # by default opens the parent directory of input image
         default_dir = os.path.dirname(self.input_img_path)
@@ -226,12 +438,13 @@ class Widget(QMainWindow):
             None, 
             "Save File",  # Dialog title
             default_dir,           # Default directory ("" means current directory)
-            "Image Files (*.jpg)"  # File filters
+            f"Image Files (*{self.encoder.format.extension})" if self.encoder else ""  # File filters
         )
         
         if save_file_path: 
             try:
-                shutil.copy(self.output_img_path, save_file_path)
+                # current compressed bytes are in memory, no need to encode or read the output again
+                utils.write_file(save_file_path, self.cmprsd_bytes)
                 print("Image saved successfully")
             except Exception as e:
                 print("Error occured while saving: ", e)
@@ -239,79 +452,358 @@ class Widget(QMainWindow):
         else: print("Save operation cancelled.")
         
     def compress_image(self):
-        if (self.real_pixmap==None): return
-        # print("compressing")
-        # print("input image path: ", self.input_img_path)
-        # Call ffmpeg command to compress image
-        input_image = self.input_img_path
-        output_image = self.output_img_path
-        compression_value = str(self.cmprs_panel.value())
-        ffmpeg_command = [
-            'ffmpeg',
-            '-i', input_image,
-            '-q:v', compression_value,
-            output_image,
-            '-y',  # to overwrite without asking permission
-            '-loglevel', 'quiet' # to disable the output
-        ]
-        result = subprocess.run(ffmpeg_command, capture_output=True, text=True)
-        
-        if result.returncode != 0:
-            print("ffmpeg command failed")
-            print("Error message from ffmpeg command: ", )
-        
-        # update pixmaps
-        self.cmprsd_pixmap = QPixmap(output_image)
-        self.update_images()
+        """compress now, skipping the debounce delay"""
+        self.encode_timer.stop()
+        self.start_encode()
+    
+    def start_encode(self):
+        """start encoding with the current compression value, cancels the encode in progress"""
+        if (self.real_image==None): return
+        if self.encode_worker is not None:
+            self.encode_worker.cancel()
+        self.encode_job_id += 1
+        self.encode_started = time.perf_counter()
+        compression_value = self.cmprs_panel.value()
+        self.encode_value = compression_value
+        self.session.set_value(self.input_img_path, compression_value)
+        self.session_model.refresh(self.input_img_path)
+        
+        # already encoded and previewed: show it right away
+        source_key = self.cache.known_source_key(self.input_img_path)
+        if source_key is not None:
+            cached = self.cache.get_in_memory(source_key + self.encoder.settings_key(compression_value))
+            if cached is not None:
+                perf.count("cache.hit")
+                self.encode_finished(self.encode_job_id, cached)
+                # the file is still written on the encode thread, after any write queued before it
+                self.encode_worker = workers.Worker(self.encode_job_id, workers.write_job(self.output_img_path, cached[0]))
+                self.encode_worker.signals.failed.connect(self.encode_failed)
+                self.encode_pool.start(self.encode_worker)
+                return
+        
+        job = workers.encode_job(self.encoder, compression_value, self.output_img_path, self.cache)
+        self.encode_worker = workers.Worker(self.encode_job_id, job)
+        self.encode_worker.signals.finished.connect(self.encode_finished)
+        self.encode_worker.signals.failed.connect(self.encode_failed)
+        self.encode_pool.start(self.encode_worker)
+    
+    def encode_failed(self, job_id, error):
+        if job_id != self.encode_job_id: return
+        print("Compression failed: ", error)
+    
+    def encode_finished(self, job_id, result):
+        # results of older jobs are dropped
+        if job_id != self.encode_job_id: return
+        self.encode_worker = None
+        self.cmprsd_bytes, self.cmprsd_image = result
+        self.cmprsd_mime_type = self.encoder.mime_type
+        
+        # update the compressed view
+        with perf.span("preview.show"):
+            self.cmprsd_image_view.set_image(self.cmprsd_image)
+        self.update_pyramid_status()
+        # from the value change (after the debounce) to the preview being set
+        perf.record("encode.latency", time.perf_counter() - self.encode_started, {"value": self.cmprs_panel.value()})
         
         # update the size label
-        file_size = os.path.getsize(output_image)
+        file_size = len(self.cmprsd_bytes)
         file_size_str = utils.format_file_size(file_size)
         # here size label has percentage also 
-        percent = file_size/os.path.getsize(input_image)*100
+        percent = file_size/self.input_img_size*100
         file_size_str += f"  ({percent:.1f}%)"
+        if self.cmprsd_image.size() != self.real_image.size():
+            file_size_str += f"  {self.cmprsd_image.width()}x{self.cmprsd_image.height()}"
         self.cmprsd_img_size_label.setText(file_size_str)
+        
+        self.start_metrics()
+        self.start_prefetch()
+    
+    def start_metrics(self):
+        """compute the quality metrics of the shown compressed image off the UI thread, cached per encode"""
+        if self.metrics_worker is not None:
+            self.metrics_worker.cancel()
+            self.metrics_worker = None
+        source_key = self.cache.known_source_key(self.input_img_path)
+        key = source_key + self.encoder.settings_key(self.encode_value) if source_key is not None else None
+        cached = self.cache.metrics.get(key) if key is not None else None
+        if cached is not None:
+            self.metrics_label.setText(str(cached))
+            return
+        self.metrics_label.setText("measuring quality...")
+        self.metrics_worker = workers.Worker(self.encode_job_id, workers.metrics_job(self.real_decoded, self.cmprsd_image, self.encoder.resize.filter), thread_priority=QThread.LowPriority)
+        self.metrics_worker.signals.finished.connect(lambda job_id, result: self.metrics_finished(job_id, key, result))
+        self.metrics_worker.signals.failed.connect(lambda job_id, error: print("Quality metrics failed: ", error))
+        QThreadPool.globalInstance().start(self.metrics_worker)
+    
+    def metrics_finished(self, job_id, key, result):
+        if key is not None: self.cache.metrics.put(key, result)
+        if job_id != self.encode_job_id: return
+        self.metrics_worker = None
+        self.metrics_label.setText(str(result))
+    
+    def fit_target_size(self, max_bytes):
+        """search the compression value for max_bytes in the background, the panel is set to the result"""
+        if self.encoder is None: return
+        if self.search_worker is not None:
+            self.search_worker.cancel()
+        encoder = self.encoder
+        job = lambda cancelled: search.find_value_for_size(
+            encoder, max_bytes, self.cmprs_panel.min_cmprs_value, self.cmprs_panel.max_cmprs_value,
+            cache=self.cache, cancelled=cancelled)
+        worker = self.search_worker = workers.Worker(0, job)
+        worker.signals.finished.connect(lambda job_id, result: self.search_finished(worker, encoder, max_bytes, result))
+        worker.signals.failed.connect(lambda job_id, error: self.search_failed(worker, error))
+        self.statusBar().showMessage(f"Searching for {utils.format_bytes(max_bytes)}...")
+        QThreadPool.globalInstance().start(worker)
+    
+    def search_failed(self, worker, error):
+        # a search that was replaced by a newer one (and cancelled) ends quietly
+        if worker is not self.search_worker or worker.cancelled.is_set(): return
+        self.search_worker = None
+        print("Search failed: ", error)
+        self.statusBar().showMessage(f"Search failed: {error}")
+    
+    def search_finished(self, worker, encoder, max_bytes, result):
+        if worker is not self.search_worker: return # a newer search is running
+        self.search_worker = None
+        if encoder is not self.encoder: return # another image was opened meanwhile
+        budget = utils.format_bytes(max_bytes)
+        if result.fits:
+            message = f"Target {budget}: compression {result.compression_value}, {utils.format_bytes(result.size)}"
+        else:
+            message = f"Target {budget} not reachable, smallest is {utils.format_bytes(result.size)} at compression {result.compression_value}"
+        self.statusBar().showMessage(message + f" ({result.encodes} encodes in {result.seconds:.2f}s)")
+        self.cmprs_panel.cmprs_spinbox.setValue(result.compression_value)
+    
+    def fit_target_quality(self, metric, threshold):
+        """search the highest compression value that meets the quality threshold in the background"""
+        if self.encoder is None: return
+        if self.search_worker is not None:
+            self.search_worker.cancel()
+        encoder, source = self.encoder, self.real_decoded
+        def job(cancelled):
+            # the source is already decoded, the search measures against it without reading the file again
+            reference = metrics.Reference(source, resize_filter=encoder.resize.filter)
+            return search.find_value_for_quality(
+                encoder, metric, threshold, reference, self.cmprs_panel.min_cmprs_value, self.cmprs_panel.max_cmprs_value,
+                cache=self.cache, cancelled=cancelled)
+        worker = self.search_worker = workers.Worker(0, job)
+        worker.signals.finished.connect(lambda job_id, result: self.quality_search_finished(worker, encoder, metric, threshold, result))
+        worker.signals.failed.connect(lambda job_id, error: self.search_failed(worker, error))
+        self.statusBar().showMessage(f"Searching for {metric.upper()} ≥ {threshold:g}...")
+        QThreadPool.globalInstance().start(worker)
+    
+    def quality_search_finished(self, worker, encoder, metric, threshold, result):
+        if worker is not self.search_worker: return # a newer search is running
+        self.search_worker = None
+        if encoder is not self.encoder: return # another image was opened meanwhile
+        goal = f"{metric.upper()} ≥ {threshold:g}"
+        if result.fits:
+            message = f"{goal}: compression {result.compression_value}, {utils.format_bytes(result.size)}, {result.metrics}"
+        else:
+            message = f"{goal} not reachable, best is {result.metrics} at compression {result.compression_value}"
+        self.statusBar().showMessage(message + f" ({result.encodes} encodes in {result.seconds:.2f}s)")
+        self.cmprs_panel.cmprs_spinbox.setValue(result.compression_value)
+    
+    def apply_to_all(self):
+        """give every open image the current compression value"""
+        compression_value = self.cmprs_panel.value()
+        self.session.apply_to_all(compression_value)
+        self.session_model.refresh()
+        self.statusBar().showMessage(f"Compression {compression_value} for all {len(self.session)} images")
+    
+    def export_all(self):
+        """compress every open image with its own compression value into the output folder, on the session pool.
+        Each output is written as soon as it's encoded. While it runs, this cancels the exports not done yet"""
+        if self.export_workers:
+            self.cancel_export()
+            return
+        if not len(self.session): return
+        self.export_job_id += 1
+        self.export_done_count = 0
+        self.session.clear_results()
+        extension = encoders.get_format(self.format_name).extension
+        default_value = self.cmprs_panel.value()
+        output_img_paths = compressor.get_output_paths([image.path for image in self.session.images], self.output_img_dir,
+                                                       self.out_img_name_pat, extension)
+        for image, output_img_path in zip(self.session.images, output_img_paths):
+            # no image store, each job decodes its own source and lets go of it when it's done
+            encoder = core.make_encoder(self.encoder_name, image.path, None, self.format_name, self.preset, self.output_resize,
+                                        self.metadata_policy)
+            job = workers.export_job(encoder, self.session.value_for(image.path, default_value), output_img_path, self.cache)
+            worker = workers.Worker(self.export_job_id, job, thread_priority=QThread.LowPriority)
+            worker.signals.finished.connect(lambda job_id, out_bytes, path=image.path: self.export_finished(job_id, path, out_bytes, ""))
+            worker.signals.failed.connect(lambda job_id, error, path=image.path: self.export_finished(job_id, path, None, error))
+            self.export_workers.append(worker)
+            self.session_pool.start(worker, 0)
+        self.export_progress.setRange(0, len(self.export_workers))
+        self.export_progress.setValue(0)
+        self.export_progress.show()
+        self.export_all_btn.setText("Cancel Export")
+        self.session_model.refresh()
+        self.statusBar().showMessage(f"Exporting {len(self.export_workers)} images to {self.output_img_dir}...")
+    
+    def export_finished(self, job_id, path, out_bytes, error):
+        if job_id != self.export_job_id: return # a cancelled export
+        image = self.session.get(path)
+        if image is not None: # None if it was taken out of the session while its export ran
+            image.out_bytes, image.error = out_bytes, error
+            if error: print("Export failed: ", path, error)
+            self.session_model.refresh(path)
+        # the job is done either way, or the export would never finish
+        self.export_done_count += 1
+        self.export_progress.setValue(self.export_done_count)
+        if self.export_done_count == len(self.export_workers):
+            self.export_stopped("Exported")
+        else:
+            self.statusBar().showMessage(f"Exporting {self.export_done_count}/{len(self.export_workers)}: {self.export_summary()}")
+    
+    def cancel_export(self):
+        for worker in self.export_workers:
+            worker.cancel()
+        # results of the cancelled jobs are dropped
+        self.export_job_id += 1
+        self.export_stopped("Export cancelled,")
+    
+    def export_stopped(self, prefix):
+        count, _, _ = self.session.totals()
+        failed = sum(1 for image in self.session.images if image.error)
+        self.statusBar().showMessage(f"{prefix} {count} images: {self.export_summary()}" + (f", {failed} failed" if failed else ""))
+        self.export_workers = []
+        self.export_progress.hide()
+        self.export_all_btn.setText("Export All")
+    
+    def export_summary(self):
+        """sizes of the images exported so far, e.g. "120.5MB -> 30.2MB, saved 90.3MB (74.9%)" """
+        _, in_bytes, out_bytes = self.session.totals()
+        text = f"{utils.format_bytes(in_bytes)} -> {utils.format_bytes(out_bytes)}"
+        if in_bytes:
+            text += f", saved {utils.format_bytes(in_bytes - out_bytes)} ({(in_bytes - out_bytes)/in_bytes*100:.1f}%)"
+        return text
+    
+    def set_prefetch_enabled(self, enabled):
+        self.prefetch_enabled = enabled
+        if enabled: self.start_prefetch()
+        else: self.cancel_prefetch()
+    
+    def start_prefetch(self):
+        """pre-encode values around the current one, nearest first. Already cached values are skipped"""
+        self.cancel_prefetch()
+        if not self.prefetch_enabled or self.encoder is None: return
+        center = self.cmprs_panel.value()
+        values = workers.ladder_order(center, self.cmprs_panel.min_cmprs_value, self.cmprs_panel.max_cmprs_value, self.prefetch_radius)
+        for value in values:
+            if value == center: continue
+            job = workers.prefetch_job(self.encoder, value, self.cache)
+            worker = workers.Worker(value, job, thread_priority=QThread.LowestPriority)
+            self.prefetch_workers.append(worker)
+            # nearer values get higher queue priority
+            self.prefetch_pool.start(worker, -abs(value-center))
+    
+    def cancel_prefetch(self):
+        for worker in self.prefetch_workers:
+            worker.cancel()
+        self.prefetch_pool.clear()
+        self.prefetch_workers = []
 
     def zoom_in(self, zoom_factor=1.25):
-        if (self.real_pixmap==None): return
+        if (self.real_image==None): return
         if (self.scale_factor*zoom_factor>self.scale_factor_max): return
         self.scale_factor *= zoom_factor
         self.update_images()
         self.adjust_scrollbars(zoom_factor)
     
     def zoom_out(self, zoom_factor=0.8):
-        if (self.real_pixmap==None): return
+        if (self.real_image==None): return
         if (self.scale_factor*zoom_factor<self.scale_factor_min): return
         self.scale_factor *= zoom_factor
         self.update_images()
         self.adjust_scrollbars(zoom_factor)
     
     def update_images(self):
-        real_scaled_pixmap = self.real_pixmap.scaled(self.real_img_scroll_area.size()*self.scale_factor, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-        self.real_image_label.setPixmap(real_scaled_pixmap)
-        cmprsd_scaled_pixmap = self.cmprsd_pixmap.scaled(self.real_img_scroll_area.size()*self.scale_factor, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-        self.cmprsd_image_label.setPixmap(cmprsd_scaled_pixmap)
+        """apply scale_factor. At 1.0 the image fits the scroll area, tiles are only resampled when they get painted"""
+        area_size = self.real_img_scroll_area.size()
+        image_size = self.real_image.size()
+        if image_size.isEmpty(): return
+        fit_scale = min(area_size.width()/image_size.width(), area_size.height()/image_size.height())
+        with perf.span("zoom.update", scale=self.scale_factor):
+            self.tile_grid.set_geometry((image_size.width(), image_size.height()), fit_scale*self.scale_factor)
+            self.real_image_view.set_image(self.real_image)
+            if (self.cmprsd_image==None): return
+            self.cmprsd_image_view.update_size()
+            self.cmprsd_image_view.update()
+        self.update_pyramid_status()
+    
+    def set_diff_mode(self, enabled):
+        """the compressed pane shows the error against the source as a heatmap, black is no error"""
+        self.cmprsd_image_view.set_diff_source(self.real_image_view if enabled else None)
+    
+    def make_diff_tile(self, key, render):
+        worker = workers.Worker(0, lambda cancelled: render())
+        worker.signals.finished.connect(lambda job_id, tile: self.diff_tile_finished(key, tile))
+        worker.signals.failed.connect(lambda job_id, error: self.diff_tile_finished(key, None, error))
+        # kept until it's done, the signals go away with the worker
+        self.diff_tile_workers[key] = worker
+        QThreadPool.globalInstance().start(worker)
+    
+    def diff_tile_finished(self, key, tile, error=""):
+        self.diff_tile_workers.pop(key, None)
+        if error: print("Difference tile failed: ", error)
+        self.cmprsd_image_view.set_tile(key, tile)
+    
+    def update_pyramid_status(self):
+        text = []
+        for name, view in (("source", self.real_image_view), ("compressed", self.cmprsd_image_view)):
+            if view.pyramid is not None:
+                text.append(f"{name}: {view.pyramid.status()}")
+        self.pyramid_status_label.setText("Zoom levels - " + ", ".join(text) if text else "")
+    
+    def set_perf_overlay(self, enabled):
+        self.perf_overlay = enabled
+        # the overlay needs the timings, once it's closed they're on or off as configured again
+        if perf.enabled != (enabled or self.perf_enabled):
+            perf.set_enabled(enabled or self.perf_enabled)
+        if enabled:
+            self.perf_timer.start()
+            self.update_perf_overlay()
+        else:
+            self.perf_timer.stop()
+        self.perf_label.setVisible(enabled)
+    
+    def update_perf_overlay(self):
+        self.perf_label.setText(perf.overlay_text(("encode.latency", "encode", "preview.decode", "open", "zoom.update", "tile.render")))
     
     def adjust_scrollbars(self, factor):
         for scroll_area in (self.real_img_scroll_area, self.cmprsd_img_scroll_area):
             for scroll_bar in (scroll_area.horizontalScrollBar(), scroll_area.verticalScrollBar()):
                 scroll_bar.setValue(scroll_bar.value()*factor + (factor-1)*scroll_bar.pageStep()/2)
     
+    def export_mime_data(self):
+        """the compressed image for the clipboard and drags, nothing is read, decoded or encoded here:
+        the encoded bytes as they are (image/jpeg, image/webp, ...), the output file (already written by the encode)
+        and the decoded preview. Qt only converts the preview if a target asks for a type it doesn't have,
+        e.g. image/png on Linux or a DIB on Windows"""
+        mime_data = QMimeData()
+        mime_data.setData(self.cmprsd_mime_type, QByteArray(self.cmprsd_bytes))
+        mime_data.setImageData(self.cmprsd_image)
+        mime_data.setUrls([QUrl.fromLocalFile(os.path.abspath(self.output_img_path))])
+        return mime_data
+    
+    def copy_btn_clicked(self):
+        if (self.cmprsd_image==None): return
+        QApplication.clipboard().setMimeData(self.export_mime_data())
+    
     def drag_btn_clicked(self, event):
         if event.button() != Qt.LeftButton: return
+        if (self.cmprsd_image==None): return
         
         drag = QDrag(self)
-        mime_data = QMimeData()
+        drag.setMimeData(self.export_mime_data())
+        # thumbnail of the compressed image under the pointer
+        drag.setPixmap(QPixmap.fromImage(self.cmprsd_image.scaled(128, 128, Qt.KeepAspectRatio, Qt.SmoothTransformation)))
 
-        # Set the file path as the MIME data
-        # print("in drag-btn-clicked: output img path: self.output_img_path ", self.output_img_path)
-        mime_data.setUrls([QUrl.fromLocalFile(self.output_img_path)])
-        drag.setMimeData(mime_data)
-
-        # drag.setHotSpot(QPoint(10, 10))  # Set the hotspot where the mouse pointer will be
-
-        # Start the drag operation
-        drag.exec(Qt.CopyAction | Qt.MoveAction)
+        # Start the drag operation. Copy only, a move would take the output file away
+        drag.exec(Qt.CopyAction)
         
     def temp_btn_clicked(self):
         self.cmprsd_img_scroll_area.set_ver_scroll_bar_val(0.2)
@@ -320,7 +812,8 @@ class Widget(QMainWindow):
         self.cmprsd_img_scroll_area.set_hor_scroll_bar_val(0.5)
         pass
     
-window = Widget()
-window.show()
-
-app.exec()
\ No newline at end of file
+if __name__ == "__main__":
+    app = QApplication(sys.argv)
+    window = Widget()
+    window.show()
+    app.exec()
@@ -0,0 +1,157 @@
+"""Source format detection, EXIF orientation and what metadata the outputs keep.
+
+    metadata.detect_format(path)                           # "jpeg", "png", "webp", ... from the header
+    policy = metadata.MetadataPolicy(exif="strip", icc="keep")
+    info = metadata.read(img)                              # orientation, EXIF and ICC profile of an open PIL image
+    img.save(output, "JPEG", **policy.save_options(info))
+    data = metadata.filter_jpeg(data, policy)              # drop JPEG metadata segments, the image data isn't touched
+
+Re-encoded outputs are made from pixels turned upright by the EXIF orientation (apply_orientation),
+so they don't need the orientation tag: kept EXIF is written without it.
+The lossless JPEG path (filter_jpeg) doesn't decode, its pixels stay as they were stored, so the
+orientation tag stays too, also when the rest of the EXIF is stripped.
+"exif" covers all descriptive metadata (EXIF, XMP, IPTC and comments), "icc" the color profile,
+which changes how colors are shown.
+"""
+from io import BytesIO
+
+from PIL import Image, UnidentifiedImageError
+
+POLICIES = ("keep", "strip")
+ORIENTATION = 0x0112 # EXIF tag
+
+# EXIF orientation -> the transpose that makes the pixels upright, like ImageOps.exif_transpose
+TRANSPOSES = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+# the same for ffmpeg (-vf)
+FFMPEG_TRANSPOSES = {2: "hflip", 3: "hflip,vflip", 4: "vflip", 5: "transpose=0", 6: "transpose=1", 7: "transpose=3", 8: "transpose=2"}
+
+
+def detect_format(source):
+    """lowercase Pillow format name of a file path or file object ("jpeg", "png", ...), None if it isn't an image.
+    Only the header is read, file objects are rewound"""
+    try:
+        with Image.open(source) as img:
+            return img.format.lower() if img.format else None
+    except (UnidentifiedImageError, OSError):
+        return None
+    finally:
+        if hasattr(source, "seek"): source.seek(0)
+
+
+def read(img):
+    """dict with the orientation (1-8), the EXIF without the orientation tag (bytes or None) and the
+    ICC profile (bytes or None) of an open PIL image"""
+    exif = Image.Exif()
+    exif.load(img.getexif().tobytes()) # a copy, the image's own Exif stays as it is
+    orientation = exif.pop(ORIENTATION, 1)
+    return {
+        "orientation": orientation if orientation in TRANSPOSES else 1,
+        "exif": exif.tobytes() if len(exif) else None,
+        "icc_profile": img.info.get("icc_profile") or None,
+    }
+
+
+def oriented_size(size, orientation):
+    """(width, height) of an image of size once apply_orientation turned it upright"""
+    return size[::-1] if orientation in (5, 6, 7, 8) else size
+
+
+def apply_orientation(image, orientation):
+    """image (PIL) turned upright for the EXIF orientation, image itself if it already is"""
+    if orientation not in TRANSPOSES: return image
+    return image.transpose(TRANSPOSES[orientation])
+
+
+class MetadataPolicy:
+    """What outputs keep of the source's metadata: exif and icc are each "keep" or "strip" """
+    def __init__(self, exif="strip", icc="keep"):
+        for name, value in (("exif", exif), ("icc", icc)):
+            if value not in POLICIES:
+                raise ValueError(f"Unknown {name} policy {value!r}, choose from: {', '.join(POLICIES)}")
+        self.exif = exif
+        self.icc = icc
+
+    @classmethod
+    def from_config(cls, configuration, exif=None, icc=None):
+        """policy from the "metadata" section of config.json, exif and icc replace it if they aren't None"""
+        metadata_config = configuration["metadata"]
+        return cls(exif or metadata_config["exif"], icc or metadata_config["icc"])
+
+    def __repr__(self):
+        return f"MetadataPolicy(exif={self.exif!r}, icc={self.icc!r})"
+
+    def key(self):
+        """identifies the policy in cache keys"""
+        return ("metadata", self.exif, self.icc)
+
+    def save_options(self, info):
+        """Pillow save arguments that write what the policy keeps of info (from read())"""
+        options = {}
+        if self.exif == "keep" and info["exif"]:
+            options["exif"] = info["exif"]
+        if self.icc == "keep" and info["icc_profile"]:
+            options["icc_profile"] = info["icc_profile"]
+        return options
+
+
+# JPEG markers
+SOI, SOS, EOI, COM = 0xD8, 0xDA, 0xD9, 0xFE
+APP0, APP1, APP2, APP14 = 0xE0, 0xE1, 0xE2, 0xEE
+ICC_SIGNATURE = b"ICC_PROFILE\x00"
+
+def jpeg_segments(data):
+    """(marker, segment bytes) of the header segments of a JPEG, up to the start of the image data.
+    The last one is (SOS, everything from the SOS marker to the end)"""
+    if data[:2] != b"\xff\xd8":
+        raise ValueError("Not a JPEG file")
+    pos = 2
+    while pos < len(data) - 1:
+        if data[pos] != 0xFF:
+            raise ValueError(f"Corrupt JPEG, no marker at byte {pos}")
+        marker = data[pos + 1]
+        if marker == 0xFF: # fill byte
+            pos += 1
+            continue
+        if marker in (SOS, EOI):
+            yield marker, data[pos:]
+            return
+        length = int.from_bytes(data[pos + 2:pos + 4], "big")
+        yield marker, data[pos:pos + 2 + length]
+        pos += 2 + length
+    raise ValueError("Corrupt JPEG, no image data")
+
+
+def filter_jpeg(data, policy, orientation=None):
+    """data (a JPEG) without the metadata segments policy strips, the compressed image data is copied as it is.
+    JFIF (APP0) and Adobe (APP14) segments are always kept, they tell decoders how to read the image.
+    When EXIF is stripped but orientation (read from data if None) isn't 1, a minimal EXIF with just the
+    orientation is written so the image still shows upright"""
+    if orientation is None:
+        with Image.open(BytesIO(data)) as img:
+            orientation = img.getexif().get(ORIENTATION, 1)
+    output = [data[:2]]
+    for marker, segment in jpeg_segments(data):
+        if marker in (APP0, APP14) or not (APP0 <= marker <= 0xEF or marker == COM):
+            keep = True
+        elif marker == APP2 and segment[4:4 + len(ICC_SIGNATURE)] == ICC_SIGNATURE:
+            keep = policy.icc == "keep"
+        else: # EXIF and XMP (APP1), IPTC (APP13), comments and the other application segments
+            keep = policy.exif == "keep"
+        if keep:
+            output.append(segment)
+    if policy.exif == "strip" and orientation in TRANSPOSES:
+        exif = Image.Exif()
+        exif[ORIENTATION] = orientation
+        body = exif.tobytes()
+        # right after SOI and JFIF, where readers look for EXIF
+        position = 2 if output[1][1] == APP0 else 1
+        output.insert(position, bytes((0xFF, APP1)) + (len(body) + 2).to_bytes(2, "big") + body)
+    return b"".join(output)
@@ -0,0 +1,200 @@
+"""Objective quality of a compressed image against its source, with vectorized NumPy.
+
+    metrics.compare(source, compressed) -> Metrics(psnr, ssim, worst)
+    metrics.Reference(source).compare(compressed) # prepares the source once for many compares
+
+source and compressed can be PIL images, imagestore.DecodedImage or (height, width, 3+) uint8 arrays.
+If the compressed image was downscaled (see resizing.py), it is measured against the source resized to
+its size with the same filter (resize_filter, default lanczos), so the score is about the encode and
+not the lost resolution.
+
+Images over max_pixels aren't measured whole, so big images stay fast:
+    "tiles" (default) - about max_pixels worth of full resolution 128x128 tiles, spread evenly over
+                        the image. Artifacts are measured as they are, on a sample of the image
+    "box"             - the image reduced by averaging factor x factor blocks, in bands of rows.
+                        Measures what is seen zoomed out, fine artifacts and noise average away
+
+psnr  - over RGB, in dB (inf for identical images)
+ssim  - mean SSIM of the luma with a 7x7 window, 1.0 is identical
+worst - butteraugli-like worst area score: the RMS luma error of each 8x8 block, lowered where the
+        source block is busy (errors hide in texture), 99th percentile. About 0-1 is hard to see,
+        above 3 is usually visible. Not the real butteraugli, just a cheap stand-in
+"""
+import math
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+import metadata
+import resizing
+
+MAX_PIXELS = 2_000_000
+TILE = 128
+SSIM_WINDOW = 7
+SSIM_C1 = (0.01*255)**2
+SSIM_C2 = (0.03*255)**2
+BLOCK = 8
+LUMA = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+# error heatmap colors, from no error (black) to max_error and above (white)
+HEATMAP_STOPS = ((0.0, (0, 0, 0)), (0.25, (40, 0, 130)), (0.5, (200, 30, 70)), (0.75, (255, 160, 0)), (1.0, (255, 255, 230)))
+HEATMAP_LUT = np.stack([
+    np.interp(np.arange(256)/255, [stop for stop, _ in HEATMAP_STOPS], [color[channel] for _, color in HEATMAP_STOPS])
+    for channel in range(3)
+], axis=-1).astype(np.uint8)
+
+
+class Metrics:
+    def __init__(self, psnr, ssim, worst, factor=1):
+        self.psnr = psnr
+        self.ssim = ssim
+        self.worst = worst
+        self.factor = factor # 1 if the whole image was measured, else 1/factor² of it was (sampled or reduced)
+
+    def __repr__(self):
+        return f"Metrics(psnr={self.psnr:.2f}, ssim={self.ssim:.4f}, worst={self.worst:.2f}, factor={self.factor})"
+
+    def __str__(self):
+        psnr = "inf" if math.isinf(self.psnr) else f"{self.psnr:.1f}"
+        return f"PSNR {psnr} dB  SSIM {self.ssim:.4f}  worst {self.worst:.2f}"
+
+
+def as_array(image):
+    """(height, width, channels) uint8 array of image, a view where possible"""
+    if isinstance(image, np.ndarray):
+        return image
+    if isinstance(image, Image.Image):
+        return np.asarray(image if image.mode in ("RGB", "RGBA") else image.convert("RGB"))
+    # imagestore.DecodedImage, the array shares its buffer
+    width, height = image.size
+    return np.frombuffer(image.buffer, dtype=np.uint8, count=image.nbytes).reshape(height, width, len(image.mode))
+
+def load(path):
+    """RGB array of an image file, upright by its EXIF orientation like the encoders see it"""
+    with Image.open(path) as img:
+        return np.asarray(metadata.apply_orientation(img.convert("RGB"), metadata.read(img)["orientation"]))
+
+def decode(data):
+    """RGB array of encoded image bytes"""
+    return load(BytesIO(data))
+
+def reduce_factor(size, max_pixels=MAX_PIXELS):
+    width, height = size
+    return max(1, math.ceil(math.sqrt(width*height/max_pixels)))
+
+def sample_tiles(array, factor, tile=TILE):
+    """float32 (tiles, tile, tile, 3) array with every factor-th tile in both directions. Alpha is dropped"""
+    rows, cols = array.shape[0]//tile, array.shape[1]//tile
+    if rows == 0 or cols == 0:
+        return array[None, :, :, :3].astype(np.float32)
+    grid = array[:rows*tile, :cols*tile].reshape(rows, tile, cols, tile, array.shape[2])
+    # start half a step in, so the tiles are centered in the image rather than crowding the top left
+    picked = grid[min((factor - 1)//2, rows - 1)::factor, :, min((factor - 1)//2, cols - 1)::factor, :, :3]
+    return picked.transpose(0, 2, 1, 3, 4).reshape(-1, tile, tile, 3).astype(np.float32)
+
+def reduce(array, factor, band_rows=256):
+    """float32 RGB array reduced by factor in both directions. Alpha is dropped"""
+    rgb = array[:, :, :3]
+    height, width = rgb.shape[0]//factor, rgb.shape[1]//factor
+    out = np.empty((height, width, 3), dtype=np.float32)
+    # band by band, so the float copy is never the size of the whole image
+    step = max(1, band_rows//factor)
+    for top in range(0, height, step):
+        bottom = min(height, top + step)
+        band = rgb[top*factor:bottom*factor, :width*factor].astype(np.float32)
+        out[top:bottom] = band.reshape(bottom - top, factor, width, factor, 3).mean(axis=(1, 3))
+    return out
+
+def luma(rgb):
+    return rgb @ LUMA
+
+
+def psnr(a, b):
+    mse = float(np.mean(np.square(a - b, dtype=np.float32)))
+    return math.inf if mse == 0 else 10*math.log10(255**2/mse)
+
+# the plane functions below take (..., height, width) arrays, so a stack of tiles goes in one call
+def _window_mean(a, size):
+    """mean over every size x size window (valid positions only), with an integral image"""
+    c = np.zeros(a.shape[:-2] + (a.shape[-2] + 1, a.shape[-1] + 1), dtype=np.float64)
+    np.cumsum(np.cumsum(a, axis=-2, dtype=np.float64), axis=-1, out=c[..., 1:, 1:])
+    return (c[..., size:, size:] - c[..., :-size, size:] - c[..., size:, :-size] + c[..., :-size, :-size])/(size*size)
+
+def ssim(a, b, window=SSIM_WINDOW):
+    """mean SSIM of two luma planes"""
+    if min(a.shape[-2:]) < window:
+        return 1.0 if np.array_equal(a, b) else 0.0
+    mean_a, mean_b = _window_mean(a, window), _window_mean(b, window)
+    var_a = _window_mean(a*a, window) - mean_a**2
+    var_b = _window_mean(b*b, window) - mean_b**2
+    covariance = _window_mean(a*b, window) - mean_a*mean_b
+    ssim_map = ((2*mean_a*mean_b + SSIM_C1)*(2*covariance + SSIM_C2)) / \
+               ((mean_a**2 + mean_b**2 + SSIM_C1)*(var_a + var_b + SSIM_C2))
+    return float(ssim_map.mean())
+
+def worst_area(a, b, block=BLOCK):
+    """99th percentile of the contrast masked RMS error of block x block areas of two luma planes"""
+    height, width = a.shape[-2]//block, a.shape[-1]//block
+    if height == 0 or width == 0:
+        return float(np.sqrt(np.mean(np.square(a - b))))
+    shape = a.shape[:-2] + (height, block, width, block)
+    source = a[..., :height*block, :width*block].reshape(shape)
+    error = np.sqrt(np.mean(np.square(source - b[..., :height*block, :width*block].reshape(shape)), axis=(-3, -1)))
+    masking = 1 + source.std(axis=(-3, -1))/8
+    return float(np.percentile(error/masking, 99))
+
+
+def error_heatmap(source, compressed, max_error=32):
+    """(height, width, 3) uint8 heatmap of the per pixel error, the largest channel difference.
+    Both are (height, width, 3+) uint8 arrays of the same size. The colors follow the square root
+    of the error, so the small errors that are typical for jpeg are still visible"""
+    error = np.abs(source[..., :3].astype(np.int16) - compressed[..., :3]).max(axis=-1)
+    colors = HEATMAP_LUT[(np.sqrt(np.minimum(np.arange(256)/max_error, 1))*255).astype(np.uint8)]
+    return colors[error]
+
+
+class Reference:
+    """The source side of compare(), prepared once. Searches compare many encodes against the same source"""
+    def __init__(self, source, max_pixels=MAX_PIXELS, mode="tiles", resize_filter="lanczos"):
+        if mode not in ("tiles", "box"):
+            raise ValueError(f"Unknown mode {mode!r}, choose from: tiles, box")
+        source = as_array(source)
+        self.source = source
+        self.shape = source.shape[:2]
+        self.mode = mode
+        self.max_pixels = max_pixels
+        self.resize_filter = resize_filter
+        self.resized = {} # (height, width) -> Reference of the source resized to that size
+        self.factor = reduce_factor((source.shape[1], source.shape[0]), max_pixels)
+        self.rgb = self.prepare(source)
+        self.luma = luma(self.rgb)
+
+    def prepare(self, array):
+        if self.factor == 1: return array[:, :, :3].astype(np.float32)
+        if self.mode == "tiles": return sample_tiles(array, self.factor)
+        return reduce(array, self.factor)
+
+    def compare(self, compressed):
+        compressed = as_array(compressed)
+        if compressed.shape[:2] != self.shape:
+            return self.resized_to(compressed.shape[:2]).compare(compressed)
+        rgb = self.prepare(compressed)
+        compressed_luma = luma(rgb)
+        return Metrics(psnr(self.rgb, rgb), ssim(self.luma, compressed_luma), worst_area(self.luma, compressed_luma), self.factor)
+
+    def resized_to(self, shape):
+        """Reference of the source resized to shape (height, width), made once per size"""
+        if shape not in self.resized:
+            height, width = shape
+            if abs(width/self.shape[1] - height/self.shape[0]) > 0.02 + 2/min(shape):
+                raise ValueError(f"Image sizes differ: {self.shape[1]}x{self.shape[0]} and {width}x{height}")
+            image = resizing.Resize(filter=self.resize_filter).apply(Image.fromarray(np.ascontiguousarray(self.source[:, :, :3])), (width, height))
+            self.resized[shape] = Reference(np.asarray(image), self.max_pixels, self.mode)
+        return self.resized[shape]
+
+
+def compare(source, compressed, max_pixels=MAX_PIXELS, mode="tiles", resize_filter="lanczos"):
+    """Metrics of compressed against source, resized to the compressed size with resize_filter if they differ"""
+    return Reference(source, max_pixels, mode, resize_filter).compare(compressed)
@@ -0,0 +1,114 @@
+"""Timing spans and counters for the hot paths.
+
+    with perf.span("encode", value=7):
+        ...
+    perf.count("cache.hit")
+
+Everything is off until configure(True). While off, span() returns one shared
+object with empty __enter__/__exit__ and count() returns right away, so instrumented
+code costs about a function call. While on, every span updates per-name stats
+(snapshot()) and, if a trace file is set, appends one JSON line per span.
+"""
+import json
+import threading
+import time
+
+enabled = False
+_trace_path = None # set by configure, kept while instrumentation is turned off and on again
+_trace_file = None
+_lock = threading.Lock()
+_stats = {} # name -> [count, total seconds, max seconds, last seconds]
+_counters = {} # name -> count
+
+
+class _NoopSpan:
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+
+_NOOP = _NoopSpan()
+
+
+class _Span:
+    __slots__ = ("name", "fields", "start")
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start, self.fields)
+        return False
+
+
+def configure(enable, trace_file=None):
+    """turn instrumentation on or off. trace_file is a path to append JSON lines to, None for no trace"""
+    global _trace_path
+    _trace_path = trace_file
+    set_enabled(enable)
+
+def set_enabled(enable):
+    """turn instrumentation on or off, with the trace file given to configure"""
+    global enabled, _trace_file
+    with _lock:
+        if _trace_file is not None:
+            _trace_file.close()
+        _trace_file = open(_trace_path, "a", buffering=1) if (enable and _trace_path) else None
+        enabled = enable
+
+def configure_from_config(configuration):
+    """set up from the "perf" section of config.json"""
+    perf_config = configuration["perf"]
+    configure(perf_config["enabled"] or perf_config["overlay"], perf_config["trace_file"])
+
+def span(name, **fields):
+    """context manager timing the block as name. fields go to the trace file"""
+    if not enabled: return _NOOP
+    return _Span(name, fields)
+
+def count(name, n=1):
+    if not enabled: return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+def record(name, seconds, fields=None):
+    """add a timing taken some other way"""
+    if not enabled: return
+    with _lock:
+        stat = _stats.get(name)
+        if stat is None:
+            stat = _stats[name] = [0, 0.0, 0.0, 0.0]
+        stat[0] += 1
+        stat[1] += seconds
+        stat[2] = max(stat[2], seconds)
+        stat[3] = seconds
+        if _trace_file is not None:
+            entry = {"ts": time.time(), "name": name, "ms": round(seconds*1000, 3), "thread": threading.current_thread().name}
+            if fields: entry.update(fields)
+            _trace_file.write(json.dumps(entry, default=str) + "\n")
+
+def snapshot():
+    """{"spans": {name: {count, total_ms, mean_ms, max_ms, last_ms}}, "counters": {name: count}}"""
+    with _lock:
+        spans = {
+            name: {"count": c, "total_ms": total*1000, "mean_ms": total/c*1000, "max_ms": peak*1000, "last_ms": last*1000}
+            for name, (c, total, peak, last) in _stats.items()
+        }
+        return {"spans": spans, "counters": dict(_counters)}
+
+def reset():
+    with _lock:
+        _stats.clear()
+        _counters.clear()
+
+def overlay_text(names):
+    """one line with the last time of each span in names, for the status bar"""
+    with _lock:
+        parts = [f"{name} {_stats[name][3]*1000:.1f}ms" for name in names if name in _stats]
+        hits, misses = _counters.get("cache.hit", 0), _counters.get("cache.miss", 0)
+    if hits or misses:
+        parts.append(f"cache {hits}/{hits + misses}")
+    return "  |  ".join(parts)
@@ -0,0 +1,53 @@
+"""Mipmap pyramid of a QImage: level 0 is the image, every next level is half the size of the one before.
+Zoomed-out views sample from the nearest level above the display size instead of the full image."""
+import threading
+
+from PySide6.QtCore import Qt
+
+class ImagePyramid:
+    """Levels are built lazily (or all at once with build_all, e.g. on a worker thread).
+    Levels past level 0 are limited to max_bytes in total, deeper levels are skipped once that's reached"""
+    def __init__(self, image, max_bytes=256*1048576, min_size=64):
+        self.levels = [image]
+        self.max_bytes = max_bytes
+        self.min_size = min_size # no levels smaller than this on the short side
+        self.complete = False # True once no more levels can be built
+        self.lock = threading.Lock()
+
+    def _build_next(self):
+        """build one more level, returns False if there are no more to build. The lock is only held to read
+        and extend levels, not while scaling, so the paint thread never waits for a level it doesn't need"""
+        with self.lock:
+            if self.complete: return False
+            count = len(self.levels)
+            last = self.levels[-1]
+            width, height = last.width()//2, last.height()//2
+            next_bytes = width*height*last.depth()//8
+            if min(width, height) < self.min_size or self.extra_bytes() + next_bytes > self.max_bytes:
+                self.complete = True
+                return False
+        level = last.scaled(width, height, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        with self.lock:
+            if len(self.levels) == count: # another thread may have built it meanwhile
+                self.levels.append(level)
+        return True
+
+    def build_all(self):
+        while self._build_next(): pass
+
+    def level_for_scale(self, scale):
+        """smallest level that is still at least scale times the full size, builds it if needed"""
+        wanted = 0
+        while scale <= 0.5**(wanted+1): wanted += 1
+        while True:
+            with self.lock:
+                if len(self.levels) > wanted or self.complete:
+                    return self.levels[min(wanted, len(self.levels)-1)]
+            self._build_next()
+
+    def extra_bytes(self):
+        """memory used by the levels besides the full image"""
+        return sum(level.sizeInBytes() for level in self.levels[1:])
+
+    def status(self):
+        return f"{len(self.levels)} levels, {self.extra_bytes()/1048576:.1f}MB"
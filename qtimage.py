@@ -0,0 +1,11 @@
+"""numpy views of QImages, for the worker jobs and the widgets that hand Qt images to metrics.py"""
+import numpy as np
+from PySide6.QtGui import QImage
+
+def qimage_rgb(image):
+    """(height, width, 3) uint8 array over an RGB888 copy of image. Returns (array, copy).
+    The array doesn't keep the pixels alive, so hold on to the copy while the array is used"""
+    image = image.convertToFormat(QImage.Format_RGB888)
+    # rows can be padded, so view them at bytesPerLine and cut the padding off
+    rows = np.frombuffer(image.constBits(), np.uint8, count=image.sizeInBytes()).reshape(image.height(), image.bytesPerLine())
+    return rows[:, :image.width()*3].reshape(image.height(), image.width(), 3), image
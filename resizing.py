@@ -0,0 +1,96 @@
+"""Optional resize stage, applied to the decoded source before it is encoded.
+
+    resizing.Resize(max_width=1920)                  # fit in 1920 pixels wide
+    resizing.Resize(percent=50, filter="bicubic")    # half size
+    resizing.Resize(megapixels=2)                    # at most 2 million pixels
+
+Limits can be combined, the strictest one wins. Images are only ever made smaller and keep their
+aspect ratio. The resize runs on the pixels already decoded for the encoder, so there is no extra
+decode, encode or file in between.
+"""
+import math
+
+from PIL import Image
+
+FILTERS = {
+    "nearest": Image.Resampling.NEAREST,
+    "box": Image.Resampling.BOX,
+    "bilinear": Image.Resampling.BILINEAR,
+    "bicubic": Image.Resampling.BICUBIC,
+    "lanczos": Image.Resampling.LANCZOS,
+}
+
+# the same filters for ffmpeg's scale filter (-vf scale=w:h:flags=...)
+FFMPEG_FLAGS = {"nearest": "neighbor", "box": "area", "bilinear": "bilinear", "bicubic": "bicubic", "lanczos": "lanczos"}
+
+# Pillow first shrinks by whole factors with a fast box reduce while the image is more than this many times
+# the target size, then resamples the rest with the filter. 3 is practically the same as filtering all the way
+REDUCING_GAP = 3.0
+
+
+class Resize:
+    """Downscale limits, all optional (None). An empty Resize leaves images as they are and is falsy"""
+    def __init__(self, max_width=None, max_height=None, percent=None, megapixels=None, filter="lanczos"):
+        if filter not in FILTERS:
+            raise ValueError(f"Unknown filter {filter!r}, choose from: {', '.join(FILTERS)}")
+        for name, value in (("max_width", max_width), ("max_height", max_height), ("percent", percent), ("megapixels", megapixels)):
+            if value is not None and value <= 0:
+                raise ValueError(f"{name} must be above 0, not {value}")
+        self.max_width = max_width
+        self.max_height = max_height
+        self.percent = percent
+        self.megapixels = megapixels
+        self.filter = filter
+
+    @classmethod
+    def from_config(cls, configuration):
+        resize_config = configuration["resize"]
+        return cls(resize_config["max_width"], resize_config["max_height"], resize_config["percent"],
+                   resize_config["megapixels"], resize_config["filter"])
+
+    def __bool__(self):
+        return any(value is not None for value in (self.max_width, self.max_height, self.percent, self.megapixels))
+
+    def __repr__(self):
+        return (f"Resize(max_width={self.max_width}, max_height={self.max_height}, percent={self.percent}, "
+                f"megapixels={self.megapixels}, filter={self.filter!r})")
+
+    def scale_for(self, size):
+        """scale factor (at most 1) for an image of size (width, height)"""
+        width, height = size
+        scales = [1.0]
+        if self.max_width is not None: scales.append(self.max_width/width)
+        if self.max_height is not None: scales.append(self.max_height/height)
+        if self.percent is not None: scales.append(self.percent/100)
+        if self.megapixels is not None: scales.append(math.sqrt(self.megapixels*1e6/(width*height)))
+        return min(scales)
+
+    def target_size(self, size):
+        """(width, height) an image of size is resized to, size itself if it's within the limits"""
+        scale = self.scale_for(size)
+        if scale >= 1.0: return size
+        width, height = size
+        # floor, so the result never goes over max_width/max_height
+        return (max(1, math.floor(width*scale)), max(1, math.floor(height*scale)))
+
+    def apply(self, image, target_size=None):
+        """image (PIL) resized to target_size, by default the target size of the image itself.
+        Pass the target size of the original when image was decoded at a reduced size (Image.draft)"""
+        target_size = target_size or self.target_size(image.size)
+        if target_size == image.size: return image
+        reducing_gap = None if self.filter == "nearest" else REDUCING_GAP
+        return image.resize(target_size, FILTERS[self.filter], reducing_gap=reducing_gap)
+
+    def key(self):
+        """identifies the resize in cache keys, empty when nothing is resized"""
+        if not self: return ()
+        return ("resize", self.max_width, self.max_height, self.percent, self.megapixels, self.filter)
+
+    def describe(self):
+        """short text for the GUI and logs, e.g. "max 1920x-, lanczos" """
+        limits = []
+        if self.max_width is not None or self.max_height is not None:
+            limits.append(f"max {self.max_width or '-'}x{self.max_height or '-'}")
+        if self.percent is not None: limits.append(f"{self.percent:g}%")
+        if self.megapixels is not None: limits.append(f"{self.megapixels:g} MP")
+        return ", ".join(limits + [self.filter]) if limits else "original size"
@@ -0,0 +1,148 @@
+"""Search the compression value space for the best value that meets a goal, with as few encodes as possible."""
+import math
+import time
+
+import core
+import metrics
+
+QUALITY_METRICS = ("ssim", "psnr")
+
+class SearchResult:
+    """Outcome of a search. compression_value and scale are what to encode with, data is that encode"""
+    def __init__(self, compression_value, scale, data, fits, encodes, seconds, metrics=None):
+        self.compression_value = compression_value
+        self.scale = scale
+        self.data = data
+        self.size = len(data)
+        self.fits = fits # False if even the smallest setting tried misses the goal
+        self.encodes = encodes
+        self.seconds = seconds
+        self.metrics = metrics # metrics.Metrics of data, for quality searches
+
+    def __repr__(self):
+        return (f"SearchResult(compression_value={self.compression_value}, scale={self.scale:.3f}, size={self.size}, "
+                f"fits={self.fits}, encodes={self.encodes}, seconds={self.seconds:.3f}, metrics={self.metrics!r})")
+
+
+class Encodes:
+    """Memoized encodes of one source. Uses the encode cache too, if given"""
+    def __init__(self, encoder, cache=None, cancelled=None):
+        self.encoder = encoder
+        self.cache = cache
+        self.cancelled = cancelled
+        self.results = {} # (compression_value, scale) -> bytes
+        self.count = 0 # real encodes, not memo/cache hits
+
+    def __call__(self, compression_value, scale=1.0):
+        memo_key = (compression_value, round(scale, 4))
+        if memo_key in self.results:
+            return self.results[memo_key]
+        data, cached = core.encode(self.encoder, compression_value, self.cache, self.cancelled, scale)
+        if not cached:
+            self.count += 1
+        self.results[memo_key] = data
+        return data
+
+
+def bisect_values(fits, min_value, max_value):
+    """smallest value in [min_value, max_value] for which fits(value) is True,
+    assuming fits only turns from False to True as the value grows. None if max_value doesn't fit"""
+    if not fits(max_value): return None
+    low, high = min_value - 1, max_value # fits(low) is False (or below the range), fits(high) is True
+    while high - low > 1:
+        middle = (low + high)//2
+        if fits(middle): high = middle
+        else: low = middle
+    return high
+
+
+def find_value_for_size(encoder, max_bytes, min_value=None, max_value=None, allow_scaling=False, scale_value=None,
+                        min_scale=0.05, cache=None, cancelled=None):
+    """best (lowest) compression value whose output is at most max_bytes.
+
+    Bigger values give smaller files, so this is a bisection over min_value..max_value
+    (default the encoder's format range).
+    If even max_value is too big and allow_scaling is set, the image is downscaled at
+    scale_value (default max_value) and the largest scale that fits is searched.
+    """
+    start = time.perf_counter()
+    min_value = encoder.format.min_value if min_value is None else min_value
+    max_value = encoder.format.max_value if max_value is None else max_value
+    encode = Encodes(encoder, cache, cancelled)
+
+    value = bisect_values(lambda v: len(encode(v)) <= max_bytes, min_value, max_value)
+    if value is not None:
+        return SearchResult(value, 1.0, encode(value), True, encode.count, time.perf_counter() - start)
+    if not allow_scaling:
+        return SearchResult(max_value, 1.0, encode(max_value), False, encode.count, time.perf_counter() - start)
+
+    # size is roughly proportional to the pixel count, so start from sqrt of the size ratio and bisect from there
+    value = max_value if scale_value is None else scale_value
+    full_size = len(encode(value))
+    low, high = min_scale, 1.0 # fits(low) is assumed, high is known not to fit
+    scale = min(max(math.sqrt(max_bytes/full_size)*0.95, min_scale), 1.0)
+    best = None
+    for _ in range(8):
+        data = encode(value, scale)
+        if len(data) <= max_bytes:
+            best = (scale, data)
+            low = scale
+        else:
+            high = scale
+        if high - low < 0.01: break
+        scale = (low + high)/2
+    if best is None:
+        data = encode(value, min_scale)
+        return SearchResult(value, min_scale, data, len(data) <= max_bytes, encode.count, time.perf_counter() - start)
+    return SearchResult(value, best[0], best[1], True, encode.count, time.perf_counter() - start)
+
+
+def find_value_for_quality(encoder, metric, threshold, reference=None, min_value=None, max_value=None, cache=None, cancelled=None):
+    """highest compression value (smallest output) whose metric ("ssim" or "psnr") is at least threshold.
+
+    Quality only drops as the value grows, so this bisects for the first value under the threshold in
+    min_value..max_value (default the encoder's format range), about 5 encodes and measurements instead of 31 for jpeg.
+    reference is a metrics.Reference of the source, made from the encoder's input file if not given.
+    Measurements are kept in cache.metrics if cache is given.
+    If even min_value misses the threshold, that is returned with fits False.
+    """
+    if metric not in QUALITY_METRICS:
+        raise ValueError(f"Unknown metric {metric!r}, choose from: {', '.join(QUALITY_METRICS)}")
+    start = time.perf_counter()
+    min_value = encoder.format.min_value if min_value is None else min_value
+    max_value = encoder.format.max_value if max_value is None else max_value
+    encode = Encodes(encoder, cache, cancelled)
+    if reference is None:
+        reference = metrics.Reference(metrics.load(encoder.input_image), resize_filter=encoder.resize.filter)
+    measured = {}
+
+    def measure(value):
+        if value in measured: return measured[value]
+        key = result = None
+        if cache is not None:
+            key = cache.source_key(encoder.input_image) + encoder.settings_key(value)
+            result = cache.metrics.get(key)
+        if result is None:
+            result = reference.compare(metrics.decode(encode(value)))
+            encoder.check_cancelled(cancelled)
+            if cache is not None: cache.metrics.put(key, result)
+        measured[value] = result
+        return result
+
+    below = bisect_values(lambda v: getattr(measure(v), metric) < threshold, min_value, max_value)
+    if below is None: # even max_value is good enough
+        value, fits = max_value, True
+    elif below == min_value:
+        value, fits = min_value, False
+    else:
+        value, fits = below - 1, True
+    return SearchResult(value, 1.0, encode(value), fits, encode.count, time.perf_counter() - start, measure(value))
+
+
+def parse_size(text):
+    """"200KB", "1.5MB", "5000" (bytes) -> number of bytes"""
+    text = text.strip().upper().replace(" ", "")
+    for suffix, factor in (("MB", 1048576), ("KB", 1024), ("M", 1048576), ("K", 1024), ("B", 1)):
+        if text.endswith(suffix):
+            return int(float(text[:-len(suffix)])*factor)
+    return int(float(text))
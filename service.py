@@ -0,0 +1,427 @@
+"""Local compression service, HTTP on localhost or on a Unix socket, in front of core.py.
+
+    python -m compressor serve [--port 8765 | --socket /tmp/compressor.sock] [--workers 2] [--queue 32]
+
+POST /compress   body: the image bytes (Content-Length or chunked). Query: format, preset, q, encoder,
+                 max_width, max_height, scale (percent), megapixels, filter, exif and icc (keep or strip),
+                 lossless (1 for the lossless JPEG path), config.json for the rest.
+                 Returns the encoded bytes with X-Compression-Value, X-Input-Bytes, X-Encode-Ms and X-Lossless headers
+POST /batch      multipart/form-data body with one image per part, same query. Returns multipart/mixed,
+                 streamed (chunked) one part per image as soon as it is done. Parts have the input's file name
+                 with the new extension and an X-Status header (200, or 400 with X-Error)
+GET  /health     {"status": "ok", "workers": 2, "queued": 0, ...} as json
+GET  /metrics    request, image and byte counters, queue depth and encode time, in the Prometheus text format
+
+    curl --data-binary @shot.png "http://127.0.0.1:8765/compress?format=webp&max_width=1920" -o shot.webp
+    curl -F a=@one.png -F b=@two.png "http://127.0.0.1:8765/batch?q=9"
+    curl --unix-socket /tmp/compressor.sock http://localhost/health
+
+Images wait in a bounded queue for a fixed pool of encode threads (Pillow releases the GIL while it
+decodes, resizes and encodes). When the queue is full new requests get 429 with Retry-After right away,
+so callers back off instead of the service piling up uploads in memory. A batch is queued whole or not at all,
+one with more images than the queue holds gets 413.
+"""
+import json
+import os
+import queue
+import re
+import socketserver
+import threading
+import time
+import uuid
+from concurrent.futures import Future, as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from PIL import UnidentifiedImageError
+
+import core
+import perf
+import utils
+
+CHUNK = 65536
+# characters a client's file name loses before it goes back out in a Content-Disposition header
+UNSAFE_NAME_CHARACTERS = re.compile(r'[\x00-\x1f\x7f"\\;]')
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobQueue:
+    """Bounded queue with a fixed number of worker threads. submit() returns a concurrent.futures.Future
+    and raises QueueFull instead of waiting when there's no room"""
+    def __init__(self, workers=2, max_queued=32):
+        self.max_queued = max_queued
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.lock = threading.Lock() # so a batch is queued whole
+        self.busy = 0 # jobs running right now
+        self.threads = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit_all(self, calls):
+        """queue every (func, args) in calls, or none of them if they don't all fit. Returns their futures.
+        Raises ValueError if there are more calls than the queue holds, they would never fit"""
+        if len(calls) > self.max_queued:
+            raise ValueError(f"{len(calls)} jobs are more than the {self.max_queued} the queue holds")
+        with self.lock:
+            if self.max_queued - self.queue.qsize() < len(calls):
+                raise QueueFull(f"{self.queue.qsize()} of {self.max_queued} queue slots taken")
+            futures = []
+            for func, args in calls:
+                future = Future()
+                self.queue.put_nowait((future, func, args))
+                futures.append(future)
+        return futures
+
+    def submit(self, func, *args):
+        return self.submit_all([(func, args)])[0]
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None: break
+            future, func, args = job
+            if not future.set_running_or_notify_cancel(): continue
+            with self.lock: self.busy += 1
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self.lock: self.busy -= 1
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def close(self):
+        """let the workers finish the queued jobs and stop them"""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+class Stats:
+    """Counters for /metrics. add() is called from the request and worker threads"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {} # (name, labels) -> value
+
+    def add(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def prometheus(self, gauges):
+        """the counters and gauges ({name: value}) in the Prometheus text format"""
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+        for (name, labels), value in counters:
+            label_text = "{" + ",".join(f'{key}="{label}"' for key, label in labels) + "}" if labels else ""
+            lines.append(f"compressor_{name}{label_text} {round(value, 6)}")
+        for name, value in gauges.items():
+            lines.append(f"compressor_{name} {round(value, 6)}")
+        return "\n".join(lines) + "\n"
+
+
+def parse_settings(query, configuration):
+    """core.Settings from the query string ({name: [values]}), config.json for what it doesn't set.
+    Raises ValueError for unknown names, bad numbers or a value outside the format's range"""
+    def value(name, convert=str):
+        values = query.get(name)
+        return convert(values[-1]) if values else None
+    return core.Settings.from_config(
+        configuration, value("format"), value("preset"), value("q", int), value("encoder"),
+        exif=value("exif"), icc=value("icc"), lossless_jpeg=value("lossless", lambda text: text.lower() in ("1", "true", "yes")),
+        max_width=value("max_width", int), max_height=value("max_height", int), percent=value("scale", float),
+        megapixels=value("megapixels", float), filter=value("filter"))
+
+
+def parse_multipart(body, content_type):
+    """[(file name, bytes)] of the parts of a multipart/form-data body. File names are reduced to a base name
+    that is safe to send back in a header"""
+    match = re.search(r'boundary="?([^";]+)"?', content_type)
+    if match is None:
+        raise ValueError("multipart body without a boundary")
+    parts = []
+    for part in body.split(b"--" + match.group(1).encode())[1:]:
+        if part.startswith(b"--"): break # closing delimiter
+        headers, _, data = part.partition(b"\r\n\r\n")
+        name = re.search(rb'filename="([^"]*)"', headers) or re.search(rb'name="([^"]*)"', headers)
+        file_name = name.group(1).decode(errors="replace") if name else ""
+        # no folders, line breaks or quotes, they would end up in the response headers
+        file_name = UNSAFE_NAME_CHARACTERS.sub("_", file_name.replace("\\", "/").rsplit("/", 1)[-1]).strip(" .")
+        file_name = file_name or f"image{len(parts)}"
+        parts.append((file_name, data[:-2] if data.endswith(b"\r\n") else data))
+    return parts
+
+
+class CompressionService:
+    """The queue, the stats and the compress job, shared by all request handler threads"""
+    def __init__(self, configuration, workers=2, max_queued=32, max_upload_bytes=100*1048576, verbose=False):
+        self.configuration = configuration
+        self.jobs = JobQueue(workers, max_queued)
+        self.workers = workers
+        self.max_upload_bytes = max_upload_bytes
+        self.verbose = verbose
+        self.stats = Stats()
+
+    def compress(self, data, settings):
+        """job for the queue: compress data and count it"""
+        with perf.span("service.compress", format=settings.format.name, value=settings.compression_value):
+            try:
+                result = core.compress_bytes(data, settings)
+            except Exception:
+                self.stats.add("images_total", status="failed")
+                raise
+        self.stats.add("images_total", status="ok")
+        self.stats.add("input_bytes_total", result["in_bytes"])
+        self.stats.add("output_bytes_total", result["out_bytes"])
+        self.stats.add("encode_seconds_total", result["seconds"])
+        return result
+
+    def health(self):
+        return {
+            "status": "ok",
+            "workers": self.workers,
+            "busy": self.jobs.busy,
+            "queued": self.jobs.depth(),
+            "max_queued": self.jobs.max_queued,
+            "uptime_seconds": round(time.time() - self.stats.started, 1),
+        }
+
+    def metrics_text(self):
+        return self.stats.prometheus({
+            "queue_depth": self.jobs.depth(),
+            "queue_capacity": self.jobs.max_queued,
+            "workers": self.workers,
+            "workers_busy": self.jobs.busy,
+            "uptime_seconds": time.time() - self.stats.started,
+        })
+
+    def close(self):
+        self.jobs.close()
+
+
+def error_text(error):
+    if isinstance(error, UnidentifiedImageError):
+        return "not an image, or a format Pillow can't read"
+    return (str(error) or type(error).__name__).replace("\n", " ")
+
+
+class RequestError(Exception):
+    """ends a request with an HTTP error status"""
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive and chunked responses
+    server_version = "ImageCompressor"
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def log_message(self, format, *args):
+        if self.service.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        self.service.stats.add("requests_total", path=path)
+        if path == "/health":
+            self.send_bytes(200, json.dumps(self.service.health()).encode(), "application/json")
+        elif path == "/metrics":
+            self.send_bytes(200, self.service.metrics_text().encode(), "text/plain; version=0.0.4")
+        else:
+            self.send_error_text(404, f"Unknown path {path}")
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        self.service.stats.add("requests_total", path=url.path)
+        body = None
+        try:
+            if url.path not in ("/compress", "/batch"):
+                raise RequestError(404, f"Unknown path {url.path}")
+            # read the body first, a client still sending it wouldn't get the error
+            body = self.read_body()
+            try:
+                settings = parse_settings(parse_qs(url.query), self.service.configuration)
+            except ValueError as e:
+                raise RequestError(400, str(e))
+            if url.path == "/compress":
+                self.compress(body, settings)
+            else:
+                self.batch(body, settings)
+        except RequestError as e:
+            # an unread body would be taken for the next request on this connection
+            if body is None: self.close_connection = True
+            self.send_error_text(e.status, str(e))
+        except QueueFull as e:
+            self.service.stats.add("rejected_total")
+            self.send_error_text(429, f"Queue full ({e}), retry later", {"Retry-After": "1"})
+
+    def read_body(self):
+        """the request body, read in chunks from a Content-Length or chunked request, up to max_upload_bytes"""
+        limit = self.service.max_upload_bytes
+        body = bytearray()
+        if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+            while True:
+                try:
+                    size = int(self.rfile.readline().split(b";")[0].strip() or b"0", 16)
+                except ValueError:
+                    raise RequestError(400, "Malformed chunk size")
+                if size == 0:
+                    while self.rfile.readline() not in (b"\r\n", b"\n", b""): pass # trailers
+                    break
+                if len(body) + size > limit:
+                    raise RequestError(413, f"Upload over {utils.format_bytes(limit)}")
+                body += self.rfile.read(size)
+                self.rfile.readline() # the chunk's \r\n
+        else:
+            if "Content-Length" not in self.headers:
+                raise RequestError(411, "Content-Length or chunked Transfer-Encoding needed")
+            try:
+                remaining = int(self.headers["Content-Length"])
+            except ValueError:
+                raise RequestError(400, "Malformed Content-Length")
+            if remaining > limit:
+                raise RequestError(413, f"Upload over {utils.format_bytes(limit)}")
+            while remaining > 0:
+                chunk = self.rfile.read(min(CHUNK, remaining))
+                if not chunk: raise RequestError(400, "Body ended early")
+                body += chunk
+                remaining -= len(chunk)
+        if not body:
+            raise RequestError(400, "Empty body, send the image bytes")
+        return bytes(body)
+
+    def compress(self, body, settings):
+        future = self.service.jobs.submit(self.service.compress, body, settings)
+        try:
+            result = future.result()
+        except (OSError, ValueError) as e: # not an image, or one Pillow can't read
+            raise RequestError(400, f"Compression failed: {error_text(e)}")
+        except Exception as e:
+            raise RequestError(500, f"Compression failed: {e}")
+        self.send_response(200)
+        self.send_header("Content-Type", result["mime_type"])
+        self.send_header("Content-Length", str(result["out_bytes"]))
+        self.send_result_headers(result)
+        self.end_headers()
+        self.write_stream(result["data"])
+
+    def batch(self, body, settings):
+        try:
+            images = parse_multipart(body, self.headers.get("Content-Type", ""))
+        except ValueError as e:
+            raise RequestError(400, str(e))
+        if not images:
+            raise RequestError(400, "No images in the multipart body")
+        if len(images) > self.service.jobs.max_queued:
+            # it would never fit in the queue, retrying can't help
+            raise RequestError(413, f"{len(images)} images are more than the {self.service.jobs.max_queued} queued at most, split the batch")
+        futures = self.service.jobs.submit_all([(self.service.compress, (data, settings)) for _, data in images])
+        names = dict(zip(futures, (name for name, _ in images)))
+        self.service.stats.add("batch_images_total", len(images))
+
+        boundary = uuid.uuid4().hex
+        self.send_response(200)
+        self.send_header("Content-Type", f"multipart/mixed; boundary={boundary}")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for future in as_completed(futures):
+            name = os.path.basename(names[future])
+            try:
+                result = future.result()
+            except Exception as e:
+                headers = {"Content-Type": "text/plain", "X-Status": "400", "X-Error": error_text(e)}
+                self.write_part(boundary, name, headers, b"")
+                continue
+            name = os.path.splitext(name)[0]
+            headers = {"Content-Type": result["mime_type"], "X-Status": "200", "X-Compression-Value": result["compression_value"],
+                       "X-Input-Bytes": result["in_bytes"], "X-Encode-Ms": f"{result['seconds']*1000:.1f}",
+                       "X-Lossless": "1" if result["lossless"] else "0"}
+            self.write_part(boundary, name + result["extension"], headers, result["data"])
+        self.write_chunk(f"--{boundary}--\r\n".encode())
+        self.write_chunk(b"")
+
+    def write_part(self, boundary, file_name, headers, data):
+        head = f"--{boundary}\r\nContent-Disposition: attachment; filename=\"{file_name}\"\r\n"
+        head += "".join(f"{key}: {value}\r\n" for key, value in headers.items())
+        head += f"Content-Length: {len(data)}\r\n\r\n"
+        self.write_chunk(head.encode())
+        for start in range(0, len(data), CHUNK):
+            self.write_chunk(data[start:start + CHUNK])
+        self.write_chunk(b"\r\n")
+
+    def write_chunk(self, data):
+        """one chunk of a chunked response, b"" ends it"""
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+    def write_stream(self, data):
+        view = memoryview(data)
+        for start in range(0, len(view), CHUNK):
+            self.wfile.write(view[start:start + CHUNK])
+
+    def send_result_headers(self, result):
+        self.send_header("X-Compression-Value", str(result["compression_value"]))
+        self.send_header("X-Input-Bytes", str(result["in_bytes"]))
+        self.send_header("X-Encode-Ms", f"{result['seconds']*1000:.1f}")
+        self.send_header("X-Lossless", "1" if result["lossless"] else "0")
+
+    def send_bytes(self, status, data, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.write_stream(data)
+
+    def send_error_text(self, status, message, headers=None):
+        self.service.stats.add("errors_total", status=status)
+        self.send_bytes(status, (message + "\n").encode(), "text/plain; charset=utf-8", headers)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service, host="127.0.0.1", port=8765, socket_path=None):
+    """HTTP server for service on host:port, or on the Unix socket socket_path if given"""
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path) # left over from a server that didn't shut down cleanly
+        server = UnixHTTPServer(socket_path, Handler)
+    else:
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def serve(configuration, host="127.0.0.1", port=8765, socket_path=None, workers=2, max_queued=32, max_upload_mb=100, verbose=False):
+    """run the service until Ctrl+C"""
+    service = CompressionService(configuration, workers, max_queued, int(max_upload_mb*1048576), verbose)
+    server = make_server(service, host, port, socket_path)
+    where = socket_path if socket_path else f"http://{host}:{server.server_address[1]}"
+    print(f"Serving on {where} with {workers} workers and a queue of {max_queued}, Ctrl+C to stop")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    service.close()
+    if socket_path and os.path.exists(socket_path):
+        os.unlink(socket_path)
@@ -0,0 +1,96 @@
+"""The images open in the GUI at once, each with its own compression value.
+
+    images = session.Session()
+    images.add(["a.png", "b.png"])
+    images.set_value("a.png", 12)               # a.png keeps 12 while other images are shown
+    images.value_for("b.png", default=7)        # 7 until b.png gets a value of its own
+    images.apply_to_all(9)
+
+Format, preset, resize and metadata are the same for the whole session, only the compression value is
+per image. An image gets its value when it's encoded in the GUI, so it keeps the value it was last shown with.
+"""
+import os
+
+class SessionImage:
+    """One image of the session: path, own compression value (None until it has one) and the last export"""
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.in_bytes = os.path.getsize(path)
+        self.compression_value = None
+        self.out_bytes = None # size of the last export, None if it wasn't exported (or failed)
+        self.error = "" # why the last export failed
+
+    def saved_percent(self):
+        """how much smaller the last export is than the source, None before an export"""
+        if self.out_bytes is None or not self.in_bytes: return None
+        return (self.in_bytes - self.out_bytes)/self.in_bytes*100
+
+
+class Session:
+    """Ordered images by path, no path twice"""
+    def __init__(self):
+        self.images = []
+        self.positions = {} # absolute path -> index in images
+
+    def __len__(self):
+        return len(self.images)
+
+    @staticmethod
+    def _key(path):
+        return os.path.abspath(path)
+
+    def add(self, paths):
+        """add the files in paths that aren't in the session yet. Returns the added SessionImages"""
+        added = []
+        for path in paths:
+            if self._key(path) in self.positions or not os.path.isfile(path): continue
+            self.positions[self._key(path)] = len(self.images)
+            image = SessionImage(path)
+            self.images.append(image)
+            added.append(image)
+        return added
+
+    def remove(self, path):
+        """take path out of the session. Returns False if it wasn't in it"""
+        position = self.position(path)
+        if position is None: return False
+        del self.images[position]
+        self.positions = {self._key(image.path): i for i, image in enumerate(self.images)}
+        return True
+
+    def position(self, path):
+        """index of path in images, None if it isn't in the session"""
+        return self.positions.get(self._key(path))
+
+    def get(self, path):
+        position = self.position(path)
+        return self.images[position] if position is not None else None
+
+    def set_value(self, path, compression_value):
+        image = self.get(path)
+        if image is not None: image.compression_value = compression_value
+
+    def value_for(self, path, default):
+        """the image's own compression value, default if it has none"""
+        image = self.get(path)
+        if image is None or image.compression_value is None: return default
+        return image.compression_value
+
+    def apply_to_all(self, compression_value):
+        for image in self.images:
+            image.compression_value = compression_value
+
+    def reset_values(self):
+        """forget the per image values, e.g. when the format (and with it the value range) changes"""
+        self.apply_to_all(None)
+
+    def clear_results(self):
+        for image in self.images:
+            image.out_bytes = None
+            image.error = ""
+
+    def totals(self):
+        """(exported images, their source bytes, their output bytes)"""
+        exported = [image for image in self.images if image.out_bytes is not None]
+        return len(exported), sum(image.in_bytes for image in exported), sum(image.out_bytes for image in exported)
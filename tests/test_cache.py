@@ -0,0 +1,88 @@
+import os
+
+import cache
+
+
+def test_lru_evicts_least_recently_used():
+    lru = cache.LRUCache(10)
+    lru.put("a", b"aaaa")
+    lru.put("b", b"bbbb")
+    lru.get("a") # b is the least recently used now
+    lru.put("c", b"cccc")
+    assert "b" not in lru and lru.get("a") == b"aaaa" and lru.get("c") == b"cccc"
+    assert lru.evictions == 1
+
+
+def test_lru_byte_accounting():
+    lru = cache.LRUCache(100)
+    lru.put("a", b"x"*30)
+    lru.put("b", b"x"*20)
+    lru.put("a", b"x"*10) # replaced, not counted twice
+    assert lru.bytes == 30 and len(lru) == 2
+    lru.clear()
+    assert lru.bytes == 0 and len(lru) == 0
+
+
+def test_lru_custom_sizeof():
+    lru = cache.LRUCache(2, sizeof=lambda value: 1)
+    for key in "abc":
+        lru.put(key, object())
+    assert len(lru) == 2 and "a" not in lru
+
+
+def test_lru_oversize_put_drops_the_old_value():
+    lru = cache.LRUCache(10)
+    lru.put("a", b"old")
+    lru.put("a", b"x"*11)
+    assert lru.get("a") is None and lru.bytes == 0
+
+
+def test_disk_cache_trims_to_max_bytes(tmp_path):
+    disk = cache.DiskCache(str(tmp_path), 10)
+    disk.put("a", b"aaaa")
+    disk.put("b", b"bbbb")
+    disk.get("a")
+    disk.put("c", b"cccc")
+    assert disk.get("b") is None and disk.get("a") == b"aaaa" and disk.get("c") == b"cccc"
+    assert disk.bytes == 8 and len(os.listdir(tmp_path)) == 2
+
+
+def test_disk_cache_survives_restarts(tmp_path):
+    cache.DiskCache(str(tmp_path), 100).put("a", b"data")
+    reopened = cache.DiskCache(str(tmp_path), 100)
+    assert reopened.get("a") == b"data" and reopened.bytes == 4
+    assert cache.DiskCache(str(tmp_path), 2).bytes == 0 # trimmed to the new limit
+
+
+def test_disk_cache_oversize_put_drops_the_old_value(tmp_path):
+    disk = cache.DiskCache(str(tmp_path), 10)
+    disk.put("a", b"old")
+    disk.put("a", b"x"*11)
+    assert disk.get("a") is None and disk.bytes == 0 and not os.listdir(tmp_path)
+
+
+def test_encode_cache_source_keys(tmp_path):
+    path = tmp_path / "a.png"
+    path.write_bytes(b"one")
+    encode_cache = cache.EncodeCache(1000, 1000)
+    assert encode_cache.known_source_key(str(path)) is None
+    key = encode_cache.source_key(str(path))
+    assert encode_cache.known_source_key(str(path)) == key
+    copy = tmp_path / "b.png"
+    copy.write_bytes(b"one")
+    os.utime(copy, ns=(0, os.stat(path).st_mtime_ns))
+    assert encode_cache.source_key(str(copy)) == key # same content and mtime
+    os.utime(path, ns=(0, 12345))
+    assert encode_cache.source_key(str(path)) != key
+
+
+def test_encode_cache_levels(tmp_path):
+    encode_cache = cache.EncodeCache(1000, 1000, disk_bytes=1000, disk_dir=str(tmp_path))
+    encode_cache.put(("src", 5), b"jpeg", preview=b"pixels")
+    assert encode_cache.get_in_memory(("src", 5)) == (b"jpeg", b"pixels")
+    encode_cache.memory.clear()
+    assert encode_cache.get_in_memory(("src", 5)) is None
+    assert encode_cache.get(("src", 5)) == b"jpeg" # from disk, back in memory
+    assert encode_cache.get(("src", 6)) is None
+    stats = encode_cache.stats()
+    assert (stats["hits"], stats["disk_hits"], stats["misses"], stats["entries"]) == (2, 1, 1, 1)
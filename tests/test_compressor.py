@@ -0,0 +1,26 @@
+import os
+
+from PIL import Image
+
+import compressor
+
+
+def test_get_output_paths_tells_same_names_apart(tmp_path):
+    inputs = ["in/a.png", "in/a.jpg", "in/a-2.png", "other/a.webp", "in/b.png"]
+    paths = compressor.get_output_paths(inputs, "out", "*", ".webp")
+    assert [os.path.basename(path) for path in paths] == ["a.webp", "a-3.webp", "a-2.webp", "a-4.webp", "b.webp"]
+
+
+def test_batch_compress_same_names_and_a_missing_input(tmp_path):
+    inputs = []
+    for name, format in (("a.png", "PNG"), ("a.jpg", "JPEG")):
+        path = str(tmp_path / name)
+        Image.new("RGB", (40, 30), (10, 120, 200)).save(path, format)
+        inputs.append(path)
+    inputs.append(str(tmp_path / "gone.png")) # deleted before its job ran
+    results = compressor.batch_compress(inputs, str(tmp_path / "out"), "*", 10, workers=2, format="webp", with_metrics=True)
+    by_input = {os.path.basename(result["input"]): result for result in results}
+    assert not by_input["gone.png"]["ok"] and by_input["gone.png"]["error"]
+    assert by_input["a.png"]["ok"] and by_input["a.jpg"]["ok"]
+    assert by_input["a.png"]["output"] != by_input["a.jpg"]["output"]
+    assert sorted(os.listdir(tmp_path / "out")) == ["a-2.webp", "a.webp"]
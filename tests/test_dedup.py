@@ -0,0 +1,132 @@
+import os
+import time
+
+import pytest
+
+import dedup
+import utils
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = dedup.DedupStore(str(tmp_path / "store"))
+    yield store
+    store.close()
+
+
+def write(path, data):
+    with open(path, "wb") as file:
+        file.write(data)
+    return str(path)
+
+
+def test_source_hash_is_remembered(store, tmp_path):
+    path = write(tmp_path / "a.png", b"one")
+    first = store.source_hash(path)
+    assert store.source_hash(path) == first
+    os.utime(path, ns=(time.time_ns(), time.time_ns() + 10**9))
+    write(path, b"two") # same size, new mtime
+    assert store.source_hash(path) != first
+
+
+def test_lookup_add(store):
+    assert store.lookup("src", "settings") is None
+    blob = store.add("src", "settings", b"output")
+    assert store.lookup("src", "settings") == blob
+    assert store.lookup("src", "other settings") is None
+    with open(blob, "rb") as file:
+        assert file.read() == b"output"
+    assert store.stats()["hits"] == 1
+
+
+def test_identical_outputs_share_a_blob(store):
+    assert store.add("a", "s", b"same") == store.add("b", "s", b"same")
+    assert store.stats()["blobs"] == 1
+
+
+def test_lookup_of_a_deleted_blob(store):
+    blob = store.add("src", "settings", b"output")
+    os.chmod(blob, 0o644)
+    os.remove(blob)
+    assert store.lookup("src", "settings") is None
+    assert store.stats()["entries"] == 0
+
+
+@pytest.mark.parametrize("link_mode", ["auto", "hardlink", "copy"])
+def test_link(tmp_path, link_mode):
+    store = dedup.DedupStore(str(tmp_path / "store"), link_mode)
+    blob = store.add("src", "settings", b"output")
+    output = str(tmp_path / "out.webp")
+    assert store.link(blob, output) in dedup.LINK_ORDER[link_mode]
+    assert store.link(blob, output) in ("linked", "copy")
+    with open(output, "rb") as file:
+        assert file.read() == b"output"
+    store.close()
+
+
+def test_writing_a_linked_output_keeps_the_blob(tmp_path):
+    store = dedup.DedupStore(str(tmp_path / "store"), "hardlink")
+    blob = store.add("src", "settings", b"output")
+    output = str(tmp_path / "out.webp")
+    store.link(blob, output)
+    utils.write_file(output, b"something else")
+    with open(blob, "rb") as file:
+        assert file.read() == b"output"
+    store.close()
+
+
+def test_gc(store, tmp_path):
+    old = store.add("old", "s", b"old output")
+    new = store.add("new", "s", b"new output")
+    store.db.execute("UPDATE entries SET last_used = 0 WHERE source = 'old'")
+    source = write(tmp_path / "gone.png", b"x")
+    store.source_hash(source)
+    os.remove(source)
+    removed = store.gc(older_than=3600)
+    assert removed["entries"] == 1 and removed["blobs"] == 1 and removed["sources"] == 1
+    assert not os.path.exists(old) and os.path.exists(new)
+
+
+def test_gc_max_bytes_drops_least_recently_used(store):
+    store.add("a", "s", b"a"*100)
+    store.add("b", "s", b"b"*100)
+    store.db.execute("UPDATE entries SET last_used = 0 WHERE source = 'a'")
+    store.gc(max_bytes=150)
+    assert store.lookup("a", "s") is None and store.lookup("b", "s") is not None
+
+
+def test_unknown_link_mode(tmp_path):
+    with pytest.raises(ValueError):
+        dedup.DedupStore(str(tmp_path / "store"), "symlink")
+
+
+def test_gc_max_bytes_counts_shared_blobs_once(store):
+    store.add("a", "s", b"a"*100)
+    store.add("b", "s", b"a"*100) # same output, the same blob
+    store.add("c", "s", b"c"*100)
+    store.db.execute("UPDATE entries SET last_used = 0 WHERE source = 'c'")
+    store.gc(max_bytes=150)
+    assert store.lookup("a", "s") is not None and store.lookup("b", "s") is not None
+    assert store.lookup("c", "s") is None
+
+
+def test_gc_leaves_recent_temporary_files(store):
+    blob = store.add("src", "s", b"output")
+    fresh, stale = blob + ".1.1.tmp", blob + ".2.2.tmp"
+    write(fresh, b"half writ")
+    write(stale, b"half")
+    os.utime(stale, (time.time() - dedup.TMP_GRACE - 60,)*2)
+    removed = store.gc()
+    assert removed["blobs"] == 1 and removed["blob_bytes"] == 4
+    assert os.path.exists(fresh) and not os.path.exists(stale) and os.path.exists(blob)
+
+
+def test_link_failure_raises_the_linker_error(tmp_path, monkeypatch):
+    store = dedup.DedupStore(str(tmp_path / "store"), "copy")
+    blob = store.add("src", "settings", b"output")
+    def fail(source, destination):
+        raise PermissionError("no copies today")
+    monkeypatch.setitem(dedup.LINKERS, "copy", fail)
+    with pytest.raises(PermissionError, match="no copies today"):
+        store.link(blob, str(tmp_path / "out.webp"))
+    store.close()
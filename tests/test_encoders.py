@@ -0,0 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import encoders
+
+
+def test_parallel_encodes_of_one_encoder(tmp_path):
+    path = str(tmp_path / "source.png")
+    Image.effect_noise((256, 192), 60).convert("RGB").save(path)
+    encoder = encoders.get_encoder(encoders.PillowEncoder.name, path, None, "jpeg", "balanced")
+    values = [2, 9, 17, 31]*4
+    expected = {value: encoder.encode(value) for value in set(values)}
+    with ThreadPoolExecutor(8) as executor:
+        assert list(executor.map(encoder.encode, values)) == [expected[value] for value in values]
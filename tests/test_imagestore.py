@@ -0,0 +1,37 @@
+import random
+
+import pytest
+from PIL import Image, ImageOps
+
+import imagestore
+import metadata
+
+
+def noise(size):
+    img = Image.new("RGB", size)
+    img.putdata([tuple(random.randrange(256) for _ in range(3)) for _ in range(size[0]*size[1])])
+    return img
+
+
+@pytest.mark.parametrize("orientation", range(1, 9))
+def test_decode_turns_upright(tmp_path, orientation):
+    path = str(tmp_path / "photo.png")
+    exif = Image.Exif()
+    exif[metadata.ORIENTATION] = orientation
+    noise((37, 23)).save(path, exif=exif)
+    store = imagestore.ImageStore(mmap_threshold=0 if orientation % 2 else 1 << 30) # mmap for half of them
+    decoded = store.get(path)
+    with Image.open(path) as img:
+        expected = ImageOps.exif_transpose(img).convert("RGB")
+    assert decoded.size == expected.size
+    assert decoded.pil_image().tobytes() == expected.tobytes()
+
+
+@pytest.mark.parametrize("orientation", range(1, 9))
+def test_source_box(orientation):
+    img = noise((37, 23))
+    upright = metadata.apply_orientation(img, orientation)
+    width, height = upright.size
+    for top, bottom in ((0, 5), (5, 17), (17, height)):
+        band = img.crop(imagestore.source_box(img.size, orientation, top, bottom))
+        assert metadata.apply_orientation(band, orientation).tobytes() == upright.crop((0, top, width, bottom)).tobytes()
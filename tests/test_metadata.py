@@ -0,0 +1,84 @@
+import io
+
+import pytest
+from PIL import Image, ImageCms
+
+import metadata
+
+KEEP_ALL = metadata.MetadataPolicy(exif="keep", icc="keep")
+STRIP_ALL = metadata.MetadataPolicy(exif="strip", icc="strip")
+
+
+def jpeg(mode="RGB", orientation=None, icc=True, comment=b"hello"):
+    exif = Image.Exif()
+    exif[0x010F] = "Camera maker"
+    if orientation is not None:
+        exif[metadata.ORIENTATION] = orientation
+    options = {"exif": exif, "comment": comment}
+    if icc:
+        options["icc_profile"] = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+    output = io.BytesIO()
+    Image.new(mode, (32, 24), (10, 20, 30) if mode == "RGB" else (10, 20, 30, 40)).save(output, "JPEG", **options)
+    return output.getvalue()
+
+
+def markers(data):
+    return [marker for marker, _ in metadata.jpeg_segments(data)]
+
+
+def image_data(data):
+    """the compressed image data, from the SOS marker on"""
+    return list(metadata.jpeg_segments(data))[-1][1]
+
+
+def test_keep_all_is_unchanged():
+    data = jpeg(orientation=6)
+    assert metadata.filter_jpeg(data, KEEP_ALL) == data
+
+
+def test_strip_keeps_jfif_and_image_data():
+    data = jpeg()
+    stripped = metadata.filter_jpeg(data, STRIP_ALL)
+    assert metadata.APP0 in markers(stripped)
+    assert not {metadata.APP1, metadata.APP2, metadata.COM} & set(markers(stripped))
+    assert image_data(stripped) == image_data(data)
+    with Image.open(io.BytesIO(stripped)) as img:
+        assert img.tobytes() == Image.open(io.BytesIO(data)).tobytes()
+
+
+def test_adobe_segment_is_kept():
+    data = jpeg("CMYK") # Pillow writes an Adobe APP14 segment for CMYK
+    assert metadata.APP14 in markers(data)
+    assert metadata.APP14 in markers(metadata.filter_jpeg(data, STRIP_ALL))
+
+
+@pytest.mark.parametrize("icc", ["keep", "strip"])
+def test_icc_policy(icc):
+    output = metadata.filter_jpeg(jpeg(), metadata.MetadataPolicy(exif="strip", icc=icc))
+    with Image.open(io.BytesIO(output)) as img:
+        assert bool(img.info.get("icc_profile")) == (icc == "keep")
+        assert not img.getexif() and "comment" not in img.info
+
+
+def test_stripped_exif_keeps_the_orientation():
+    output = metadata.filter_jpeg(jpeg(orientation=6), STRIP_ALL)
+    with Image.open(io.BytesIO(output)) as img:
+        assert dict(img.getexif()) == {metadata.ORIENTATION: 6}
+    assert markers(output)[:2] == [metadata.APP0, metadata.APP1] # right after JFIF
+
+
+def test_upright_source_gets_no_exif():
+    assert metadata.APP1 not in markers(metadata.filter_jpeg(jpeg(orientation=1), STRIP_ALL))
+
+
+def test_corrupt_marker():
+    data = jpeg()
+    jfif = next(segment for marker, segment in metadata.jpeg_segments(data) if marker == metadata.APP0)
+    corrupt = b"\xff\xd8" + jfif + b"\x00\x00garbage" + image_data(data) # no marker after JFIF
+    with pytest.raises(ValueError, match="Corrupt JPEG"):
+        metadata.filter_jpeg(corrupt, STRIP_ALL, orientation=1)
+
+
+def test_not_a_jpeg():
+    with pytest.raises(ValueError, match="Not a JPEG"):
+        metadata.filter_jpeg(b"\x89PNG\r\n\x1a\n", STRIP_ALL, orientation=1)
@@ -0,0 +1,99 @@
+import math
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import metrics
+
+
+def gradient(width, height):
+    """smooth RGB test image with values in 20..235, so small offsets don't clip"""
+    x = np.linspace(20, 235, width, dtype=np.float32)
+    y = np.linspace(20, 235, height, dtype=np.float32)
+    return np.stack([np.add.outer(y, x)/2, np.tile(x, (height, 1)), np.tile(y[:, None], (1, width))], axis=-1).astype(np.uint8)
+
+
+def test_identical_images():
+    image = gradient(300, 200)
+    result = metrics.compare(image, image.copy())
+    assert math.isinf(result.psnr)
+    assert result.ssim == pytest.approx(1.0)
+    assert result.worst == 0
+    assert result.factor == 1
+
+
+def test_psnr_of_a_known_error():
+    image = gradient(300, 200)
+    # every channel of every pixel off by 5, an MSE of 25
+    result = metrics.compare(image, image + 5)
+    assert result.psnr == pytest.approx(10*math.log10(255**2/25), abs=1e-4)
+    assert result.ssim < 1
+
+
+def test_psnr_of_noise():
+    rng = np.random.default_rng(1)
+    image = gradient(400, 300)
+    noisy = (image + rng.choice([-3, 3], size=image.shape)).astype(np.uint8)
+    result = metrics.compare(image, noisy)
+    assert result.psnr == pytest.approx(10*math.log10(255**2/9), abs=1e-4)
+
+
+def test_ssim_drops_with_the_error():
+    rng = np.random.default_rng(2)
+    image = gradient(256, 256)
+    scores = [metrics.compare(image, np.clip(image + rng.normal(0, sigma, image.shape), 0, 255).astype(np.uint8)).ssim
+              for sigma in (1, 4, 16)]
+    assert 1 > scores[0] > scores[1] > scores[2]
+
+
+def test_tiles_agree_with_box_on_large_images():
+    image = gradient(3000, 2000)
+    # an error that varies slowly over the image, which sampling and reducing both see the same way
+    error = np.linspace(-6, 6, 3000, dtype=np.float32)[None, :, None]
+    compressed = np.clip(image + error, 0, 255).astype(np.uint8)
+    tiles = metrics.compare(image, compressed, mode="tiles")
+    box = metrics.compare(image, compressed, mode="box")
+    full = metrics.compare(image, compressed, max_pixels=image.shape[0]*image.shape[1])
+    assert tiles.factor == box.factor == 2 and full.factor == 1
+    assert tiles.psnr == pytest.approx(full.psnr, abs=0.5)
+    assert box.psnr == pytest.approx(full.psnr, abs=0.5)
+    assert tiles.ssim == pytest.approx(box.ssim, abs=0.01)
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        metrics.Reference(gradient(64, 64), mode="median")
+
+
+def test_worst_area():
+    flat = np.full((64, 64), 100, dtype=np.float32)
+    assert metrics.worst_area(flat, flat) == 0
+    assert metrics.worst_area(flat, flat + 4) == pytest.approx(4)
+    # the same error is masked in a busy area
+    busy = np.where(np.indices((64, 64)).sum(axis=0) % 2 == 0, 60, 140).astype(np.float32)
+    assert metrics.worst_area(busy, busy + 4) < 4
+    # smaller than a block, the plain RMS error
+    assert metrics.worst_area(flat[:4, :4], flat[:4, :4] + 3) == pytest.approx(3)
+
+
+def test_error_heatmap():
+    source = np.full((4, 6, 3), 100, dtype=np.uint8)
+    compressed = source.copy()
+    compressed[0, 0, 1] = 140 # past max_error
+    compressed[1, 1, 2] = 102 # small
+    heatmap = metrics.error_heatmap(source, compressed, max_error=32)
+    assert heatmap.shape == (4, 6, 3) and heatmap.dtype == np.uint8
+    assert (heatmap[2:] == 0).all()
+    assert tuple(heatmap[0, 0]) == (255, 255, 230)
+    assert 0 < heatmap[1, 1].max() < 255
+
+
+def test_compare_resizes_the_source():
+    image = gradient(400, 300)
+    reference = metrics.Reference(image)
+    half = np.asarray(Image.fromarray(image).resize((200, 150), Image.LANCZOS))
+    assert reference.compare(half).psnr > 40
+    assert reference.resized_to((150, 200)) is reference.resized_to((150, 200))
+    with pytest.raises(ValueError):
+        reference.resized_to((150, 300))
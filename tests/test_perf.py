@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+import perf
+
+
+@pytest.fixture(autouse=True)
+def clean_perf():
+    perf.reset()
+    yield
+    perf.configure(False)
+    perf.reset()
+
+
+def test_disabled_does_nothing(tmp_path):
+    perf.configure(False, str(tmp_path / "trace.jsonl"))
+    with perf.span("encode", value=7):
+        pass
+    perf.count("cache.hit")
+    perf.record("decode", 0.5)
+    assert perf.snapshot() == {"spans": {}, "counters": {}}
+    assert perf.span("a") is perf.span("b") # one shared no-op object
+    assert not (tmp_path / "trace.jsonl").exists()
+
+
+def test_spans_and_counters():
+    perf.configure(True)
+    for seconds in (0.002, 0.004):
+        perf.record("encode", seconds)
+    with perf.span("decode"):
+        pass
+    perf.count("cache.hit")
+    perf.count("cache.hit", 2)
+    snapshot = perf.snapshot()
+    encode = snapshot["spans"]["encode"]
+    assert encode["count"] == 2 and encode["last_ms"] == pytest.approx(4)
+    assert encode["mean_ms"] == pytest.approx(3) and encode["max_ms"] == pytest.approx(4)
+    assert snapshot["spans"]["decode"]["count"] == 1
+    assert snapshot["counters"] == {"cache.hit": 3}
+
+
+def test_trace_file(tmp_path):
+    trace = tmp_path / "trace.jsonl"
+    perf.configure(True, str(trace))
+    with perf.span("encode", value=7):
+        pass
+    perf.set_enabled(False)
+    perf.set_enabled(True) # the trace file is kept
+    perf.record("decode", 0.001)
+    perf.configure(False)
+    entries = [json.loads(line) for line in trace.read_text().splitlines()]
+    assert [entry["name"] for entry in entries] == ["encode", "decode"]
+    assert entries[0]["value"] == 7
+
+
+def test_overlay_text():
+    perf.configure(True)
+    perf.record("encode", 0.0125)
+    perf.count("cache.hit")
+    perf.count("cache.miss", 3)
+    assert perf.overlay_text(("encode", "open")) == "encode 12.5ms  |  cache 1/4"
+    perf.reset()
+    assert perf.overlay_text(("encode",)) == ""
@@ -0,0 +1,17 @@
+import threading
+
+from PySide6.QtGui import QImage
+
+import pyramid
+
+
+def test_levels_while_building_on_another_thread():
+    image = QImage(2000, 1500, QImage.Format_RGB888)
+    image.fill(0x336699)
+    levels = pyramid.ImagePyramid(image, min_size=64)
+    builder = threading.Thread(target=levels.build_all)
+    builder.start()
+    assert levels.level_for_scale(0.3).width() == 1000
+    assert levels.level_for_scale(0.1).width() == 250
+    builder.join()
+    assert [level.width() for level in levels.levels] == [2000, 1000, 500, 250, 125]
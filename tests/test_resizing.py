@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+import resizing
+
+
+def noise_image(width, height):
+    return Image.fromarray(np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8))
+
+
+def test_empty_resize():
+    resize = resizing.Resize()
+    assert not resize
+    assert resize.key() == ()
+    assert resize.target_size((4000, 3000)) == (4000, 3000)
+    assert resize.describe() == "original size"
+    image = noise_image(40, 30)
+    assert resize.apply(image) is image
+
+
+def test_target_size():
+    assert resizing.Resize(max_width=1920).target_size((4000, 3000)) == (1920, 1440)
+    assert resizing.Resize(max_height=1000).target_size((4000, 3000)) == (1333, 1000)
+    assert resizing.Resize(percent=50).target_size((4001, 3001)) == (2000, 1500)
+    # the strictest limit wins
+    assert resizing.Resize(max_width=1920, percent=25).target_size((4000, 3000)) == (1000, 750)
+    # never made larger
+    assert resizing.Resize(max_width=8000, percent=100).target_size((4000, 3000)) == (4000, 3000)
+    # and never below one pixel
+    assert resizing.Resize(max_width=10).target_size((4000, 3)) == (10, 1)
+
+
+def test_target_size_stays_within_the_limits():
+    for size in ((4000, 3000), (3333, 2222), (1001, 999), (7, 5000)):
+        for max_width in (1, 99, 640, 1919):
+            width, height = resizing.Resize(max_width=max_width).target_size(size)
+            assert width <= max_width
+        for megapixels in (0.3, 1, 2.5):
+            width, height = resizing.Resize(megapixels=megapixels).target_size(size)
+            assert width*height <= megapixels*1e6
+
+
+def test_invalid_limits():
+    with pytest.raises(ValueError):
+        resizing.Resize(filter="gaussian")
+    with pytest.raises(ValueError):
+        resizing.Resize(max_width=0)
+    with pytest.raises(ValueError):
+        resizing.Resize(percent=-50)
+
+
+def test_every_filter_has_an_ffmpeg_flag():
+    assert resizing.FFMPEG_FLAGS.keys() == resizing.FILTERS.keys()
+
+
+def test_apply_uses_the_filter_and_reducing_gap():
+    image = noise_image(400, 300)
+    for name, pillow_filter in resizing.FILTERS.items():
+        result = resizing.Resize(percent=20, filter=name).apply(image)
+        assert result.size == (80, 60)
+        reducing_gap = None if name == "nearest" else resizing.REDUCING_GAP
+        assert np.array_equal(np.asarray(result), np.asarray(image.resize((80, 60), pillow_filter, reducing_gap=reducing_gap)))
+
+
+def test_apply_to_a_reduced_decode():
+    # an image decoded at half size (Image.draft) still ends up at the target size of the original
+    resize = resizing.Resize(max_width=100)
+    target = resize.target_size((400, 300))
+    assert resize.apply(noise_image(200, 150), target).size == target == (100, 75)
+
+
+def test_key_and_describe():
+    resize = resizing.Resize(max_width=1920, megapixels=2, filter="bicubic")
+    assert resize.key() == ("resize", 1920, None, None, 2, "bicubic")
+    assert resize.key() != resizing.Resize(max_width=1920, megapixels=2).key()
+    assert resize.describe() == "max 1920x-, 2 MP, bicubic"
+    assert resizing.Resize(percent=50).describe() == "50%, lanczos"
+
+
+def test_from_config():
+    configuration = {"resize": {"max_width": None, "max_height": 1080, "percent": None, "megapixels": None, "filter": "box"}}
+    resize = resizing.Resize.from_config(configuration)
+    assert resize.max_height == 1080 and resize.filter == "box"
+    assert resize.target_size((3840, 2160)) == (1920, 1080)
@@ -0,0 +1,17 @@
+import pytest
+
+import search
+
+
+@pytest.mark.parametrize("threshold", [0, 1, 7, 29, 30])
+def test_bisect_values_finds_the_smallest_fitting_value(threshold):
+    calls = []
+    def fits(value):
+        calls.append(value)
+        return value >= threshold
+    assert search.bisect_values(fits, 1, 30) == max(threshold, 1)
+    assert len(calls) <= 6 # log2 of the range, plus the max_value check
+
+
+def test_bisect_values_when_nothing_fits():
+    assert search.bisect_values(lambda value: False, 1, 30) is None
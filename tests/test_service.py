@@ -0,0 +1,165 @@
+import http.client
+import io
+import os
+import threading
+
+import pytest
+from PIL import Image
+
+import compressor
+import service
+
+
+def png_bytes(size=(64, 48)):
+    output = io.BytesIO()
+    Image.new("RGB", size, (200, 40, 90)).save(output, "PNG")
+    return output.getvalue()
+
+
+@pytest.fixture
+def server(tmp_path):
+    """a service on a free localhost port, with a queue of 4"""
+    configuration = compressor.load_config(str(tmp_path)) # the defaults, not the user's config.json
+    compression_service = service.CompressionService(configuration, workers=1, max_queued=4)
+    http_server = service.make_server(compression_service, port=0)
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    yield http_server
+    http_server.shutdown()
+    http_server.server_close()
+    compression_service.close()
+
+
+def request(server, method, path, body=None, headers=None):
+    connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=30)
+    connection.request(method, path, body, headers or {})
+    response = connection.getresponse()
+    data = response.read()
+    connection.close()
+    return response, data
+
+
+def send_raw(server, data):
+    """status code of the response to the raw request bytes"""
+    connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=30)
+    connection.connect()
+    connection.sock.sendall(data)
+    response = http.client.HTTPResponse(connection.sock, method="POST")
+    response.begin()
+    response.read()
+    connection.close()
+    return response.status
+
+
+def test_queue_runs_jobs():
+    jobs = service.JobQueue(workers=2, max_queued=4)
+    futures = jobs.submit_all([(pow, (2, n)) for n in range(4)])
+    assert [future.result(timeout=10) for future in futures] == [1, 2, 4, 8]
+    jobs.close()
+
+
+def test_queue_takes_a_batch_whole_or_not_at_all():
+    jobs = service.JobQueue(workers=1, max_queued=3)
+    started, release = threading.Event(), threading.Event()
+    def blocking():
+        started.set()
+        release.wait(10)
+    running = jobs.submit(blocking)
+    started.wait(10) # the worker holds it, the queue is empty again
+    jobs.submit_all([(int, ()), (int, ())])
+    with pytest.raises(service.QueueFull):
+        jobs.submit_all([(int, ()), (int, ())]) # 1 slot left for 2 jobs
+    assert jobs.depth() == 2
+    jobs.submit(int) # the last slot is still free
+    release.set()
+    running.result(timeout=10)
+    jobs.close()
+
+
+def test_queue_rejects_a_batch_larger_than_the_queue():
+    jobs = service.JobQueue(workers=1, max_queued=2)
+    with pytest.raises(ValueError):
+        jobs.submit_all([(int, ())]*3)
+    jobs.close()
+
+
+def test_parse_multipart():
+    body = (b"--xyz\r\n"
+            b'Content-Disposition: form-data; name="a"; filename="one.png"\r\n'
+            b"Content-Type: image/png\r\n\r\n"
+            b"first\r\n\r\nbytes\r\n"
+            b"--xyz\r\n"
+            b'Content-Disposition: form-data; name="b"\r\n\r\n'
+            b"second\r\n"
+            b"--xyz--\r\n")
+    parts = service.parse_multipart(body, 'multipart/form-data; boundary="xyz"')
+    assert parts == [("one.png", b"first\r\n\r\nbytes"), ("b", b"second")]
+
+
+def test_parse_multipart_file_names():
+    body = (b"--xyz\r\n"
+            b'Content-Disposition: form-data; name="a"; filename="C:\\photos\\one.png"\r\n\r\n1\r\n'
+            b"--xyz\r\n"
+            b'Content-Disposition: form-data; name="b"; filename="../two\r\nX-Injected: 1.png"\r\n\r\n2\r\n'
+            b"--xyz\r\n"
+            b'Content-Disposition: form-data; name="c"; filename="/.."\r\n\r\n3\r\n'
+            b"--xyz--\r\n")
+    names = [name for name, _ in service.parse_multipart(body, "multipart/form-data; boundary=xyz")]
+    assert names == ["one.png", "two__X-Injected: 1.png", "image2"]
+
+
+def test_parse_multipart_without_boundary():
+    with pytest.raises(ValueError):
+        service.parse_multipart(b"", "multipart/form-data")
+
+
+@pytest.mark.parametrize("query", [{"format": ["nope"]}, {"q": ["high"]}, {"q": ["999"]}])
+def test_parse_settings_rejects(query, tmp_path):
+    with pytest.raises(ValueError):
+        service.parse_settings(query, compressor.load_config(str(tmp_path)))
+
+
+def test_compress(server):
+    response, data = request(server, "POST", "/compress?format=webp", png_bytes())
+    assert response.status == 200
+    assert Image.open(io.BytesIO(data)).size == (64, 48)
+    assert int(response.headers["X-Input-Bytes"]) > 0
+
+
+def test_compress_chunked(server):
+    data = png_bytes()
+    chunks = b"".join(b"%x\r\n%s\r\n" % (len(data[i:i + 100]), data[i:i + 100]) for i in range(0, len(data), 100))
+    status = send_raw(server, b"POST /compress HTTP/1.1\r\nHost: x\r\nTransfer-Encoding: chunked\r\n\r\n" + chunks + b"0\r\n\r\n")
+    assert status == 200
+
+
+def test_malformed_chunk_size(server):
+    status = send_raw(server, b"POST /compress HTTP/1.1\r\nHost: x\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\nabc\r\n0\r\n\r\n")
+    assert status == 400
+
+
+def test_bad_query_is_answered_after_the_body(server):
+    # a large body, the error comes once it's read instead of breaking the upload
+    response, data = request(server, "POST", "/compress?q=999", os.urandom(8*1048576))
+    assert response.status == 400
+    assert data.strip()
+
+
+def test_batch(server):
+    body = b"".join(b'--b\r\nContent-Disposition: form-data; name="f"; filename="%d.png"\r\n\r\n%s\r\n' % (n, png_bytes())
+                    for n in range(2)) + b"--b--\r\n"
+    response, data = request(server, "POST", "/batch", body, {"Content-Type": "multipart/form-data; boundary=b"})
+    assert response.status == 200
+    assert data.count(b"X-Status: 200") == 2
+
+
+def test_batch_larger_than_the_queue(server):
+    body = b"".join(b'--b\r\nContent-Disposition: form-data; name="f"; filename="%d.png"\r\n\r\n%s\r\n' % (n, png_bytes())
+                    for n in range(5)) + b"--b--\r\n"
+    response, _ = request(server, "POST", "/batch", body, {"Content-Type": "multipart/form-data; boundary=b"})
+    assert response.status == 413
+
+
+def test_health(server):
+    response, data = request(server, "GET", "/health")
+    assert response.status == 200 and b'"max_queued": 4' in data
@@ -0,0 +1,16 @@
+import session
+
+
+def test_remove_keeps_positions(tmp_path):
+    paths = []
+    for name in ("a.png", "b.png", "c.png"):
+        path = tmp_path / name
+        path.write_bytes(b"x")
+        paths.append(str(path))
+    images = session.Session()
+    images.add(paths)
+    images.set_value(paths[2], 5)
+    assert images.remove(paths[1])
+    assert not images.remove(paths[1])
+    assert [image.name for image in images.images] == ["a.png", "c.png"]
+    assert images.position(paths[2]) == 1 and images.value_for(paths[2], 0) == 5
@@ -0,0 +1,71 @@
+import math
+
+import tiles
+
+
+def grid(image_size, scale, tile_size=256):
+    result = tiles.TileGrid(tile_size)
+    result.set_geometry(image_size, scale)
+    return result
+
+
+def test_tiles_cover_the_image_once():
+    g = grid((1000, 700), 0.75)
+    assert g.display_size() == (750, 525)
+    covered = set()
+    for col, row in g.tiles_in_rect(0, 0, *g.display_size()):
+        x, y, w, h = g.tile_rect(col, row)
+        pixels = {(px, py) for px in range(x, x + w) for py in range(y, y + h)}
+        assert not covered & pixels
+        covered |= pixels
+    assert len(covered) == 750*525
+
+
+def test_edge_tiles_are_clipped():
+    g = grid((1000, 700), 0.75)
+    assert g.tiles_in_rect(0, 0, 750, 525)[-1] == (2, 2)
+    assert g.tile_rect(2, 2) == (512, 512, 238, 13)
+    assert g.tile_rect(0, 0) == (0, 0, 256, 256)
+
+
+def test_tiles_in_rect_clips_to_the_image():
+    g = grid((1000, 700), 1.0)
+    # a viewport scrolled past the bottom right corner, and one starting left of the image
+    assert g.tiles_in_rect(900, 600, 500, 500) == [(3, 2)]
+    assert g.tiles_in_rect(-100, 0, 200, 10) == [(0, 0)]
+    # a rect ending exactly on a tile border doesn't pull in the next tile
+    assert g.tiles_in_rect(0, 0, 256, 256) == [(0, 0)]
+    assert g.tiles_in_rect(256, 0, 1, 1) == [(1, 0)]
+
+
+def test_tiny_image():
+    g = grid((3, 2), 0.01)
+    assert g.display_size() == (1, 1)
+    assert g.tiles_in_rect(0, 0, 10, 10) == [(0, 0)]
+    (x, y, w, h), _, _ = g.source_rect(0, 0)
+    assert (x, y) == (0, 0) and w >= 1 and h >= 1
+
+
+def test_source_rect_covers_the_tile():
+    g = grid((4000, 3000), 0.3)
+    for col, row in g.tiles_in_rect(0, 0, *g.display_size()):
+        tile_x, tile_y, tile_w, tile_h = g.tile_rect(col, row)
+        for level_size in (None, (2000, 1500), (1000, 750)):
+            (x, y, w, h), (scale_x, scale_y), (dx, dy) = g.source_rect(col, row, level_size)
+            width, height = level_size or g.image_size
+            assert 0 <= x and 0 <= y and x + w <= width and y + h <= height
+            # scaled to display size the source rect starts at or before the tile and ends at or after it
+            assert math.isclose(scale_x, g.display_size()[0]/width) and math.isclose(scale_y, g.display_size()[1]/height)
+            assert x*scale_x <= tile_x + 0.5 and y*scale_y <= tile_y + 0.5
+            assert (x + w)*scale_x >= tile_x + tile_w - 0.5 and (y + h)*scale_y >= tile_y + tile_h - 0.5
+            assert (dx, dy) == (round(tile_x - x*scale_x), round(tile_y - y*scale_y))
+
+
+def test_key_changes_with_the_zoom():
+    g = grid((1000, 700), 0.5)
+    key = g.key()
+    g.set_geometry((1000, 700), 0.5000000001)
+    assert g.key() == key
+    g.set_geometry((1000, 700), 0.6)
+    assert g.key() != key
+    assert grid((1000, 700), 0.5, tile_size=128).key() != key
@@ -0,0 +1,24 @@
+import os
+import queue
+import time
+
+import watcher
+
+
+def test_polling_reports_files_once_they_settle(tmp_path):
+    reported = queue.Queue()
+    index = watcher.FolderIndex(str(tmp_path), (".png",))
+    folder_watcher = watcher.FolderWatcher(index, reported.put, poll_interval=0.05, use_inotify=False)
+    folder_watcher.start()
+    time.sleep(0.2) # files from before the first scan aren't new
+    path = tmp_path / "new.png"
+    path.write_bytes(b"x"*10)
+    (tmp_path / "notes.txt").write_bytes(b"not an image")
+    assert reported.get(timeout=5) == str(path)
+    path.unlink()
+    (tmp_path / "second.png").write_bytes(b"y")
+    assert reported.get(timeout=5) == os.path.join(tmp_path, "second.png")
+    folder_watcher.stop()
+    folder_watcher.join(5)
+    assert reported.empty()
+    assert index.latest() == os.path.join(tmp_path, "second.png")
@@ -0,0 +1,50 @@
+"""Tile grid for viewport rendering. The displayed (zoomed) image is split into square tiles
+and only the tiles inside the visible rect get resampled. Both image panes share one grid."""
+import math
+
+class TileGrid:
+    def __init__(self, tile_size=256):
+        self.tile_size = tile_size
+        self.image_size = (0, 0) # source image (width, height)
+        self.scale = 1.0 # display pixels per source pixel
+
+    def set_geometry(self, image_size, scale):
+        self.image_size = image_size
+        self.scale = scale
+
+    def display_size(self):
+        """(width, height) of the whole image at the current scale"""
+        return (max(1, round(self.image_size[0]*self.scale)), max(1, round(self.image_size[1]*self.scale)))
+
+    def tiles_in_rect(self, x, y, w, h):
+        """(column, row) of every tile intersecting the display rect x, y, w, h"""
+        display_w, display_h = self.display_size()
+        first_col, first_row = max(0, x//self.tile_size), max(0, y//self.tile_size)
+        last_col = min(math.ceil(display_w/self.tile_size), (x + w - 1)//self.tile_size + 1)
+        last_row = min(math.ceil(display_h/self.tile_size), (y + h - 1)//self.tile_size + 1)
+        return [(col, row) for row in range(first_row, last_row) for col in range(first_col, last_col)]
+
+    def tile_rect(self, col, row):
+        """display rect (x, y, w, h) of a tile, clipped to the image"""
+        display_w, display_h = self.display_size()
+        x, y = col*self.tile_size, row*self.tile_size
+        return (x, y, min(self.tile_size, display_w - x), min(self.tile_size, display_h - y))
+
+    def source_rect(self, col, row, source_size=None):
+        """rect (x, y, w, h) in a source image covering a tile, widened to whole pixels.
+        source_size is the size of the image sampled from (a pyramid level), default the full image.
+        Also returns (scale_x, scale_y), display pixels per source pixel, and the offset (dx, dy)
+        of the tile inside that rect once it's scaled to display size"""
+        source_w, source_h = source_size or self.image_size
+        display_w, display_h = self.display_size()
+        scale_x, scale_y = display_w/source_w, display_h/source_h
+        x, y, w, h = self.tile_rect(col, row)
+        src_x0, src_y0 = math.floor(x/scale_x), math.floor(y/scale_y)
+        src_x1 = min(source_w, math.ceil((x + w)/scale_x))
+        src_y1 = min(source_h, math.ceil((y + h)/scale_y))
+        offset = (round(x - src_x0*scale_x), round(y - src_y0*scale_y))
+        return (src_x0, src_y0, max(1, src_x1 - src_x0), max(1, src_y1 - src_y0)), (scale_x, scale_y), offset
+
+    def key(self):
+        """identifies the zoom level, used in tile cache keys"""
+        return (self.image_size, round(self.scale, 6), self.tile_size)
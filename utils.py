@@ -1,50 +1,19 @@
 import os
-import platform
-import subprocess
-from PIL import Image
-from io import BytesIO
 import glob
+import threading
 
-def copy_image_to_clipboard(image_path):
-    # Load the image
-    img = Image.open(image_path)
-
-    if platform.system() == "Windows":
-        import win32clipboard  # Import only on Windows
-        # For Windows using pywin32
-        output = BytesIO()
-        img.save(output, 'BMP')
-        data = output.getvalue()[14:]  # Remove the BMP header
-        output.close()
-
-        win32clipboard.OpenClipboard()
-        win32clipboard.EmptyClipboard()
-        win32clipboard.SetClipboardData(win32clipboard.CF_DIB, data)
-        win32clipboard.CloseClipboard()
-    elif platform.system() == "Darwin":
-        # For macOS using subprocess
-        img.save("/tmp/temp_image.png")  # Save temporarily
-        result = subprocess.run(["osascript", "-e", f"set the clipboard to (read (POSIX file \"/tmp/temp_image.png\") as JPEG picture)"], capture_output=True)
-        if result.returncode != 0:
-            print("Failed to copy to clipboard:", result.stderr.decode())
-    elif platform.system() == "Linux":
-        # For Linux using xclip
-        img.save("/tmp/temp_image.png")  # Save temporarily
-        result = subprocess.run(['xclip', '-selection', 'clipboard', '-t', 'image/png', '-i', '/tmp/temp_image.png'], capture_output=True)
-        if result.returncode != 0:
-            print("Failed to copy to clipboard:", result.stderr.decode())
+def format_bytes(size):
+    """human readable size like 1.50MB"""
+    if (size>1048576): # >1MB
+        return f"{size/1048576 :.2f}MB"
+    elif (size>1024): # >1KB
+        return f"{size/1024 :.2f}KB"
     else:
-        raise OSError("Unsupported operating system.")
-
+        return f"{size :.2f}B"
 
 def format_file_size(file_size):
     file_size_str = "Size: "
-    if (file_size>1048576): # >1MB
-        file_size_str += f"{file_size/1048576 :.2f}MB"
-    elif (file_size>1024): # >1KB
-        file_size_str += f"{file_size/1024 :.2f}KB"
-    else:
-        file_size_str += f"{file_size :.2f}B"
+    file_size_str += format_bytes(file_size)
     return file_size_str
 
 def get_latest_image_from_dir(dir: str):
@@ -61,4 +30,16 @@ def get_base_name_wo_ext(file: str):
     """get base name of a file without extensions and parent directory"""
     basename = os.path.basename(file)
     basename_wo_ext = basename[:basename.find(".")]
-    return basename_wo_ext
\ No newline at end of file
+    return basename_wo_ext
+
+def write_file(path, data):
+    """write data to path through a temporary file that replaces it. Readers never see a half written file
+    and a path that is a hardlink (e.g. to a dedup store blob) gets a new file instead of changing the shared one"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
@@ -0,0 +1,229 @@
+"""Watch a folder for new images.
+
+FolderIndex keeps the folder's matching files and their mtimes in memory, so finding
+the latest one doesn't need a glob and a stat per file. FolderWatcher keeps the index
+up to date with inotify on Linux, or by polling elsewhere, and reports new files.
+CompressQueue runs a fixed number of workers behind a bounded queue, so a burst of new
+files blocks the watcher instead of starting unbounded encodes.
+"""
+import ctypes
+import ctypes.util
+import os
+import queue
+import select
+import struct
+import sys
+import threading
+
+class FolderIndex:
+    """name -> (mtime_ns, size) of the files in directory with one of the extensions"""
+    def __init__(self, directory, extensions=(".png",)):
+        self.directory = directory
+        self.extensions = tuple(ext.lower() for ext in extensions)
+        self.files = {}
+        self.latest_name = None
+        self.lock = threading.Lock()
+
+    def matches(self, name):
+        return name.lower().endswith(self.extensions)
+
+    def scan(self):
+        """full scan of the directory. Returns the paths that are new or changed since the last scan"""
+        found = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if self.matches(entry.name) and entry.is_file():
+                    stat = entry.stat()
+                    found[entry.name] = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            changed = [name for name, info in found.items() if self.files.get(name) != info]
+            self.files = found
+            self._find_latest()
+        return [os.path.join(self.directory, name) for name in changed]
+
+    def update(self, name):
+        """stat one file and update the index. Returns True if it's new or changed"""
+        if not self.matches(name): return False
+        try:
+            stat = os.stat(os.path.join(self.directory, name))
+        except OSError:
+            self.remove(name)
+            return False
+        info = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            if self.files.get(name) == info: return False
+            self.files[name] = info
+            if self.latest_name is None or info[0] >= self.files[self.latest_name][0]:
+                self.latest_name = name
+        return True
+
+    def remove(self, name):
+        with self.lock:
+            if self.files.pop(name, None) is not None and name == self.latest_name:
+                self._find_latest()
+
+    def _find_latest(self):
+        self.latest_name = max(self.files, key=lambda name: self.files[name][0]) if self.files else None
+
+    def latest(self):
+        """path of the most recently modified file, or None"""
+        with self.lock:
+            return os.path.join(self.directory, self.latest_name) if self.latest_name else None
+
+
+class Inotify:
+    """Minimal inotify binding (Linux) with ctypes"""
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    EVENT_HEADER = struct.Struct("iIII") # wd, mask, cookie, name length
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_MOVED_FROM | self.IN_DELETE
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+
+    def read(self, timeout):
+        """(mask, name) events, waits up to timeout seconds"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable: return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset+length].rstrip(b"\0"))
+            offset += length
+            events.append((mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FolderWatcher(threading.Thread):
+    """Keeps index up to date and calls on_new_file(path) for every new file.
+    Uses inotify on Linux, otherwise (or if inotify fails) polls every poll_interval seconds.
+    inotify also reports files rewritten in place. Polling doesn't: it only rescans when the folder's
+    mtime changes, which happens when files are added, renamed or deleted but not when one is rewritten"""
+    def __init__(self, index, on_new_file=None, poll_interval=1.0, use_inotify=True):
+        super().__init__(daemon=True)
+        self.index = index
+        self.on_new_file = on_new_file
+        self.poll_interval = poll_interval
+        self.stopped = threading.Event()
+        self.inotify = None
+        if use_inotify and sys.platform.startswith("linux"):
+            try:
+                self.inotify = Inotify(index.directory)
+            except OSError as e:
+                print("inotify not available, polling instead:", e)
+        self.mode = "inotify" if self.inotify is not None else "polling"
+
+    def stop(self):
+        self.stopped.set()
+
+    def report(self, paths):
+        if self.on_new_file is None: return
+        for path in paths:
+            if self.stopped.is_set(): return
+            self.on_new_file(path)
+
+    def run(self):
+        # scan after the watch is set up so nothing created in between is missed
+        self.index.scan()
+        try:
+            if self.inotify is not None: self.run_inotify(self.inotify)
+            else: self.run_polling()
+        finally:
+            if self.inotify is not None: self.inotify.close()
+
+    def run_inotify(self, inotify):
+        while not self.stopped.is_set():
+            new_files = []
+            for mask, name in inotify.read(0.5):
+                if mask & Inotify.IN_Q_OVERFLOW:
+                    # events were lost, fall back to one full scan
+                    new_files.extend(self.index.scan())
+                elif mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+                    self.index.remove(name)
+                elif self.index.update(name):
+                    new_files.append(os.path.join(self.index.directory, name))
+            self.report(new_files)
+
+    def run_polling(self):
+        last_dir_mtime = None
+        pending = {} # path -> (mtime, size) seen once, reported when it's the same on the next poll
+        while not self.stopped.wait(self.poll_interval):
+            try:
+                dir_mtime = os.stat(self.index.directory).st_mtime_ns
+            except OSError:
+                continue
+            # the directory's mtime changes when files are added, rescan only then.
+            # Files that are settling are stat'ed one by one in between
+            if dir_mtime != last_dir_mtime:
+                last_dir_mtime = dir_mtime
+                for path in self.index.scan():
+                    pending[path] = None
+            elif pending:
+                for path in pending:
+                    self.index.update(os.path.basename(path))
+            else:
+                continue
+            with self.index.lock:
+                infos = {path: self.index.files.get(os.path.basename(path)) for path in pending}
+            ready = []
+            for path, info in infos.items():
+                if info is None:
+                    del pending[path]
+                elif pending[path] == info: # unchanged for one poll, done being written
+                    ready.append(path)
+                    del pending[path]
+                else:
+                    pending[path] = info
+            self.report(ready)
+
+
+class CompressQueue:
+    """Bounded work queue with a fixed number of worker threads calling func(path).
+    put() blocks while the queue is full, which slows the producer down instead of piling up work"""
+    def __init__(self, func, workers=2, max_queued=16, on_result=None):
+        self.func = func
+        self.on_result = on_result
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.threads = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, path):
+        self.queue.put(path)
+
+    def work(self):
+        while True:
+            path = self.queue.get()
+            if path is None: break
+            try:
+                result = self.func(path)
+                if self.on_result: self.on_result(result)
+            except Exception as e:
+                print("Error occured while compressing", path, ":", e)
+            finally:
+                self.queue.task_done()
+
+    def close(self):
+        """wait for queued work and stop the workers"""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
@@ -1,10 +1,13 @@
 from PySide6.QtWidgets import (
     QScrollArea, QWidget, QLabel, QSpinBox, QSlider,
-    QScrollBar, QPushButton,
-    QHBoxLayout
+    QScrollBar, QPushButton, QDoubleSpinBox, QComboBox,
+    QHBoxLayout, QSizePolicy, QListView
 )
-from PySide6.QtCore import Qt, QPoint, QMimeData
-from PySide6.QtGui import QDrag
+from PySide6.QtCore import Qt, QPoint, QMimeData, QSize, QAbstractListModel, QModelIndex
+from PySide6.QtGui import QDrag, QPainter, QImage, QPixmap
+import math
+
+import cache, metrics, perf, pyramid, qtimage, resizing, utils
 
 class customScrollArea(QScrollArea):
     def __init__(self):
@@ -108,18 +111,167 @@ class customScrollArea(QScrollArea):
         return super().mouseReleaseEvent(event)
     # --------- methods for panning :END ----------------
      
+class ImageView(QWidget):
+    """Paints an image through a TileGrid (see tiles.py), centered when it's smaller than the view.
+    Only the tiles in the repainted rect are resampled and tiles are cached per zoom level.
+    Tiles are sampled from the nearest level of an ImagePyramid (see pyramid.py).
+    With a diff source (another ImageView) it paints a heatmap of the difference to that view's image instead.
+    Diff tiles are computed off the UI thread (set_on_diff_tile_needed), a gray placeholder is painted until they arrive.
+    An image smaller than the grid's image size (a downscaled encode) is stretched over the same display rect"""
+    def __init__(self, tile_grid, tile_cache_mb=64, pyramid_mb=256):
+        super().__init__()
+        self.tile_grid = tile_grid
+        self.image = None # QImage
+        self.pyramid = None
+        self.pyramid_max_bytes = pyramid_mb*1048576
+        self.tiles = cache.LRUCache(tile_cache_mb*1048576, sizeof=lambda tile: tile.sizeInBytes())
+        self.diff_source = None
+        self.pending_tiles = set() # keys of the diff tiles being computed
+        # (image, diff source, grid) part of the keys of the diff tiles on screen, None when no diff is shown.
+        # Set on the UI thread, diff renders on other threads compare against it instead of reading the widget
+        self.diff_tiles_key = None
+        self.on_diff_tile_needed_func = None
+    
+    def set_on_diff_tile_needed(self, func):
+        """set a function to call with (key, render) for a diff tile that isn't cached. It should call render()
+        off the UI thread and pass the tile (a QImage, None if it isn't needed anymore) to set_tile"""
+        self.on_diff_tile_needed_func = func
+    
+    def set_tile(self, key, tile):
+        self.pending_tiles.discard(key)
+        if tile is None: return
+        self.tiles.put(key, tile)
+        self.update()
+    
+    def set_diff_source(self, view):
+        """paint the difference to view's image, None to paint the image itself"""
+        self.diff_source = view
+        self.update()
+    
+    def showing_diff(self):
+        return self.diff_source is not None and self.diff_source.image is not None and self.image is not None
+    
+    def set_image(self, image):
+        if image is not self.image:
+            self.image = image
+            self.pyramid = pyramid.ImagePyramid(image, self.pyramid_max_bytes)
+        self.update_size()
+        self.update()
+    
+    def clear(self):
+        self.image = None
+        self.pyramid = None
+        self.diff_tiles_key = None
+        self.update()
+    
+    def update_size(self):
+        """resize to the displayed image so the scroll area can scroll over it. Call after the grid's scale changes"""
+        size = QSize(*self.tile_grid.display_size()) if self.image is not None else QSize(0, 0)
+        self.setMinimumSize(size)
+        # resize now (not on the next layout) so scroll bar ranges are right for adjust_scrollbars
+        if self.parentWidget() is not None:
+            self.resize(size.expandedTo(self.parentWidget().size()))
+    
+    def image_offset(self):
+        """top left of the image in widget coordinates"""
+        display_w, display_h = self.tile_grid.display_size()
+        return max(0, (self.width() - display_w)//2), max(0, (self.height() - display_h)//2)
+    
+    def level_scale(self):
+        """display pixels per pixel of this view's image"""
+        return self.tile_grid.scale*self.tile_grid.image_size[0]/self.image.width()
+    
+    def render_tile(self, col, row):
+        grid = self.tile_grid
+        level = self.pyramid.level_for_scale(self.level_scale())
+        (src_x, src_y, src_w, src_h), (scale_x, scale_y), (dx, dy) = grid.source_rect(col, row, (level.width(), level.height()))
+        _, _, w, h = grid.tile_rect(col, row)
+        source = level.copy(src_x, src_y, src_w, src_h)
+        scaled = source.scaled(math.ceil(src_w*scale_x), math.ceil(src_h*scale_y), Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        return scaled.copy(dx, dy, w, h)
+    
+    def diff_tile_render(self, key, col, row):
+        """function that returns the heatmap of the difference in one tile, computed at the zoom level the tile
+        is sampled from. It only uses what's picked here, so it can run on another thread. It returns None
+        if the view moved on to another image or zoom (key isn't on screen anymore) before it ran"""
+        grid = self.tile_grid
+        level = self.pyramid.level_for_scale(self.level_scale())
+        source_level = self.diff_source.pyramid.level_for_scale(self.diff_source.level_scale())
+        (src_x, src_y, src_w, src_h), (scale_x, scale_y), (dx, dy) = grid.source_rect(col, row, (level.width(), level.height()))
+        _, _, w, h = grid.tile_rect(col, row)
+        def render():
+            if self.diff_tiles_key != key[:-2]: return None
+            source_tile = source_level.copy(src_x, src_y, src_w, src_h)
+            if source_level.size() != level.size():
+                # the pyramids stopped at different depths or the image was downscaled, so sample the same area
+                # of the source and bring it to this level's size (downscaled encodes are compared to the downscaled source)
+                ratio_x, ratio_y = source_level.width()/level.width(), source_level.height()/level.height()
+                source_tile = source_level.copy(math.floor(src_x*ratio_x), math.floor(src_y*ratio_y),
+                                                max(1, round(src_w*ratio_x)), max(1, round(src_h*ratio_y)))
+                source_tile = source_tile.scaled(src_w, src_h, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+            with perf.span("tile.render_diff"):
+                compressed, compressed_image = qtimage.qimage_rgb(level.copy(src_x, src_y, src_w, src_h))
+                source, source_image = qtimage.qimage_rgb(source_tile)
+                heatmap = metrics.error_heatmap(source, compressed)
+                diff = QImage(heatmap.data, src_w, src_h, src_w*3, QImage.Format_RGB888)
+                # zoomed in, show the pixels as blocks instead of blurring them together
+                transform = Qt.FastTransformation if scale_x >= 1 else Qt.SmoothTransformation
+                scaled = diff.scaled(math.ceil(src_w*scale_x), math.ceil(src_h*scale_y), Qt.IgnoreAspectRatio, transform)
+                return scaled.copy(dx, dy, w, h)
+        return render
+    
+    def paintEvent(self, event):
+        if self.image is None: return
+        painter = QPainter(self)
+        offset_x, offset_y = self.image_offset()
+        rect = event.rect().translated(-offset_x, -offset_y)
+        showing_diff = self.showing_diff()
+        # diff tiles are cached next to the image tiles, so switching between them is instant once both were painted
+        tiles_key = (self.image.cacheKey(), self.diff_source.image.cacheKey() if showing_diff else None) + self.tile_grid.key()
+        self.diff_tiles_key = tiles_key if showing_diff else None
+        for col, row in self.tile_grid.tiles_in_rect(rect.x(), rect.y(), rect.width(), rect.height()):
+            key = tiles_key + (col, row)
+            tile = self.tiles.get(key)
+            x, y, w, h = self.tile_grid.tile_rect(col, row)
+            if tile is None and showing_diff and self.on_diff_tile_needed_func:
+                if key not in self.pending_tiles:
+                    self.pending_tiles.add(key)
+                    self.on_diff_tile_needed_func(key, self.diff_tile_render(key, col, row))
+                painter.fillRect(x + offset_x, y + offset_y, w, h, Qt.darkGray)
+                continue
+            if tile is None:
+                with perf.span("tile.render"):
+                    tile = self.diff_tile_render(key, col, row)() if showing_diff else self.render_tile(col, row)
+                self.tiles.put(key, tile)
+                perf.count("tile.render")
+            painter.drawImage(x + offset_x, y + offset_y, tile)
+        painter.end()
+
 class CompressionPanel(QWidget):
-    """Horizontal widget. Label, Spinbox, Slider"""
-    def __init__(self, default_cmprs_val=5):
+    """Horizontal widget. Format and effort ComboBoxes, Label, Spinbox, Slider.
+    The value range is set per format with set_range, min is the best quality and max the smallest file"""
+    def __init__(self, default_cmprs_val=5, min_cmprs_value=1, max_cmprs_value=31, formats=("jpeg",), presets=("balanced",),
+                 default_format="jpeg", default_preset="balanced"):
         super().__init__()
         
         layout = QHBoxLayout() # Main layout
         
+        # output format and encoder effort
+        self.format_combobox = QComboBox()
+        self.format_combobox.addItems(formats)
+        self.format_combobox.setCurrentText(default_format)
+        self.preset_combobox = QComboBox()
+        self.preset_combobox.addItems(presets)
+        self.preset_combobox.setCurrentText(default_preset)
+        self.preset_combobox.setStatusTip("Encoder effort: fast encodes quickly, small spends more time for smaller files")
+        self.format_combobox.currentTextChanged.connect(self.on_format_change)
+        self.preset_combobox.currentTextChanged.connect(self.on_format_change)
+        
         #compression label and some attributes
         cmprs_label = QLabel("Compression: ")
         self.initial_cmprs_value = default_cmprs_val
-        self.min_cmprs_value = 1
-        self.max_cmprs_value = 31
+        self.min_cmprs_value = min_cmprs_value
+        self.max_cmprs_value = max_cmprs_value
 
         # compression spinbox
         self.cmprs_spinbox = QSpinBox()
@@ -137,6 +289,9 @@ class CompressionPanel(QWidget):
         self.cmprs_slider.valueChanged.connect(self.slider_val_changed)
         self.cmprs_spinbox.valueChanged.connect(self.spinbox_val_changed)
         
+        layout.addWidget(QLabel("Format: "))
+        layout.addWidget(self.format_combobox)
+        layout.addWidget(self.preset_combobox)
         layout.addWidget(cmprs_label)
         layout.addWidget(self.cmprs_spinbox)
         layout.addWidget(self.cmprs_slider)
@@ -144,6 +299,30 @@ class CompressionPanel(QWidget):
         
         # On value changed
         self.on_value_change_func = None
+        self.on_format_change_func = None
+    
+    def set_range(self, min_value, max_value, value):
+        """change the value range (for another format) without calling the value change function"""
+        self.min_cmprs_value = min_value
+        self.max_cmprs_value = max_value
+        for widget in (self.cmprs_spinbox, self.cmprs_slider):
+            widget.blockSignals(True)
+            widget.setRange(min_value, max_value)
+            widget.setValue(value)
+            widget.blockSignals(False)
+    
+    def set_on_format_change(self, func):
+        """set a function to call with (format, preset) when either changes"""
+        self.on_format_change_func = func
+    
+    def on_format_change(self):
+        if self.on_format_change_func: self.on_format_change_func(self.format(), self.preset())
+    
+    def format(self):
+        return self.format_combobox.currentText()
+    
+    def preset(self):
+        return self.preset_combobox.currentText()
     
     def spinbox_val_changed(self, value):
         # Block the signal and change the value of slider and unblock the signal
@@ -169,3 +348,278 @@ class CompressionPanel(QWidget):
     def value(self):
         """Get compression value"""
         return self.cmprs_slider.value()
+
+
+class ResizePanel(QWidget):
+    """Horizontal widget. Max width, max height, scale (%) and megapixel Spinboxes, filter ComboBox.
+    0 turns a limit off, the strictest limit wins. Makes a resizing.Resize"""
+    def __init__(self, resize=None):
+        super().__init__()
+        resize = resize or resizing.Resize()
+        
+        layout = QHBoxLayout()
+        
+        self.width_spinbox = self.limit_spinbox(QSpinBox(), 0, 65535, resize.max_width)
+        self.height_spinbox = self.limit_spinbox(QSpinBox(), 0, 65535, resize.max_height)
+        self.percent_spinbox = self.limit_spinbox(QSpinBox(), 0, 100, resize.percent)
+        self.percent_spinbox.setSuffix("%")
+        self.megapixels_spinbox = self.limit_spinbox(QDoubleSpinBox(), 0, 1000, resize.megapixels)
+        self.megapixels_spinbox.setSingleStep(0.5)
+        self.megapixels_spinbox.setDecimals(1)
+        self.megapixels_spinbox.setSuffix(" MP")
+        self.filter_combobox = QComboBox()
+        self.filter_combobox.addItems(resizing.FILTERS)
+        self.filter_combobox.setCurrentText(resize.filter)
+        self.filter_combobox.setStatusTip("Resampling filter, lanczos is the sharpest, box and bilinear are faster")
+        self.filter_combobox.currentTextChanged.connect(self.on_change)
+        
+        layout.addWidget(QLabel("Resize: max "))
+        layout.addWidget(self.width_spinbox)
+        layout.addWidget(QLabel("x"))
+        layout.addWidget(self.height_spinbox)
+        layout.addWidget(QLabel("scale"))
+        layout.addWidget(self.percent_spinbox)
+        layout.addWidget(QLabel("max"))
+        layout.addWidget(self.megapixels_spinbox)
+        layout.addWidget(self.filter_combobox)
+        layout.addStretch()
+        layout.setContentsMargins(layout.contentsMargins().left(), 0, layout.contentsMargins().right(), 0)
+        self.setLayout(layout)
+        self.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Fixed)
+        
+        self.on_change_func = None
+    
+    def limit_spinbox(self, spinbox, minimum, maximum, value):
+        spinbox.setRange(minimum, maximum)
+        spinbox.setSpecialValueText("off") # shown at the minimum, 0
+        spinbox.setValue(value or 0)
+        spinbox.valueChanged.connect(self.on_change)
+        return spinbox
+    
+    def set_on_change(self, func):
+        """set a function to call with the new resizing.Resize when any setting changes"""
+        self.on_change_func = func
+    
+    def on_change(self):
+        if self.on_change_func: self.on_change_func(self.settings())
+    
+    def settings(self):
+        """resizing.Resize of the current settings"""
+        return resizing.Resize(self.width_spinbox.value() or None, self.height_spinbox.value() or None,
+                               self.percent_spinbox.value() or None, self.megapixels_spinbox.value() or None,
+                               self.filter_combobox.currentText())
+
+
+class TargetSizePanel(QWidget):
+    """Horizontal widget. Label, Spinbox (KB), Fit button. Finds the compression value for a size budget"""
+    def __init__(self, default_target_kb=200):
+        super().__init__()
+        
+        layout = QHBoxLayout()
+        
+        target_label = QLabel("Target size (KB): ")
+        self.target_spinbox = QSpinBox()
+        self.target_spinbox.setMinimum(1)
+        self.target_spinbox.setMaximum(1048576)
+        self.target_spinbox.setValue(default_target_kb)
+        
+        self.fit_btn = QPushButton("Fit")
+        self.fit_btn.setStatusTip("Find the best compression value that is under the target size")
+        self.fit_btn.clicked.connect(self.on_fit)
+        
+        layout.addWidget(target_label)
+        layout.addWidget(self.target_spinbox)
+        layout.addWidget(self.fit_btn)
+        layout.addStretch()
+        layout.setContentsMargins(layout.contentsMargins().left(), 0, layout.contentsMargins().right(), 0)
+        self.setLayout(layout)
+        self.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Fixed)
+        
+        self.on_fit_func = None
+    
+    def set_on_fit(self, func):
+        """set a function to call with the target size in bytes when Fit is clicked"""
+        self.on_fit_func = func
+    
+    def on_fit(self):
+        if self.on_fit_func: self.on_fit_func(self.target_bytes())
+    
+    def target_bytes(self):
+        """Get target size in bytes"""
+        return self.target_spinbox.value()*1024
+
+
+class QualityTargetPanel(QWidget):
+    """Horizontal widget. Label, metric ComboBox, threshold Spinbox, Fit button.
+    Finds the smallest output that still meets the quality threshold"""
+    # metric -> (min, max, step, decimals, default)
+    RANGES = {"ssim": (0.5, 1.0, 0.005, 3, 0.98), "psnr": (20.0, 60.0, 0.5, 1, 40.0)}
+    
+    def __init__(self):
+        super().__init__()
+        
+        layout = QHBoxLayout()
+        
+        quality_label = QLabel("Target quality: ")
+        self.metric_combobox = QComboBox()
+        self.metric_combobox.addItem("SSIM ≥", "ssim")
+        self.metric_combobox.addItem("PSNR (dB) ≥", "psnr")
+        self.metric_combobox.currentIndexChanged.connect(self.on_metric_change)
+        self.threshold_spinbox = QDoubleSpinBox()
+        
+        self.fit_btn = QPushButton("Fit")
+        self.fit_btn.setStatusTip("Find the highest compression value that still meets the quality")
+        self.fit_btn.clicked.connect(self.on_fit)
+        
+        layout.addWidget(quality_label)
+        layout.addWidget(self.metric_combobox)
+        layout.addWidget(self.threshold_spinbox)
+        layout.addWidget(self.fit_btn)
+        layout.addStretch()
+        layout.setContentsMargins(layout.contentsMargins().left(), 0, layout.contentsMargins().right(), 0)
+        self.setLayout(layout)
+        self.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Fixed)
+        
+        self.on_fit_func = None
+        self.on_metric_change()
+    
+    def on_metric_change(self):
+        minimum, maximum, step, decimals, default = self.RANGES[self.metric()]
+        self.threshold_spinbox.setDecimals(decimals)
+        self.threshold_spinbox.setRange(minimum, maximum)
+        self.threshold_spinbox.setSingleStep(step)
+        self.threshold_spinbox.setValue(default)
+    
+    def set_on_fit(self, func):
+        """set a function to call with (metric, threshold) when Fit is clicked"""
+        self.on_fit_func = func
+    
+    def on_fit(self):
+        if self.on_fit_func: self.on_fit_func(self.metric(), self.threshold())
+    
+    def metric(self):
+        """"ssim" or "psnr" """
+        return self.metric_combobox.currentData()
+    
+    def threshold(self):
+        return self.threshold_spinbox.value()
+
+
+class SessionModel(QAbstractListModel):
+    """List model over a session.Session for the ThumbnailStrip. Views only ask for the rows they show,
+    a row's thumbnail is asked for (set_on_thumbnail_needed) the first time it's shown and painted once it's set"""
+    def __init__(self, session):
+        super().__init__()
+        self.session = session
+        self.thumbnails = {} # path -> QPixmap
+        self.requested = set() # paths whose thumbnail is being made
+        self.on_thumbnail_needed_func = None
+    
+    def set_on_thumbnail_needed(self, func):
+        """set a function to call with an image path whose thumbnail should be made, see set_thumbnail"""
+        self.on_thumbnail_needed_func = func
+    
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.session)
+    
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid(): return None
+        image = self.session.images[index.row()]
+        if role == Qt.DisplayRole:
+            text = image.name
+            if image.compression_value is not None: text += f"\nq {image.compression_value}"
+            if image.error: text += "  failed"
+            elif image.out_bytes is not None: text += f"  -{image.saved_percent():.0f}%"
+            return text
+        if role == Qt.DecorationRole:
+            thumbnail = self.thumbnails.get(image.path)
+            if thumbnail is None and image.path not in self.requested and self.on_thumbnail_needed_func:
+                self.requested.add(image.path)
+                self.on_thumbnail_needed_func(image.path)
+            return thumbnail
+        if role == Qt.ToolTipRole:
+            text = f"{image.path}\n{utils.format_bytes(image.in_bytes)}"
+            if image.error: text += f"\nexport failed: {image.error}"
+            elif image.out_bytes is not None: text += f" -> {utils.format_bytes(image.out_bytes)}"
+            return text
+        return None
+    
+    def set_thumbnail(self, path, image):
+        """show image (a QImage) as path's thumbnail"""
+        self.thumbnails[path] = QPixmap.fromImage(image)
+        self.refresh(path)
+    
+    def refresh(self, path=None):
+        """repaint path's row, all rows if path is None. Call after the session's images changed"""
+        if path is None:
+            if not len(self.session): return
+            first, last = self.index(0), self.index(len(self.session) - 1)
+        else:
+            position = self.session.position(path)
+            if position is None: return
+            first = last = self.index(position)
+        self.dataChanged.emit(first, last)
+    
+    def images_added(self, count):
+        """call after count images were added to the end of the session"""
+        self.beginInsertRows(QModelIndex(), len(self.session) - count, len(self.session) - 1)
+        self.endInsertRows()
+    
+    def remove(self, path):
+        """take path out of the session and the view"""
+        position = self.session.position(path)
+        if position is None: return
+        self.beginRemoveRows(QModelIndex(), position, position)
+        self.session.remove(path)
+        self.endRemoveRows()
+        self.thumbnails.pop(path, None)
+        self.requested.discard(path)
+
+
+class ThumbnailStrip(QListView):
+    """Horizontal, scrollable row of thumbnails of a SessionModel, one item selected.
+    Item widgets are never created, only the visible items are painted, so it stays fast with many images"""
+    def __init__(self, model, thumbnail_size=96):
+        super().__init__()
+        self.setModel(model)
+        self.setViewMode(QListView.IconMode)
+        self.setFlow(QListView.LeftToRight)
+        self.setWrapping(False)
+        self.setMovement(QListView.Static)
+        self.setUniformItemSizes(True) # the layout doesn't measure every item
+        self.setIconSize(QSize(thumbnail_size, thumbnail_size))
+        self.setGridSize(QSize(thumbnail_size + 40, thumbnail_size + 40))
+        self.setTextElideMode(Qt.ElideMiddle)
+        self.setWordWrap(True)
+        self.setHorizontalScrollMode(QListView.ScrollPerPixel)
+        self.setSelectionMode(QListView.SingleSelection)
+        self.setFixedHeight(thumbnail_size + 60)
+        self.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Fixed)
+        self.selectionModel().currentChanged.connect(self.on_select)
+        self.on_select_func = None
+        self.selecting = False # set_current is selecting, not the user
+    
+    def set_on_select(self, func):
+        """set a function to call with the image path when another thumbnail is selected"""
+        self.on_select_func = func
+    
+    def on_select(self, current, previous):
+        if current.isValid() and self.on_select_func and not self.selecting:
+            self.on_select_func(self.model().session.images[current.row()].path)
+    
+    def set_current(self, path):
+        """select path's thumbnail without calling the select function"""
+        position = self.model().session.position(path)
+        if position is None: return
+        self.selecting = True
+        self.setCurrentIndex(self.model().index(position))
+        self.selecting = False
+        self.scrollTo(self.model().index(position))
+    
+    def remove(self, path, current=None):
+        """take path's thumbnail out and select current's (nothing if it's None), without calling the select function"""
+        self.selecting = True
+        self.model().remove(path)
+        position = self.model().session.position(current) if current else None
+        self.setCurrentIndex(self.model().index(position) if position is not None else QModelIndex())
+        self.selecting = False
@@ -0,0 +1,147 @@
+"""Background jobs for the GUI, run on a QThreadPool so the UI thread never blocks"""
+import threading
+from io import BytesIO
+
+from PySide6.QtCore import QObject, QRunnable, QThread, Signal
+from PySide6.QtGui import QImage
+
+from PIL import Image
+
+import core, encoders, metadata, metrics, perf, qtimage, utils
+
+class WorkerSignals(QObject):
+    """Signals are emitted from the worker thread and delivered on the UI thread"""
+    finished = Signal(int, object) # job id, result
+    failed = Signal(int, str) # job id, error message
+
+
+class Worker(QRunnable):
+    """Runs func(cancelled) on a thread pool. func gets a threading.Event that is set by cancel().
+    thread_priority (a QThread.Priority) is applied to the pool thread while the job runs"""
+    def __init__(self, job_id, func, thread_priority=None):
+        super().__init__()
+        self.job_id = job_id
+        self.func = func
+        self.thread_priority = thread_priority
+        self.cancelled = threading.Event()
+        self.signals = WorkerSignals()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self):
+        if self.cancelled.is_set(): return
+        if self.thread_priority is not None:
+            QThread.currentThread().setPriority(self.thread_priority)
+        try:
+            result = self.func(self.cancelled)
+        except encoders.EncodeCancelled:
+            return
+        except Exception as e:
+            self.signals.failed.emit(self.job_id, str(e) or type(e).__name__)
+            return
+        if not self.cancelled.is_set():
+            self.signals.finished.emit(self.job_id, result)
+
+
+def decode_preview(data):
+    """QImage of encoded bytes. Formats Qt has no plugin for (avif, jxl) are decoded with Pillow"""
+    image = QImage.fromData(data)
+    if not image.isNull(): return image
+    with Image.open(BytesIO(data)) as img:
+        img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+        image_format = QImage.Format_RGBA8888 if img.mode == "RGBA" else QImage.Format_RGB888
+        # copy() so the QImage owns its pixels once the PIL image is gone
+        return QImage(img.tobytes(), img.width, img.height, img.width*len(img.mode), image_format).copy()
+
+
+def encode_job(encoder, compression_value, output_img_path, cache=None):
+    """job for Worker: encode (or take it from cache), write the output file and decode the preview.
+    Returns (compressed bytes, preview QImage)"""
+    def job(cancelled):
+        data, cached = core.encode(encoder, compression_value, cache, cancelled)
+        encoder.check_cancelled(cancelled)
+        with perf.span("encode.write"):
+            utils.write_file(output_img_path, data)
+        key = core.cache_key(cache, encoder, compression_value) if cache is not None else None
+        image = cache.get_preview(key) if cached else None
+        if image is None:
+            # QImage (unlike QPixmap) can be made off the UI thread
+            with perf.span("preview.decode"):
+                image = decode_preview(data)
+            if cache is not None: cache.previews.put(key, image)
+        return data, image
+    return job
+
+
+def write_job(output_img_path, data):
+    """job for Worker: write bytes that are already encoded (a cache hit) to the output file"""
+    def job(cancelled):
+        with perf.span("encode.write"):
+            utils.write_file(output_img_path, data)
+    return job
+
+
+def export_job(encoder, compression_value, output_img_path, cache=None):
+    """job for Worker: encode (or take it from cache) and write the output file. Nothing is kept in memory
+    besides what cache keeps, so many exports can be queued. Returns the output size"""
+    def job(cancelled):
+        data, _ = core.encode(encoder, compression_value, cache, cancelled)
+        encoder.check_cancelled(cancelled)
+        with perf.span("encode.write"):
+            utils.write_file(output_img_path, data)
+        return len(data)
+    return job
+
+
+def thumbnail_job(path, size):
+    """job for Worker: QImage of the image at path, upright and fitted in size x size.
+    JPEGs are decoded at a reduced size right away"""
+    def job(cancelled):
+        with perf.span("thumbnail"):
+            with Image.open(path) as img:
+                orientation = metadata.read(img)["orientation"]
+                img.draft("RGB", (size, size))
+                img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+            img = metadata.apply_orientation(img, orientation)
+            img.thumbnail((size, size), Image.Resampling.BILINEAR)
+            image_format = QImage.Format_RGBA8888 if img.mode == "RGBA" else QImage.Format_RGB888
+            return QImage(img.tobytes(), img.width, img.height, img.width*len(img.mode), image_format).copy()
+    return job
+
+
+def prefetch_job(encoder, compression_value, cache):
+    """job for Worker: encode compression_value into the cache (bytes and preview) if it isn't there yet.
+    Returns the encoded size, or None if it was cached already"""
+    def job(cancelled):
+        key = cache.source_key(encoder.input_image) + encoder.settings_key(compression_value)
+        # read the levels directly so prefetching doesn't count as cache hits/misses
+        data = cache.memory.get(key)
+        if data is not None and key in cache.previews: return None
+        if data is None:
+            data = encoder.encode(compression_value, cancelled)
+            cache.put(key, data)
+        encoder.check_cancelled(cancelled)
+        cache.previews.put(key, decode_preview(data))
+        return len(data)
+    return job
+
+
+def metrics_job(source, preview, resize_filter="lanczos"):
+    """job for Worker: metrics.Metrics of the preview QImage against source, an imagestore.DecodedImage.
+    A downscaled preview is measured against the source resized with resize_filter"""
+    def job(cancelled):
+        with perf.span("metrics"):
+            compressed, image = qtimage.qimage_rgb(preview)
+            # a newer encode replaced the preview, don't spend the comparison on this one
+            encoders.Encoder.check_cancelled(cancelled)
+            return metrics.compare(source, compressed, resize_filter=resize_filter)
+    return job
+
+
+def ladder_order(center, min_value, max_value, radius=None):
+    """compression values from center outwards (center, center-1, center+1, ...), within radius if given"""
+    values = range(min_value, max_value+1)
+    if radius is not None:
+        values = [v for v in values if abs(v-center) <= radius]
+    return sorted(values, key=lambda v: (abs(v-center), v))